@@ -0,0 +1,56 @@
+import argparse
+from .attention_aggregation_method import AttentionAggregationMethod
+from .server import serve
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    The `att_viz` command line entry point.
+
+    Args:
+        argv: the command line arguments (default `None`, i.e. `sys.argv[1:]`)
+    """
+    parser = argparse.ArgumentParser(
+        prog="att_viz", description="Self-attention visualization."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser(
+        "serve",
+        help="serve the completions saved in a directory, without rendering them first",
+    )
+    serve_parser.add_argument(
+        "store_dir", help="the directory holding the attention store files"
+    )
+    serve_parser.add_argument(
+        "--host", default="127.0.0.1", help="the address to listen on"
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=8000, help="the port to listen on"
+    )
+    serve_parser.add_argument(
+        "--aggregation",
+        choices=[method.name.lower() for method in AttentionAggregationMethod],
+        default="none",
+        help="the aggregation method of the served attention",
+    )
+    serve_parser.add_argument(
+        "--raw-tokens",
+        action="store_true",
+        help="do not remove special characters from tokens",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(
+            args.store_dir,
+            args.host,
+            args.port,
+            AttentionAggregationMethod[args.aggregation.upper()],
+            prettify_tokens=not args.raw_tokens,
+        )
+
+
+if __name__ == "__main__":
+    main()
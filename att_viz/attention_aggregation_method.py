@@ -1,4 +1,7 @@
+import torch
 from enum import Enum
+from .attention_rollout import AttentionRollout
+from .packed_attention import PackedAttention
 
 
 class AttentionAggregationMethod(Enum):
@@ -7,6 +10,10 @@ class AttentionAggregationMethod(Enum):
     The supported aggregation methods are:
         - `NONE`: no dimension collapses
         - `HEADWISE_AVERAGING`: head dimension is collapsed
+        - `LAYERWISE_AVERAGING`: layer dimension is collapsed
+        - `HEADWISE_MAX`: head dimension is collapsed
+        - `GLOBAL_AVERAGING`: layer and head dimensions are collapsed
+        - `ROLLOUT`: layer and head dimensions are collapsed
     """
 
     NONE = 1
@@ -14,3 +21,60 @@ class AttentionAggregationMethod(Enum):
 
     HEADWISE_AVERAGING = 2
     """ Represents the headwise averaging aggregation method - the head dimension of the attention matrix collapses, while the layer dimension is kept. """
+
+    LAYERWISE_AVERAGING = 3
+    """ Represents the layerwise averaging aggregation method - the layer dimension of the attention matrix collapses, while the head dimension is kept. """
+
+    HEADWISE_MAX = 4
+    """ Represents the headwise maximum aggregation method - every attention value is the maximum over the heads of its layer. """
+
+    GLOBAL_AVERAGING = 5
+    """ Represents the global averaging aggregation method - the attention matrix is averaged over all layers and heads. """
+
+    ROLLOUT = 6
+    """ Represents attention rollout - the attention of the heads is averaged, then propagated through the layers. See `AttentionRollout`. """
+
+    @property
+    def collapses_layers(self) -> bool:
+        """Whether the layer dimension of the attention matrix collapses."""
+        return self in (
+            AttentionAggregationMethod.LAYERWISE_AVERAGING,
+            AttentionAggregationMethod.GLOBAL_AVERAGING,
+            AttentionAggregationMethod.ROLLOUT,
+        )
+
+    @property
+    def collapses_heads(self) -> bool:
+        """Whether the head dimension of the attention matrix collapses."""
+        return self in (
+            AttentionAggregationMethod.HEADWISE_AVERAGING,
+            AttentionAggregationMethod.HEADWISE_MAX,
+            AttentionAggregationMethod.GLOBAL_AVERAGING,
+            AttentionAggregationMethod.ROLLOUT,
+        )
+
+    def aggregate(self, packed: PackedAttention) -> PackedAttention:
+        """
+        Aggregates a packed attention matrix, reducing all of its rows at once.
+
+        Args:
+            packed: the packed attention matrix, of shape `num_layers x num_heads x num_packed`
+
+        Returns:
+            the aggregated attention matrix, whose collapsed dimensions have size 1 (`packed` itself for `NONE`)
+        """
+        attention = packed.data
+
+        if self == AttentionAggregationMethod.NONE:
+            return packed
+        if self == AttentionAggregationMethod.ROLLOUT:
+            return AttentionRollout().apply(packed)
+
+        if self == AttentionAggregationMethod.HEADWISE_MAX:
+            attention = torch.amax(attention, 1, keepdim=True)
+        else:
+            dims = (0,) if self.collapses_layers else ()
+            dims += (1,) if self.collapses_heads else ()
+            attention = torch.mean(attention, dims, keepdim=True)
+
+        return PackedAttention(attention, packed.row_offsets)
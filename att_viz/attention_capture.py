@@ -0,0 +1,200 @@
+import torch
+from .attention_matrix import AttentionMatrix, LazyAttentionMatrix
+from .attention_store import AttentionStoreWriter
+from .packed_attention import PackedAttention
+
+
+class AttentionCapture:
+    """
+    Captures the self-attention of every decoding step while a model generates text.
+
+    Returning attentions from `generate` (`return_dict_in_generate=True`) keeps the per-layer tensors of every step
+    alive on the model's device until generation ends. Instead, a forward hook copies the attention row of the newest
+    token to the CPU as soon as each step has been computed (optionally downcasting it), and appends it to a
+    preallocated buffer: in memory, or in an `AttentionStore` file. Device memory then no longer grows with the
+    number of generated tokens.
+
+    Usage:
+        with AttentionCapture(model, prompt_length, max_new_tokens) as capture:
+            sequences = model.generate(..., output_attentions=True, return_dict_in_generate=False)
+
+        attention_matrix = capture.close(tokens)
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        prompt_length: int,
+        max_new_tokens: int,
+        dtype: torch.dtype | None = None,
+        store_path: str | None = None,
+        layers: list[int] | None = None,
+        heads: list[int] | None = None,
+        batch_index: int = 0,
+        padding: int = 0,
+    ):
+        """
+        `AttentionCapture` constructor.
+
+        Args:
+            model: the HuggingFace model used for generation, which must be called with `output_attentions=True`
+
+            prompt_length: the length of the prompt in tokens
+
+            max_new_tokens: the maximum number of tokens to be generated
+
+            dtype: the dtype of the captured attention values, e.g. `torch.float16` (default `None`, i.e. the model's dtype)
+
+            store_path: if given, the captured attention is written to this `AttentionStore` file instead of being kept in memory (default `None`)
+
+            layers: the indices of the layers to capture (default `None`, i.e. all layers)
+
+            heads: the indices of the heads to capture (default `None`, i.e. all heads)
+
+            batch_index: the index of the captured sequence, when generating for a batch of prompts (default `0`)
+
+            padding: the number of padding tokens on the left of the captured sequence's prompt, whose attention is dropped (default `0`)
+        """
+        self.model = model
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.dtype = dtype
+        self.store_path = store_path
+        self.layers = layers
+        self.heads = heads
+        self.batch_index = batch_index
+        self.padding = padding
+
+        # Sum of the row lengths of all response tokens: prompt_length, prompt_length + 1, ...
+        self.capacity = (
+            max_new_tokens * prompt_length + max_new_tokens * (max_new_tokens - 1) // 2
+        )
+
+        self._handle = None
+        self._writer = None
+        self._buffer = None
+        self._row_offsets = [0]
+
+    def __enter__(self):
+        """Starts capturing attention."""
+        self._handle = self.model.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, *args):
+        """Stops capturing attention."""
+        self._handle.remove()
+        self._handle = None
+
+    def _hook(self, module, args, output) -> None:
+        """
+        Forward hook: appends the attention rows of the newest token of a decoding step.
+
+        Args:
+            module: the hooked model
+
+            args: the positional arguments of the forward call
+
+            output: the output of the forward call, holding one attention tensor per layer (`batch_size x num_heads x a x b`)
+        """
+        # Gather on one device, so that the step is copied to the CPU in a single transfer
+        rows = PackedAttention.step_rows(
+            output["attentions"], self.layers, self.heads, batch_index=self.batch_index
+        )
+        rows = rows[..., self.padding :]  # num_layers x num_heads x seq_len
+
+        if self._writer is None and self._buffer is None:
+            self._allocate(*rows.shape[:2], rows.dtype)
+
+        if self._writer is not None:
+            self._writer.append(rows)
+        else:
+            start = self._row_offsets[-1]
+            end = start + rows.shape[-1]
+            assert end <= self.capacity, "The capture's capacity has been exceeded"
+
+            self._buffer[:, :, start:end].copy_(rows)
+            self._row_offsets.append(end)
+
+    def _allocate(self, num_layers: int, num_heads: int, dtype: torch.dtype) -> None:
+        """
+        Allocates the capture buffer, once the shape of the attention is known.
+
+        Args:
+            num_layers: the number of layers of the model
+
+            num_heads: the number of heads of the model
+
+            dtype: the dtype of the model's attention
+        """
+        dtype = dtype if self.dtype is None else self.dtype
+
+        if self.store_path is not None:
+            self._writer = AttentionStoreWriter(
+                self.store_path, num_layers, num_heads, self.capacity, dtype
+            )
+        else:
+            self._buffer = torch.empty(
+                (num_layers, num_heads, self.capacity), dtype=dtype
+            )
+
+    def close(
+        self,
+        tokens: list[str],
+        model_name: str | None = None,
+        num_steps: int | None = None,
+    ) -> AttentionMatrix:
+        """
+        Finishes the capture.
+
+        Args:
+            tokens: the list of tokens of the prompt and model completion
+
+            model_name: the name or directory of the model, recorded in the `AttentionStore` if any (default `None`)
+
+            num_steps: the number of decoding steps to keep, e.g. up to the sequence's end in a batch whose other
+                sequences kept generating (default `None`, i.e. all captured steps)
+
+        Returns:
+            the captured, unformatted attention matrix: a `LazyAttentionMatrix` over the written store if `store_path`
+            was given, or an in-memory `AttentionMatrix` otherwise
+        """
+        assert (
+            self._writer is not None or self._buffer is not None
+        ), "No attention has been captured"
+
+        if num_steps is not None:
+            del self._row_offsets[num_steps + 1 :]
+
+        if self._writer is not None:
+            if num_steps is not None:
+                self._writer.truncate(num_steps)
+
+            store = self._writer.close(
+                tokens,
+                self.prompt_length,
+                model_name,
+                layer_indices=self.layers,
+                head_indices=self.heads,
+            )
+            self._writer = None
+            return LazyAttentionMatrix(store)
+
+        num_packed = self._row_offsets[-1]
+        attention = PackedAttention(
+            self._buffer[:, :, :num_packed], torch.tensor(self._row_offsets)
+        )
+        self._buffer = None
+
+        return AttentionMatrix(attention, self.layers, self.heads)
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionCapture`
+        """
+        return f"AttentionCapture (prompt length: {self.prompt_length}, max new tokens: {self.max_new_tokens}, store: {self.store_path})"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionCapture`
+        """
+        return self.__repr__()
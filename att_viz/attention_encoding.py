@@ -0,0 +1,24 @@
+from enum import Enum
+
+
+class AttentionEncoding(Enum):
+    """
+    Represents the possible encodings of the attention matrix in the generated HTML files.
+    The supported encodings are:
+        - `JSON`: nested lists of decimal numbers
+        - `FLOAT16`: base64-encoded half-precision floats
+        - `UINT8`: base64-encoded 8-bit integers, with one scale per attention row
+        - `SPARSE`: base64-encoded column indices and float16 values of the non-zero attention values only
+    """
+
+    JSON = 1
+    """ Represents the JSON encoding - every attention value is written as decimal text (about 20 characters per value). """
+
+    FLOAT16 = 2
+    """ Represents the float16 encoding - attention values are written as half-precision floats, encoded in base64 (about 2.7 characters per value). """
+
+    UINT8 = 3
+    """ Represents the 8-bit quantized encoding - every attention row is scaled by its maximum and rounded to 256 levels, then encoded in base64 (about 1.3 characters per value). """
+
+    SPARSE = 4
+    """ Represents the sparse encoding - only non-zero attention values are written, with their column indices, so that the size is proportional to the number of kept values of a sparsified attention matrix (see `AttentionSparsity`). """
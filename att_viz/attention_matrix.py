@@ -1,5 +1,10 @@
 import torch
 from .attention_aggregation_method import AttentionAggregationMethod
+from .attention_reprocessing import AttentionReprocessing
+from .attention_sparsity import AttentionSparsity
+from .attention_store import AttentionStore
+from .instrumentation import stage
+from .packed_attention import PackedAttention
 
 
 class AttentionMatrix:
@@ -9,7 +14,12 @@ class AttentionMatrix:
 
     """
 
-    def __init__(self, attention_matrix):
+    def __init__(
+        self,
+        attention_matrix,
+        layers: list[int] | None = None,
+        heads: list[int] | None = None,
+    ):
         """
         `AttentionMatrix` constructor.
 
@@ -19,74 +29,154 @@ class AttentionMatrix:
 
                 `a x b` is either `num_prompt_tokens x num_prompt_tokens` (for the first response token only)
                     or `1 x num_prompt_tokens` otherwise self.num_layers = len(attention_matrix[0])
+
+                alternatively, an unformatted `PackedAttention` (e.g. read from an `AttentionStore`)
+
+            layers: the indices of the model layers to keep when formatting. For a `PackedAttention`,
+                the model indices of the layers it holds (default `None`, i.e. all layers)
+
+            heads: the indices of the attention heads to keep when formatting. For a `PackedAttention`,
+                the model indices of the heads it holds (default `None`, i.e. all heads)
         """
         self.attention_matrix = attention_matrix  # out-of-the-box, has shape: `num_response_tokens x num_layers x 1 x num_heads x a x b` where `a x b` is either `num_prompt_tokens x num_prompt_tokens` (for the first response token only), or `1 x num_prompt_tokens` otherwise.
-        self.num_layers = len(attention_matrix[0])
-        self.num_heads = len(attention_matrix[0][0][0])
+
+        if isinstance(attention_matrix, PackedAttention):
+            num_layers, num_heads = attention_matrix.data.shape[:2]
+        else:
+            num_layers = len(attention_matrix[0])
+            num_heads = len(attention_matrix[0][0][0])
+
+        self._selected = layers is not None or heads is not None
+
+        # Model indices of the layers and heads of this matrix (heads before any aggregation)
+        self.layer_indices = list(range(num_layers)) if layers is None else list(layers)
+        self.head_indices = list(range(num_heads)) if heads is None else list(heads)
+
+        self.num_layers = len(self.layer_indices)
+        self.num_heads = len(self.head_indices)
         self.is_formatted = False
 
     def format(
-        self, aggr_method: AttentionAggregationMethod, zero_first_attention: bool
+        self,
+        aggr_method: AttentionAggregationMethod,
+        zero_first_attention: bool,
+        dtype: torch.dtype | None = None,
+        sparsity: AttentionSparsity | None = None,
+        reprocessing: AttentionReprocessing | None = None,
+        device: torch.device | str | None = "cpu",
     ) -> None:
         """
         Formats the wrapped attention matrix for HTML visualization, aggregating it based on the specified aggregation method.
 
+        The formatted attention matrix is stored as a `PackedAttention` of shape `num_layers x num_heads x num_packed`.
+        Formatting runs on the device of the model's attention, over all decoding steps at once; the result is then
+        copied to `device` in a single transfer, after being converted to `dtype`.
+
         Args:
             aggr_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`.
 
             zero_first_attention: whether to ignore self attention values towards the first token.
+
+            dtype: the dtype of the formatted attention matrix, e.g. `torch.float16` (default `None`, i.e. the model's dtype)
+
+            sparsity: which attention values to keep in every row, the others being set to zero; render with
+                `AttentionEncoding.SPARSE` to only write the kept values. See `AttentionSparsity` (default `None`, i.e. keep all values)
+
+            reprocessing: the interpretability transform of `post_processing.py`, applied before `sparsity`.
+                See `AttentionReprocessing` (default `None`)
+
+            device: the device of the formatted attention matrix (default `"cpu"`; `None` keeps it on the device of
+                the model's attention)
         """
 
         if self.is_formatted:
             pass
 
         self.is_formatted = True
-        res = []
 
-        ## attention has shape num_response_tokens x 1 x num_heads x a x b
-        num_response_tokens = len(self.attention_matrix)
+        with stage("format", aggregation_method=aggr_method.name) as formatting:
+            if isinstance(self.attention_matrix, PackedAttention):
+                packed = self.attention_matrix
+            else:
+                # Without aggregation, values can be packed directly in the requested dtype
+                packed = PackedAttention.from_generate(
+                    self.attention_matrix,
+                    dtype if aggr_method == AttentionAggregationMethod.NONE else None,
+                    self.layer_indices if self._selected else None,
+                    self.head_indices if self._selected else None,
+                )
+
+            formatted = self._format_packed(
+                packed, aggr_method, zero_first_attention, dtype, sparsity, reprocessing
+            )
+            self.attention_matrix = (
+                formatted if device is None else formatted.to(device)
+            )
+            self.num_layers, self.num_heads = self.attention_matrix.data.shape[:2]
+            formatting.add_tensor(self.attention_matrix)
+
+    @staticmethod
+    def _format_packed(
+        packed: PackedAttention,
+        aggr_method: AttentionAggregationMethod,
+        zero_first_attention: bool,
+        dtype: torch.dtype | None,
+        sparsity: AttentionSparsity | None = None,
+        reprocessing: AttentionReprocessing | None = None,
+    ) -> PackedAttention:
+        """
+        Applies the aggregation method, the first-token zeroing, the reprocessing and the sparsity to a packed attention matrix, in place when possible.
+
+        Args:
+            packed: the packed, unformatted attention matrix (`num_layers x num_heads x num_packed`)
+
+            aggr_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`.
 
-        for i in range(num_response_tokens):
+            zero_first_attention: whether to ignore self attention values towards the first token.
 
-            token_attention = self.attention_matrix[i]
+            dtype: the dtype of the formatted attention matrix (`None` keeps the current dtype)
 
-            squeezed = []
-            for layer_attention in token_attention:
-                layer_attention = torch.squeeze(layer_attention)  # num_heads x seq_len
+            sparsity: which attention values to keep in every row (default `None`, i.e. keep all values)
 
-                if i == 0:  # num_heads x seq_len x seq_len -> num_heads x seq_len
-                    layer_attention = layer_attention[:, -1]
+            reprocessing: the interpretability transform of `post_processing.py` (default `None`)
+
+        Returns:
+            the formatted `PackedAttention`
+        """
+        # The first token is zeroed after aggregating, so that rollouts propagate the unmodified attention
+        attention = aggr_method.aggregate(packed).data
 
-                if zero_first_attention:
-                    layer_attention[:, 0] = torch.zeros(len(layer_attention))
+        if zero_first_attention:
+            attention[..., packed.row_offsets[:-1]] = 0
 
-                if aggr_method == AttentionAggregationMethod.NONE:
-                    squeezed.append(layer_attention.tolist())  # num_heads x seq_len
-                elif aggr_method == AttentionAggregationMethod.HEADWISE_AVERAGING:
-                    squeezed.append(
-                        torch.mean(
-                            layer_attention, 0, keepdim=True
-                        ).tolist()  # 1 x seq_len
-                    )  ## Keep only attentions related to the prompt tokens
+        if reprocessing is not None:
+            reprocessing.apply(PackedAttention(attention, packed.row_offsets))
 
-            # squeezed has shape num_layers x {num_heads if aggr_method is NONE else 1 for HEADWISE_AVERAGING} x {num_tokens_before_current_one}
-            res.append(squeezed)
+        if sparsity is not None:
+            sparsity.apply(PackedAttention(attention, packed.row_offsets))
 
-        ## res has shape: num_res_tokens x num_layers x num_heads x {varying: num_tokens_before_current_one}
-        nh = len(res[0][0])
-        nl = len(res[0])
-        tmp1 = [
-            [[token_attention[l][h] for token_attention in res] for h in range(nh)]
-            for l in range(nl)
-        ]
+        if dtype is not None and attention.dtype != dtype:
+            attention = attention.to(dtype)
 
-        assert len(tmp1) == nl
-        assert len(tmp1[0]) == nh
-        assert len(tmp1[0][0]) == len(res)
+        return PackedAttention(attention, packed.row_offsets)
+
+    def get_slice(
+        self, layers: slice = slice(None), heads: slice = slice(None)
+    ) -> PackedAttention:
+        """
+        Returns a range of layers and heads of the formatted attention matrix.
+
+        Args:
+            layers: the range of layers to return
 
-        self.attention_matrix = tmp1
-        self.num_heads = nh
-        self.num_layers = nl
+            heads: the range of heads to return
+
+        Returns:
+            the requested part of the formatted attention matrix (a view, no values are copied)
+        """
+        assert self.is_formatted, "The attention matrix must be formatted first"
+
+        return self.attention_matrix.select(layers, heads)
 
     def __repr__(self):
         """
@@ -111,3 +201,107 @@ class AttentionMatrix:
             and self.is_formatted == other.is_formatted
             and len(self.attention_matrix) == len(other.attention_matrix)
         )  ## TODO find a way to compare content as well
+
+
+class LazyAttentionMatrix(AttentionMatrix):
+    """
+    An `AttentionMatrix` backed by a memory-mapped `AttentionStore`.
+
+    Formatting is deferred: `get_slice` only reads the requested layers (and heads, when they are not aggregated)
+    from disk, then formats them. The memory used while rendering is therefore proportional to one chunk,
+    not to the whole attention matrix.
+    """
+
+    def __init__(self, store: AttentionStore):
+        """
+        `LazyAttentionMatrix` constructor. No attention values are read from disk.
+
+        Args:
+            store: the `AttentionStore` holding the unformatted attention matrix
+        """
+        super().__init__(store.map(), store.layer_indices, store.head_indices)
+        self.store = store
+        self._format_args = None
+
+    def format(
+        self,
+        aggr_method: AttentionAggregationMethod,
+        zero_first_attention: bool,
+        dtype: torch.dtype | None = None,
+        sparsity: AttentionSparsity | None = None,
+        reprocessing: AttentionReprocessing | None = None,
+        device: torch.device | str | None = "cpu",
+    ) -> None:
+        """
+        Records how the attention matrix should be formatted. Values are formatted on access, see `get_slice`.
+
+        Args:
+            aggr_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`.
+
+            zero_first_attention: whether to ignore self attention values towards the first token.
+
+            dtype: the dtype of the formatted attention matrix, e.g. `torch.float16` (default `None`, i.e. the stored dtype)
+
+            sparsity: which attention values to keep in every row. See `AttentionSparsity` (default `None`, i.e. keep all values)
+
+            reprocessing: the interpretability transform of `post_processing.py`. See `AttentionReprocessing` (default `None`)
+
+            device: the device of the returned slices (default `"cpu"`; `None` keeps them on the CPU, where the store
+                is read and formatted)
+        """
+        self.is_formatted = True
+        self._format_args = (
+            aggr_method,
+            zero_first_attention,
+            dtype,
+            sparsity,
+            reprocessing,
+            device,
+        )
+
+        if aggr_method.collapses_layers:
+            self.num_layers = 1
+        if aggr_method.collapses_heads:
+            self.num_heads = 1
+
+    def get_slice(
+        self, layers: slice = slice(None), heads: slice = slice(None)
+    ) -> PackedAttention:
+        """
+        Reads a range of layers and heads from the store and formats it.
+
+        Args:
+            layers: the range of layers to return
+
+            heads: the range of heads to return (of the formatted attention matrix)
+
+        Returns:
+            the requested part of the formatted attention matrix (a copy, held in memory)
+        """
+        assert self.is_formatted, "The attention matrix must be formatted first"
+
+        aggr_method, zero_first_attention, dtype, sparsity, reprocessing, device = (
+            self._format_args
+        )
+        # Collapsed dimensions are read entirely, then the requested range of the aggregated matrix is returned
+        read_layers = slice(None) if aggr_method.collapses_layers else layers
+        read_heads = slice(None) if aggr_method.collapses_heads else heads
+
+        with stage("format", aggregation_method=aggr_method.name) as formatting:
+            mapped = self.attention_matrix.select(read_layers, read_heads)
+            chunk = PackedAttention(mapped.data.clone(), mapped.row_offsets)
+
+            # The mapped pages are not needed anymore: do not let them accumulate in memory
+            self.store.evict(read_layers)
+
+            formatted = self._format_packed(
+                chunk, aggr_method, zero_first_attention, dtype, sparsity, reprocessing
+            ).select(
+                layers if aggr_method.collapses_layers else slice(None),
+                heads if aggr_method.collapses_heads else slice(None),
+            )
+            if device is not None:
+                formatted = formatted.to(device)
+            formatting.add_tensor(formatted)
+
+        return formatted
@@ -0,0 +1,85 @@
+import torch
+from .packed_attention import PackedAttention
+
+
+class AttentionReprocessing:
+    """
+    Improves the interpretability of formatted attention matrices (the transform of `post_processing.py`).
+
+    In every row, the attention towards the first `firstignored` tokens is set to zero, then only the values more than
+    `cutoff` standard deviations above the mean are kept, and raised to the power of `corrfactor`. The mean and
+    standard deviation of a row are computed over the prompt tokens after the first `firstignored` ones.
+    """
+
+    def __init__(
+        self, cutoff: float = 0.5, corrfactor: float = 1.0 / 3.0, firstignored: int = 1
+    ):
+        """
+        `AttentionReprocessing` constructor.
+
+        Args:
+            cutoff: the number of standard deviations above the mean of a row from which values are kept (default `0.5`)
+
+            corrfactor: the power to which kept values are raised, to renormalize them (lower is stronger, default `1/3`)
+
+            firstignored: the number of first tokens whose attention is set to zero (default `1`)
+        """
+        self.cutoff = cutoff
+        self.corrfactor = corrfactor
+        self.firstignored = firstignored
+
+    def apply(self, packed: PackedAttention) -> PackedAttention:
+        """
+        Reprocesses all rows of a formatted attention matrix at once.
+
+        Args:
+            packed: the formatted attention matrix, of shape `... x num_packed`
+
+        Returns:
+            the reprocessed attention matrix (`packed`, modified in place)
+        """
+        device = packed.data.device
+        lengths = packed.lengths.to(device)
+        row_index = torch.repeat_interleave(
+            torch.arange(packed.num_rows, device=device), lengths
+        )
+        column = torch.arange(packed.data.shape[-1], device=device) - (
+            packed.row_offsets.to(device)[row_index]
+        )
+
+        values = packed.data.double()
+        values[..., column < self.firstignored] = 0
+
+        # The prompt length is the length of the first row (a length of 2 was a sentinel in
+        # the original reprocessing loop, which then took the next row's length)
+        prompt_length = next((n for n in lengths.tolist() if n != 2), 2)
+        in_stats = ((column >= self.firstignored) & (column < prompt_length)).double()
+
+        row_shape = (*values.shape[:-1], packed.num_rows)
+        count = torch.zeros(packed.num_rows, dtype=torch.float64, device=device)
+        count.index_add_(0, row_index, in_stats)
+
+        mean = torch.zeros(row_shape, dtype=torch.float64, device=device)
+        mean = mean.index_add_(-1, row_index, values * in_stats) / count
+        deviation = (values - mean[..., row_index]) * in_stats
+
+        variance = torch.zeros(row_shape, dtype=torch.float64, device=device)
+        variance = variance.index_add_(-1, row_index, deviation**2) / count
+
+        # Rows without statistics (NaN mean) keep no values
+        keep = values > (mean + self.cutoff * variance.sqrt())[..., row_index]
+        packed.data.copy_(torch.where(keep, values**self.corrfactor, 0))
+
+        return packed
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionReprocessing`
+        """
+        return f"AttentionReprocessing (cutoff: {self.cutoff}, corrfactor: {self.corrfactor}, firstignored: {self.firstignored})"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionReprocessing`
+        """
+        return self.__repr__()
@@ -0,0 +1,115 @@
+import torch
+from .packed_attention import PackedAttention
+
+
+class AttentionRollout:
+    """
+    Attention rollout (Abnar & Zuidema, 2020): the attention of the heads of every layer is averaged, mixed with the
+    residual connection (`residual * I + (1 - residual) * A`), and propagated from the first layer to the last
+    by multiplying these matrices. The result is the attention of the last layer towards the input tokens.
+
+    Since attention is causal, the rollout row of a token only depends on the rows of the previous tokens: rows are
+    computed incrementally, one decoding step at a time, from the rollout rows of the previous steps, and no product
+    of full attention matrices is ever computed.
+
+    Only the attention rows of the response tokens are captured (see `PackedAttention`): prompt tokens, whose rows
+    are missing, are treated as attending only to themselves.
+    """
+
+    def __init__(self, residual: float = 0.5):
+        """
+        `AttentionRollout` constructor.
+
+        Args:
+            residual: the weight of the residual connection in every layer (default `0.5`)
+        """
+        assert 0 <= residual <= 1, "The residual weight must be in [0, 1]"
+        self.residual = residual
+
+    def apply(self, packed: PackedAttention) -> PackedAttention:
+        """
+        Computes the attention rollout of a packed attention matrix.
+
+        Args:
+            packed: the packed attention matrix, of shape `num_layers x num_heads x num_packed`
+
+        Returns:
+            the rollout, of shape `1 x 1 x num_packed` (in float32)
+        """
+        attention = packed.data.float().mean(1)  # num_layers x num_packed
+        num_layers = attention.shape[0]
+        offsets = packed.row_offsets.tolist()
+        lengths = packed.lengths
+
+        # Row i is the attention of the token at position lengths[i] - 1
+        positions = lengths.to(attention.device) - 1
+        row_index = torch.repeat_interleave(
+            torch.arange(packed.num_rows, device=attention.device),
+            lengths.to(attention.device),
+        )
+        columns = torch.arange(attention.shape[-1], device=attention.device) - (
+            packed.row_offsets.to(attention.device)[row_index]
+        )
+
+        # Rollout rows of every layer, padded to the longest row
+        rollout = torch.zeros(
+            (num_layers, packed.num_rows, int(lengths.max())), device=attention.device
+        )
+
+        # The first layer only mixes its attention with the identity: all of its rows are computed at once
+        rollout[0, row_index, columns] = (1 - self.residual) * attention[0]
+        rollout[0, torch.arange(packed.num_rows), positions] += self.residual
+
+        for i in range(packed.num_rows):
+            self._step(attention[:, offsets[i] : offsets[i + 1]], rollout, positions, i)
+
+        return PackedAttention(
+            rollout[-1, row_index, columns].view(1, 1, -1), packed.row_offsets
+        )
+
+    def _step(
+        self,
+        rows: torch.Tensor,
+        rollout: torch.Tensor,
+        positions: torch.Tensor,
+        i: int,
+    ) -> None:
+        """
+        Computes the rollout row of one decoding step in every layer after the first, from the rows of the previous steps.
+
+        Args:
+            rows: the head-averaged attention rows of the step, of shape `num_layers x length`
+
+            rollout: the rollout rows of every layer, filled for the previous steps (and for the first layer)
+
+            positions: the position of the token of every row
+
+            i: the index of the row of the step
+        """
+        length = rows.shape[-1]
+        # The positions of this row which have rollout rows
+        captured = positions[: i + 1]
+
+        for layer in range(1, len(rows)):
+            previous = rollout[layer - 1, : i + 1, :length]
+
+            # Tokens without rollout rows only attend to themselves; the others pass on their own rollout
+            mixed = rows[layer].clone()
+            mixed[captured] = 0
+            mixed += rows[layer, captured] @ previous
+
+            rollout[layer, i, :length] = (
+                self.residual * previous[i] + (1 - self.residual) * mixed
+            )
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionRollout`
+        """
+        return f"AttentionRollout (residual: {self.residual})"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionRollout`
+        """
+        return self.__repr__()
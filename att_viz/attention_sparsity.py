@@ -0,0 +1,160 @@
+import torch
+from enum import Enum
+from .packed_attention import PackedAttention
+
+
+class SparsityMethod(Enum):
+    """
+    Represents the possible ways of selecting the attention values kept in every row of a formatted attention matrix.
+    The supported methods are:
+        - `TOP_K`: the largest values of every row
+        - `THRESHOLD`: the values above an absolute threshold
+        - `SIGMA_THRESHOLD`: the values above the row's mean plus a number of standard deviations
+        - `CUMULATIVE_MASS`: the largest values of every row, up to a fraction of the row's total attention
+    """
+
+    TOP_K = 1
+    """ Keeps the `k` largest values of every row. """
+
+    THRESHOLD = 2
+    """ Keeps the values strictly above an absolute threshold. """
+
+    SIGMA_THRESHOLD = 3
+    """ Keeps the values strictly above `mean + cutoff * std` of their row (see `post_processing.py`). """
+
+    CUMULATIVE_MASS = 4
+    """ Keeps the fewest largest values of every row whose sum reaches a fraction of the row's total attention. """
+
+
+class AttentionSparsity:
+    """
+    Sparsifies formatted attention matrices, by setting the attention values which are not kept to zero.
+
+    Most of the attention of a row sits in a few values: once the others are zeroed, the attention matrix can be
+    rendered with a sparse encoding (see `AttentionEncoding.SPARSE`), whose size is proportional to the number of
+    kept values instead of being quadratic in the length of the completion.
+    """
+
+    def __init__(self, method: SparsityMethod, value: float):
+        """
+        `AttentionSparsity` constructor. See also `top_k`, `threshold`, `sigma_threshold` and `cumulative_mass`.
+
+        Args:
+            method: how the kept values are selected. See `SparsityMethod`.
+
+            value: the parameter of the method: the number of values, the threshold, the number of standard deviations,
+                or the fraction of the attention mass
+        """
+        if method == SparsityMethod.TOP_K:
+            assert int(value) == value and value > 0, "k must be a positive integer"
+        if method == SparsityMethod.CUMULATIVE_MASS:
+            assert 0 < value <= 1, "The attention mass must be in (0, 1]"
+
+        self.method = method
+        self.value = value
+
+    @classmethod
+    def top_k(cls, k: int) -> "AttentionSparsity":
+        """Keeps the `k` largest values of every row."""
+        return cls(SparsityMethod.TOP_K, k)
+
+    @classmethod
+    def threshold(cls, threshold: float) -> "AttentionSparsity":
+        """Keeps the values strictly above `threshold`."""
+        return cls(SparsityMethod.THRESHOLD, threshold)
+
+    @classmethod
+    def sigma_threshold(cls, cutoff: float) -> "AttentionSparsity":
+        """Keeps the values strictly above `mean + cutoff * std` of their row."""
+        return cls(SparsityMethod.SIGMA_THRESHOLD, cutoff)
+
+    @classmethod
+    def cumulative_mass(cls, mass: float) -> "AttentionSparsity":
+        """Keeps the fewest largest values of every row whose sum reaches `mass` times the row's total."""
+        return cls(SparsityMethod.CUMULATIVE_MASS, mass)
+
+    def keep_mask(self, packed: PackedAttention) -> torch.Tensor:
+        """
+        Selects the attention values to keep, row by row, for all layers and heads at once.
+
+        Args:
+            packed: the formatted attention matrix, of shape `... x num_packed`
+
+        Returns:
+            a boolean tensor with the shape of `packed.data`, which is `True` for the kept values
+        """
+        data = packed.data.double()
+        row_index = torch.repeat_interleave(
+            torch.arange(packed.num_rows, device=data.device),
+            packed.lengths.to(data.device),
+        )
+
+        if self.method == SparsityMethod.THRESHOLD:
+            return data > self.value
+
+        if self.method == SparsityMethod.SIGMA_THRESHOLD:
+            lengths = packed.lengths.to(data.device, torch.float64)
+            row_shape = (*data.shape[:-1], packed.num_rows)
+
+            mean = torch.zeros(row_shape, dtype=data.dtype, device=data.device)
+            mean = mean.index_add_(-1, row_index, data) / lengths
+            deviation = data - mean[..., row_index]
+
+            variance = torch.zeros(row_shape, dtype=data.dtype, device=data.device)
+            variance = variance.index_add_(-1, row_index, deviation**2) / lengths
+
+            return deviation > self.value * variance.sqrt()[..., row_index]
+
+        # Sort the values of every row in decreasing order, keeping rows in place (both sorts are stable)
+        order = torch.argsort(-data, dim=-1, stable=True)
+        order = torch.gather(
+            order, -1, torch.argsort(row_index[order], dim=-1, stable=True)
+        )
+        sorted_data = torch.gather(data, -1, order)
+        row_offsets = packed.row_offsets.to(data.device)
+
+        if self.method == SparsityMethod.TOP_K:
+            rank = (
+                torch.arange(data.shape[-1], device=data.device)
+                - row_offsets[row_index]
+            )
+            keep_sorted = (rank < self.value).expand_as(data)
+        elif self.method == SparsityMethod.CUMULATIVE_MASS:
+            # The attention mass of the larger values of the same row, before each value
+            cumulative = torch.cumsum(sorted_data, -1)
+            row_start = torch.nn.functional.pad(cumulative, (1, 0))[..., row_offsets]
+            before = cumulative - sorted_data - row_start[..., :-1][..., row_index]
+            total = row_start[..., 1:] - row_start[..., :-1]
+
+            keep_sorted = before < self.value * total[..., row_index]
+        else:
+            raise ValueError(f"Unknown sparsity method: {self.method}")
+
+        keep = torch.empty_like(keep_sorted)
+        keep.scatter_(-1, order, keep_sorted)
+        return keep
+
+    def apply(self, packed: PackedAttention) -> PackedAttention:
+        """
+        Sets the attention values which are not kept to zero.
+
+        Args:
+            packed: the formatted attention matrix, of shape `... x num_packed`
+
+        Returns:
+            the sparsified attention matrix (`packed`, modified in place)
+        """
+        packed.data[~self.keep_mask(packed)] = 0
+        return packed
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionSparsity`
+        """
+        return f"AttentionSparsity ({self.method.name}, {self.value})"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionSparsity`
+        """
+        return self.__repr__()
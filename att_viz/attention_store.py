@@ -0,0 +1,435 @@
+import json
+import mmap
+import os
+import struct
+import torch
+from .packed_attention import PackedAttention
+
+
+class AttentionStore:
+    """
+    Single-file binary store for a model completion and its (unformatted) self-attention matrix.
+
+    The file layout is:
+        - an 8-byte magic string, padded to `DATA_OFFSET` bytes
+        - the raw packed attention buffer (see `PackedAttention`), in C order: `num_layers x num_heads x num_packed`
+        - a UTF-8 JSON metadata block: tokens, prompt length, model name, dtype, shape, model indices
+          of the stored layers and heads, per-step row offsets and per-layer byte offsets
+        - the length of the metadata block (8-byte little-endian unsigned integer), followed by the magic string
+
+    Keeping the metadata at the end of the file (as Parquet does) allows writing the attention values
+    as they are produced, before the completion tokens are known. Since every layer is one contiguous
+    block, layers and head ranges can be read without loading the rest of the file.
+    """
+
+    MAGIC = b"ATTVIZ01"
+    """ Identifies att_viz attention store files. """
+
+    DATA_OFFSET = 64
+    """ Where the attention buffer starts in the file (in bytes). """
+
+    SUFFIX = "_attention.attviz"
+    """ Suffix appended to save prefixes to obtain the store's file name. """
+
+    _FOOTER = struct.Struct("<Q8s")
+
+    def __init__(self, path: str):
+        """
+        `AttentionStore` constructor. Reads the metadata of an existing store, but none of the attention values.
+
+        Args:
+            path: the path of the store file
+        """
+        self.path = path
+
+        with open(path, "rb") as fp:
+            if fp.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{path} is not an att_viz attention store")
+
+            fp.seek(-self._FOOTER.size, os.SEEK_END)
+            metadata_length, magic = self._FOOTER.unpack(fp.read(self._FOOTER.size))
+            if magic != self.MAGIC:
+                raise ValueError(f"{path} is truncated or corrupt")
+
+            fp.seek(-self._FOOTER.size - metadata_length, os.SEEK_END)
+            self.metadata = json.loads(fp.read(metadata_length).decode("UTF-8"))
+
+        self.tokens: list[str] = self.metadata["tokens"]
+        self.prompt_length: int = self.metadata["prompt_length"]
+        self.model_name: str | None = self.metadata["model_name"]
+        self.dtype: torch.dtype = getattr(torch, self.metadata["dtype"])
+        self.num_layers, self.num_heads, self.num_packed = self.metadata["shape"]
+        self.row_offsets = torch.tensor(self.metadata["row_offsets"])
+        self.layer_indices: list[int] = self.metadata.get(
+            "layer_indices", list(range(self.num_layers))
+        )
+        self.head_indices: list[int] = self.metadata.get(
+            "head_indices", list(range(self.num_heads))
+        )
+        self.itemsize = torch.empty((), dtype=self.dtype).element_size()
+        self._mmap = None
+
+    @staticmethod
+    def path_for(save_prefix: str) -> str:
+        """
+        Returns the store path corresponding to a save prefix.
+
+        Args:
+            save_prefix: the prefix used for storing inference results
+
+        Returns:
+            the path of the store file
+        """
+        return f"{save_prefix}{AttentionStore.SUFFIX}"
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        attention: PackedAttention,
+        tokens: list[str],
+        prompt_length: int,
+        model_name: str | None = None,
+        layer_indices: list[int] | None = None,
+        head_indices: list[int] | None = None,
+    ) -> "AttentionStore":
+        """
+        Writes a completion and its packed attention matrix to a new store file.
+
+        Args:
+            path: the path of the store file
+
+            attention: the packed, unformatted attention matrix (see `PackedAttention.from_generate`)
+
+            tokens: the list of tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+            model_name: the name or directory of the model that generated the completion (default `None`)
+
+            layer_indices: the model indices of the layers held by `attention` (default `None`, i.e. all layers)
+
+            head_indices: the model indices of the heads held by `attention` (default `None`, i.e. all heads)
+
+        Returns:
+            the written `AttentionStore`
+        """
+        data = attention.data.detach().to("cpu").contiguous()
+
+        with open(path, "wb") as fp:
+            fp.write(cls.MAGIC.ljust(cls.DATA_OFFSET, b"\0"))
+            fp.write(data.view(torch.uint8).numpy())
+
+            cls._write_metadata(
+                fp,
+                shape=list(data.shape),
+                dtype=data.dtype,
+                row_offsets=attention.row_offsets.tolist(),
+                tokens=tokens,
+                prompt_length=prompt_length,
+                model_name=model_name,
+                layer_indices=layer_indices,
+                head_indices=head_indices,
+            )
+
+        return cls(path)
+
+    @classmethod
+    def _write_metadata(
+        cls,
+        fp,
+        shape: list[int],
+        dtype: torch.dtype,
+        row_offsets: list[int],
+        tokens: list[str],
+        prompt_length: int,
+        model_name: str | None,
+        layer_indices: list[int] | None,
+        head_indices: list[int] | None,
+    ) -> None:
+        """
+        Appends the metadata block and the footer to a store file, right after the attention buffer.
+        """
+        num_layers, num_heads, num_packed = shape
+        layer_nbytes = (
+            num_heads * num_packed * torch.empty((), dtype=dtype).element_size()
+        )
+
+        metadata = {
+            "format_version": 1,
+            "model_name": model_name,
+            "tokens": list(tokens),
+            "prompt_length": int(prompt_length),
+            "dtype": str(dtype).removeprefix("torch."),
+            "shape": shape,
+            "data_offset": cls.DATA_OFFSET,
+            "row_offsets": row_offsets,
+            "layer_indices": (
+                list(range(num_layers))
+                if layer_indices is None
+                else list(layer_indices)
+            ),
+            "head_indices": (
+                list(range(num_heads)) if head_indices is None else list(head_indices)
+            ),
+            "layer_offsets": [
+                cls.DATA_OFFSET + layer * layer_nbytes for layer in range(num_layers)
+            ],
+        }
+
+        encoded = json.dumps(metadata).encode("UTF-8")
+        fp.write(encoded)
+        fp.write(cls._FOOTER.pack(len(encoded), cls.MAGIC))
+
+    def read(
+        self, layers: slice = slice(None), heads: slice = slice(None)
+    ) -> PackedAttention:
+        """
+        Reads a range of layers and heads from the store. Only the requested values are read from disk.
+
+        Args:
+            layers: the range of layers to read
+
+            heads: the range of heads to read
+
+        Returns:
+            the requested part of the packed attention matrix
+        """
+        layer_range = range(self.num_layers)[layers]
+        head_range = range(self.num_heads)[heads]
+        assert (
+            layer_range.step == 1 and head_range.step == 1
+        ), "Only contiguous ranges are supported"
+
+        head_nbytes = self.num_packed * self.itemsize
+
+        data = torch.empty(
+            (len(layer_range), len(head_range), self.num_packed), dtype=self.dtype
+        )
+        buffer = data.view(torch.uint8).numpy().reshape(len(layer_range), -1)
+
+        with open(self.path, "rb") as fp:
+            for i, layer in enumerate(layer_range):
+                fp.seek(
+                    self.metadata["layer_offsets"][layer]
+                    + head_range.start * head_nbytes
+                )
+                fp.readinto(buffer[i])
+
+        return PackedAttention(data, self.row_offsets)
+
+    def map(self) -> PackedAttention:
+        """
+        Memory-maps the attention buffer of the store. Values are only read from disk when they are accessed.
+
+        The mapping is private (copy-on-write): modifying the returned values never modifies the file.
+
+        Returns:
+            the packed attention matrix, backed by the file
+        """
+        if self._mmap is None:
+            with open(self.path, "rb") as fp:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        data = torch.frombuffer(
+            self._mmap,
+            dtype=torch.uint8,
+            count=self.num_layers * self.num_heads * self.num_packed * self.itemsize,
+            offset=self.metadata["data_offset"],
+        )
+
+        return PackedAttention(
+            data.view(self.dtype).view(self.num_layers, self.num_heads, -1),
+            self.row_offsets,
+        )
+
+    def evict(self, layers: slice = slice(None)) -> None:
+        """
+        Drops the memory-mapped pages of a range of layers from memory. They are read from disk again if accessed.
+
+        Args:
+            layers: the range of layers to evict
+        """
+        if self._mmap is None or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+
+        layer_range = range(self.num_layers)[layers]
+        if len(layer_range) == 0:
+            return
+
+        start = self.metadata["layer_offsets"][layer_range.start]
+        end = self.metadata["layer_offsets"][layer_range[-1]] + (
+            self.num_heads * self.num_packed * self.itemsize
+        )
+
+        # madvise requires page-aligned addresses
+        start -= start % mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionStore`
+        """
+        return f"AttentionStore ({self.path}: {self.num_heads} head(s), {self.num_layers} layer(s), {len(self.tokens)} token(s))"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionStore`
+        """
+        return self.__repr__()
+
+
+class AttentionStoreWriter:
+    """
+    Writes an `AttentionStore` incrementally, one response token at a time.
+
+    The attention buffer is preallocated in the file (sparsely, on most file systems) for `capacity` values per head,
+    and memory-mapped: appended rows go straight to the page cache instead of accumulating in memory.
+    When closing, the buffer is compacted to the values actually written, and the metadata is appended.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        num_layers: int,
+        num_heads: int,
+        capacity: int,
+        dtype: torch.dtype,
+    ):
+        """
+        `AttentionStoreWriter` constructor. Creates (or overwrites) the store file.
+
+        Args:
+            path: the path of the store file
+
+            num_layers: the number of layers of the attention matrix
+
+            num_heads: the number of heads of the attention matrix
+
+            capacity: the maximum number of attention values per head, i.e. the sum of the lengths of all rows
+
+            dtype: the dtype of the stored attention values
+        """
+        self.path = path
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.capacity = capacity
+        self.dtype = dtype
+        self.itemsize = torch.empty((), dtype=dtype).element_size()
+        self.row_offsets = [0]
+
+        with open(path, "wb+") as fp:
+            fp.write(AttentionStore.MAGIC.ljust(AttentionStore.DATA_OFFSET, b"\0"))
+            fp.truncate(
+                AttentionStore.DATA_OFFSET
+                + num_layers * num_heads * capacity * self.itemsize
+            )
+            self._mmap = mmap.mmap(fp.fileno(), 0)
+
+        self._buffer = (
+            torch.frombuffer(
+                self._mmap,
+                dtype=torch.uint8,
+                count=num_layers * num_heads * capacity * self.itemsize,
+                offset=AttentionStore.DATA_OFFSET,
+            )
+            .view(dtype)
+            .view(num_layers, num_heads, capacity)
+        )
+
+    def append(self, rows: torch.Tensor) -> None:
+        """
+        Appends the attention rows of one response token, converting them to the store's dtype.
+
+        Args:
+            rows: the attention rows of the response token, of shape `num_layers x num_heads x seq_len` (on any device)
+        """
+        start = self.row_offsets[-1]
+        end = start + rows.shape[-1]
+        assert end <= self.capacity, "The store's capacity has been exceeded"
+
+        self._buffer[:, :, start:end].copy_(rows)
+        self.row_offsets.append(end)
+
+    def truncate(self, num_rows: int) -> None:
+        """
+        Discards the rows appended after the first `num_rows` ones, e.g. those of steps generated after the end of sequence.
+
+        Args:
+            num_rows: the number of rows to keep
+        """
+        del self.row_offsets[num_rows + 1 :]
+
+    def close(
+        self,
+        tokens: list[str],
+        prompt_length: int,
+        model_name: str | None = None,
+        layer_indices: list[int] | None = None,
+        head_indices: list[int] | None = None,
+    ) -> AttentionStore:
+        """
+        Compacts the attention buffer, writes the metadata and closes the store file.
+
+        Args:
+            tokens: the list of tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+            model_name: the name or directory of the model that generated the completion (default `None`)
+
+            layer_indices: the model indices of the written layers (default `None`, i.e. all layers)
+
+            head_indices: the model indices of the written heads (default `None`, i.e. all heads)
+
+        Returns:
+            the written `AttentionStore`
+        """
+        num_packed = self.row_offsets[-1]
+
+        # Move every head's values right after the previous head's (destinations never come after sources)
+        flat = self._buffer.view(-1)
+        for i in range(1, self.num_layers * self.num_heads):
+            src = i * self.capacity
+            flat[i * num_packed : (i + 1) * num_packed] = flat[
+                src : src + num_packed
+            ].clone()
+
+        # No tensor may reference the mapping once it is closed
+        del flat
+        self._buffer = None
+        self._mmap.flush()
+        self._mmap.close()
+
+        with open(self.path, "r+b") as fp:
+            fp.truncate(
+                AttentionStore.DATA_OFFSET
+                + self.num_layers * self.num_heads * num_packed * self.itemsize
+            )
+            fp.seek(0, os.SEEK_END)
+
+            AttentionStore._write_metadata(
+                fp,
+                shape=[self.num_layers, self.num_heads, num_packed],
+                dtype=self.dtype,
+                row_offsets=self.row_offsets,
+                tokens=tokens,
+                prompt_length=prompt_length,
+                model_name=model_name,
+                layer_indices=layer_indices,
+                head_indices=head_indices,
+            )
+
+        return AttentionStore(self.path)
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionStoreWriter`
+        """
+        return f"AttentionStoreWriter ({self.path}: {len(self.row_offsets) - 1} row(s) written)"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionStoreWriter`
+        """
+        return self.__repr__()
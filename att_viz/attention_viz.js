@@ -96,7 +96,7 @@ requirejs(['jquery', 'd3'], function ($, d3) {
 
     initializeConfig();
 
-    renderVisualization();
+    showLayer();
 
     /**
      * Initializes the global variable config, as well as the HTML file.
@@ -107,12 +107,22 @@ requirejs(['jquery', 'd3'], function ($, d3) {
         config.attention = params['attention'];
         config.rootDivId = params['root_div_id'];
         config.nLayers = config.attention['num_layers'];
+
+        // With a single-page viewer, each layer is only decoded (or loaded) when it is selected: see `loadLayer`
+        const attn = config.attention['attn'];
+        config.layerSources = (attn && attn.encoding === 'layers') ? attn.layers : null;
+        config.layerLoads = new Array(config.nLayers);
+        config.attention.attn = config.layerSources ? new Array(config.nLayers) : decodeAttention(attn);
+
         config.nHeads = config.attention['num_heads'];
         config.layers = [...Array(config.nLayers).keys()]; // equivalent to range(nLayers); see https://stackoverflow.com/a/10050831
 
         config.totalDy = config.attention['dy_total'];
         config.tokenInfo = config.attention['pos']
 
+        // Whether the token layout was computed with font metrics, in which case tokens are not measured
+        config.posFinal = config.attention['pos_final'] || false;
+
         config.layerSeq = 0
 
         config.layer = config.layers[config.layerSeq]
@@ -120,15 +130,22 @@ requirejs(['jquery', 'd3'], function ($, d3) {
         config.headStartIdx = config.attention['head_start_idx']
         config.layerIdx = config.attention['layer_idx']
 
+        // Rendering backend: 'svg' (one element per token) or 'canvas' (for long texts)
+        config.backend = params['backend'] || 'svg';
+
         // Mark the first head as selected / the default view
         config.headVis = new Array(config.nHeads).fill(false);
         config.headVis[config.head] = true;
 
+        // Model indices of the rendered layers and heads (these differ from positions when only some were captured)
+        config.layerIndices = config.attention['layer_indices'] || config.layers;
+        config.headIndices = config.attention['head_indices'] || config.headVis.map((_, i) => i + config.headStartIdx);
+
         // Build the layer selector + install change listener
         if (config.nLayers > 1) {
             let layerEl = $(`#${config.rootDivId} #layer`);
             for (const layer of config.layers) {
-                layerEl.append($("<option />").val(layer).text(layer));
+                layerEl.append($("<option />").val(layer).text(config.layerIndices[layer]));
             }
             layerEl.val(config.layer).change();
 
@@ -137,7 +154,7 @@ requirejs(['jquery', 'd3'], function ($, d3) {
             layerEl.on('change', function (e) {
                 config.layer = +e.currentTarget.value;
                 config.layerSeq = config.layers.findIndex(layer => config.layer === layer);
-                renderVisualization();
+                showLayer();
             });
         } else {
             let layerEl = $(`#${config.rootDivId} #layer`);
@@ -145,6 +162,70 @@ requirejs(['jquery', 'd3'], function ($, d3) {
         }
     }
 
+    /**
+     * Renders the visualization of the current layer, once its attention has been loaded.
+     */
+    function showLayer() {
+        const layer = config.layer;
+        loadLayer(layer).then(() => {
+            if (config.layer === layer) // Another layer may have been selected in the meantime
+                renderVisualization();
+        }, err => console.error(err));
+    }
+
+    /**
+     * Loads and decodes the attention of a layer of a single-page viewer, at most once.
+     * 
+     * @param {number} layer the position of the layer
+     * @returns a promise resolved once `config.attention.attn[layer]` is available
+     */
+    function loadLayer(layer) {
+        if (config.layerSources === null || config.attention.attn[layer] !== undefined)
+            return Promise.resolve();
+
+        if (config.layerLoads[layer] === undefined) {
+            config.layerLoads[layer] = fetchLayer(config.layerSources[layer]).then(payload => {
+                config.attention.attn[layer] = decodeAttention(payload)[0];
+            });
+        }
+        return config.layerLoads[layer];
+    }
+
+    /**
+     * Reads the attention payload of a layer: a gzip-compressed blob embedded in the page, a sidecar file,
+     * or a slice served by `att_viz serve`.
+     * 
+     * @param {*} source the source of the layer: `{gzip: <base64>}`, `{src: <path>, key: <key>}` or `{url: <url>}`
+     * @returns a promise of the attention payload of the layer (see `decodeAttention`)
+     */
+    function fetchLayer(source) {
+        if (source.url !== undefined)
+            return fetch(source.url).then(response => {
+                if (!response.ok)
+                    throw new Error(`Could not load ${source.url}: ${response.status}`);
+                return response.arrayBuffer();
+            }).then(readSlice);
+
+        if (source.gzip !== undefined) {
+            const stream = new Blob([base64ToBytes(source.gzip)]).stream().pipeThrough(new DecompressionStream('gzip'));
+            return new Response(stream).text().then(JSON.parse);
+        }
+
+        // Sidecar files are classic scripts rather than fetch requests, so that the page can be opened from file://
+        return new Promise((resolve, reject) => {
+            const script = document.createElement('script');
+            script.src = source.src;
+            script.onload = () => {
+                const payload = window.attVizLayers[source.key];
+                delete window.attVizLayers[source.key];
+                script.remove();
+                resolve(payload);
+            };
+            script.onerror = () => reject(new Error(`Could not load ${source.src}`));
+            document.head.appendChild(script);
+        });
+    }
+
     /**
      * Renders the HTML visualization.
      * 
@@ -181,6 +262,12 @@ requirejs(['jquery', 'd3'], function ($, d3) {
         // Determine size of the new visualization (TODO this is always the same, can save it as a constant somewhere)
         const height = MATRIX_WIDTH + 2*(config.totalDy + BOXHEIGHT) + TEXT_TOP;
         const width = LINE_WIDTH + 20;
+
+        if (config.backend === 'canvas') {
+            renderCanvas(width, height, tokens, layerAttention, promptLength);
+            return;
+        }
+
         const svg = d3.select(`#${config.rootDivId} #vis`)
             .append('svg')
             .attr("width", width + "px")
@@ -191,7 +278,7 @@ requirejs(['jquery', 'd3'], function ($, d3) {
         renderText(svg, tokens, false, layerAttention, promptLength, config.tokenInfo.map(x => [x[0], x[1] + MATRIX_WIDTH + config.totalDy, x[2], x[3]])); // Observer view
 
         if (config.nHeads > 1)
-            drawCheckboxes(0, svg, config.headStartIdx);
+            drawCheckboxes(0, svg, config.headIndices);
 
         svg.select("#attention").attr("visibility", "hidden");
     }
@@ -233,13 +320,19 @@ requirejs(['jquery', 'd3'], function ($, d3) {
             .attr("font-weight", (_, i) => ((i < promptLength) ? "bold" : "normal"))
             .style("cursor", "default")
             .style("-webkit-user-select", "none")
-            .attr("y", (_, i) => tokenInfo[i][1])
-            .each(function(_, i) {
+            .attr("y", (_, i) => tokenInfo[i][1]);
+
+        if (config.posFinal) {
+            // The layout is final: no token is measured, which would force a layout of the page per token
+            tokenInfo.forEach((info, i) => { textWidth[i] = info[2]; });
+        } else {
+            textEl.each(function(_, i) {
                 textWidth[i] = 0.3*(0.25 + tokenInfo[i][3])*TEXT_SIZE + this.getComputedTextLength();
                 if (i != 0 && tokenInfo[i-1][1] == tokenInfo[i][1]) {
                     tokenInfo[i][0] = tokenInfo[i-1][0] + textWidth[i-1];
                 }
             });
+        }
 
         textEl.style("text-anchor", "start")
             .attr("dx", (_, i) => +0.3*(0.25+tokenInfo[i][3])*TEXT_SIZE)
@@ -262,11 +355,11 @@ requirejs(['jquery', 'd3'], function ($, d3) {
                             return 1.0
                         } else if (isObserved) {
                             if (i >= promptLength && index <= i) { // Can only be observed by i if : index <= i >= prompt length
-                                return attention[config.head][i - promptLength][index];
+                                return attentionAt(attention[config.head][i - promptLength], index);
                             }
                         } else if (index >= promptLength) { // is an observer => can only observe if index >= prompt length
                             if (i <= index) // Highlight only items with smaller indices than index
-                                return attention[config.head][index - promptLength][i];
+                                return attentionAt(attention[config.head][index - promptLength], i);
                         }
 
                         return 0;
@@ -301,9 +394,9 @@ requirejs(['jquery', 'd3'], function ($, d3) {
      * 
      * @param {*} top the y-coordinate where the boxes should be rendered
      * @param {*} svg the svg object in which to render the selection boxes
-     * @param {*} head_start_idx the starting head index (useful for chunking)
+     * @param {*} headIndices the model indices of the rendered heads (useful for chunking and head selection)
      */
-    function drawCheckboxes(top, svg, head_start_idx) {
+    function drawCheckboxes(top, svg, headIndices) {
         const checkboxContainer = svg.append("g");
 
         const headContainer = checkboxContainer.append("g").selectAll("g")
@@ -319,7 +412,7 @@ requirejs(['jquery', 'd3'], function ($, d3) {
             .attr("fill", (_, i) => headColours(i));
             
         const textEl = headContainer.append("text")
-            .text((_, i) => i + head_start_idx)
+            .text((_, i) => headIndices[i])
             .attr("font-size", 0.8*TEXT_SIZE + "px")
             .style("cursor", "default")
             .style("-webkit-user-select", "none")
@@ -365,6 +458,427 @@ requirejs(['jquery', 'd3'], function ($, d3) {
         });
 }
 
+    /**
+     * Renders the visualization in two stacked canvases, for long texts: a static layer with the tokens
+     * and head selection boxes, and a highlight layer which is redrawn in one pass on hover.
+     * 
+     * The two views, the hover and double-click (freeze) behaviour, and the head selection boxes
+     * are the same as in the SVG visualization (see `renderText` and `drawCheckboxes`).
+     * 
+     * @param {number} width the width of the visualization
+     * @param {number} height the height of the visualization
+     * @param {*} tokens the prompt + completion tokens to render
+     * @param {*} attention the self-attention matrix of the current layer
+     * @param {number} promptLength the length of the prompt (in tokens)
+     */
+    function renderCanvas(width, height, tokens, attention, promptLength) {
+        const container = $('<div></div>').css({position: 'relative', width: width + 'px', height: height + 'px'});
+        $(`#${config.rootDivId} #vis`).append(container);
+
+        const ratio = window.devicePixelRatio || 1;
+        const makeLayer = () => {
+            const canvas = $('<canvas></canvas>')
+                .attr({width: Math.round(width * ratio), height: Math.round(height * ratio)})
+                .css({position: 'absolute', left: 0, top: 0, width: width + 'px', height: height + 'px'});
+            container.append(canvas);
+            const ctx = canvas[0].getContext('2d');
+            ctx.scale(ratio, ratio);
+            return [canvas, ctx];
+        };
+        const [, highlightCtx] = makeLayer();
+        const [textCanvas, textCtx] = makeLayer();
+
+        const layout = canvasLayout(textCtx, tokens, promptLength);
+        const offsets = [0, MATRIX_WIDTH + config.totalDy]; // Observed view, observer view
+        const findToken = offsets.map(dy => lineIndex(layout, dy));
+
+        // Static layer: the tokens of both views, and the head selection boxes
+        textCtx.textBaseline = 'alphabetic';
+        for (const dy of offsets) {
+            layout.forEach((box, i) => {
+                textCtx.font = canvasFont(TEXT_SIZE, i < promptLength);
+                textCtx.fillStyle = 'black';
+                textCtx.fillText(box.text, box.x + box.dx, box.y + dy + TEXT_SIZE);
+            });
+        }
+        if (config.nHeads > 1)
+            drawCanvasCheckboxes(textCtx, 0);
+
+        // Hovered token of each view (null if none), and whether each view is frozen
+        const hovered = [null, null];
+        const frozen = () => [clickObservedView, clickObserverView];
+
+        function drawHighlights() {
+            highlightCtx.clearRect(0, 0, width, height);
+            const colour = headColours(config.head);
+
+            hovered.forEach((index, view) => {
+                if (index === null)
+                    return;
+
+                const dy = offsets[view];
+                const highlight = (i, opacity) => {
+                    if (i !== index && opacity > 0) {
+                        highlightCtx.globalAlpha = Math.min(opacity, 1);
+                        highlightCtx.fillStyle = colour;
+                        highlightCtx.fillRect(layout[i].x, layout[i].y + dy, layout[i].width, BOXHEIGHT);
+                    }
+                };
+
+                if (view === 0) {
+                    // Can only be observed by i if : index <= i >= prompt length
+                    for (let i = Math.max(index, promptLength); i < layout.length; i++)
+                        highlight(i, attentionAt(attention[config.head][i - promptLength], index));
+                } else if (index >= promptLength) {
+                    // is an observer => can only observe if index >= prompt length; only non-zero values are drawn
+                    forEachAttention(attention[config.head][index - promptLength], (i, opacity) => {
+                        if (i <= index)
+                            highlight(i, opacity);
+                    });
+                }
+
+                const box = layout[index];
+                highlightCtx.globalAlpha = 1;
+                highlightCtx.fillStyle = 'lightgray';
+                highlightCtx.fillRect(box.x, box.y + dy, box.width, BOXHEIGHT);
+            });
+            highlightCtx.globalAlpha = 1;
+        }
+
+        function pointer(event) {
+            const rect = textCanvas[0].getBoundingClientRect();
+            return [event.clientX - rect.left, event.clientY - rect.top];
+        }
+
+        textCanvas.on('mousemove', function (event) {
+            const [x, y] = pointer(event);
+            let changed = false;
+            findToken.forEach((find, view) => {
+                if (frozen()[view])
+                    return;
+                const token = find(x, y);
+                if (token !== hovered[view]) {
+                    hovered[view] = token;
+                    changed = true;
+                }
+            });
+            if (changed)
+                drawHighlights();
+        });
+
+        textCanvas.on('mouseleave', function () {
+            hovered.forEach((_, view) => {
+                if (!frozen()[view])
+                    hovered[view] = null;
+            });
+            drawHighlights();
+        });
+
+        textCanvas.on('dblclick', function (event) {
+            const [x, y] = pointer(event);
+
+            // Head selection boxes: one (and only one) head is selected at all times
+            if (config.nHeads > 1 && y >= 0 && y < CHECKBOX_SIZE && x >= 0 && x < config.nHeads * CHECKBOX_SIZE) {
+                const i = Math.floor(x / CHECKBOX_SIZE);
+                if (!config.headVis[i] && activeHeads() === 1) {
+                    config.headVis = new Array(config.nHeads).fill(false);
+                    config.headVis[i] = true;
+                    config.head = i;
+
+                    clickObservedView = false;
+                    clickObserverView = false;
+                    hovered.fill(null);
+                }
+                textCtx.clearRect(0, 0, width, CHECKBOX_SIZE);
+                drawCanvasCheckboxes(textCtx, 0);
+                drawHighlights();
+                return;
+            }
+
+            // Double clicks on a token toggle the frozen state of its view
+            if (findToken[0](x, y) !== null)
+                clickObservedView = !clickObservedView;
+            else if (findToken[1](x, y) !== null)
+                clickObserverView = !clickObserverView;
+        });
+    }
+
+    /**
+     * Returns the canvas font of a token.
+     * 
+     * @param {number} size the font size
+     * @param {boolean} bold whether the font is bold (prompt tokens)
+     * @returns the CSS font string
+     */
+    function canvasFont(size, bold) {
+        return `${bold ? 'bold' : 'normal'} ${size}px 'Helvetica Neue', Helvetica, Arial, sans-serif`;
+    }
+
+    /**
+     * Computes the boxes of the tokens, measuring them with the canvas (no layout reflow) unless the layout is final, following the same
+     * rules as the SVG visualization: boxes on the same line are placed one after the other.
+     * 
+     * @param {*} ctx the canvas context used to measure text
+     * @param {*} tokens the prompt + completion tokens
+     * @param {number} promptLength the length of the prompt (in tokens)
+     * @returns the box of each token: its text, position, width and text offset
+     */
+    function canvasLayout(ctx, tokens, promptLength) {
+        const widths = new Map(); // Measurements are cached: tokens repeat a lot
+        const boxes = [];
+
+        tokens.forEach((token, i) => {
+            // SVG collapses white space, and trims the text of each token
+            const text = token.replace(/[\n\r]/g, '').replace(/\t/g, ' ').replace(/ +/g, ' ').trim();
+            const bold = i < promptLength;
+            const info = config.tokenInfo[i];
+            const dx = 0.3*(0.25 + info[3])*TEXT_SIZE;
+
+            if (config.posFinal) { // The layout is final: tokens are not measured
+                boxes.push({text: text, x: info[0], y: info[1], dx: dx, width: info[2]});
+                return;
+            }
+
+            const key = (bold ? 'b' : 'n') + text;
+            if (!widths.has(key)) {
+                ctx.font = canvasFont(TEXT_SIZE, bold);
+                widths.set(key, ctx.measureText(text).width);
+            }
+
+            const box = {text: text, x: info[0], y: info[1], dx: dx, width: dx + widths.get(key)};
+
+            if (i != 0 && boxes[i-1].y == box.y)
+                box.x = boxes[i-1].x + boxes[i-1].width;
+
+            boxes.push(box);
+        });
+
+        return boxes;
+    }
+
+    /**
+     * Builds a spatial index over the token boxes of a view, for hit-testing: boxes are grouped by line,
+     * and both lines and boxes within a line are found by binary search.
+     * 
+     * @param {*} boxes the token boxes (see `canvasLayout`), in reading order
+     * @param {number} dy the vertical offset of the view
+     * @returns a function returning the index of the token at a position (x, y), or null if there is none
+     */
+    function lineIndex(boxes, dy) {
+        const lines = []; // [y, first token, last token + 1], by increasing y
+        boxes.forEach((box, i) => {
+            const line = lines[lines.length - 1];
+            if (line && line[0] === box.y)
+                line[2] = i + 1;
+            else
+                lines.push([box.y, i, i + 1]);
+        });
+
+        // Returns the last index in [lo, hi] for which `isBefore` holds, or -1
+        function lastBefore(lo, hi, isBefore) {
+            let found = -1;
+            while (lo <= hi) {
+                const mid = (lo + hi) >> 1;
+                if (isBefore(mid)) {
+                    found = mid;
+                    lo = mid + 1;
+                } else {
+                    hi = mid - 1;
+                }
+            }
+            return found;
+        }
+
+        return function (x, y) {
+            y -= dy;
+
+            const line = lastBefore(0, lines.length - 1, l => lines[l][0] <= y);
+            if (line < 0 || y >= lines[line][0] + BOXHEIGHT)
+                return null;
+
+            const token = lastBefore(lines[line][1], lines[line][2] - 1, t => boxes[t].x <= x);
+            if (token < 0 || x >= boxes[token].x + boxes[token].width)
+                return null;
+
+            return token;
+        };
+    }
+
+    /**
+     * Draws the attention-head selection boxes in a canvas (see `drawCheckboxes`).
+     * 
+     * @param {*} ctx the canvas context
+     * @param {number} top the y-coordinate where the boxes should be rendered
+     */
+    function drawCanvasCheckboxes(ctx, top) {
+        config.headVis.forEach((visible, i) => {
+            ctx.fillStyle = visible ? headColours(i) : lighten(headColours(i)).toString();
+            ctx.fillRect(i * CHECKBOX_SIZE, top, CHECKBOX_SIZE, CHECKBOX_SIZE);
+
+            ctx.font = canvasFont(0.8*TEXT_SIZE, false);
+            ctx.fillStyle = 'black';
+            ctx.fillText(config.headIndices[i], i * CHECKBOX_SIZE + 0.1*TEXT_SIZE, top + TEXT_SIZE);
+        });
+    }
+
+    /**
+     * Decodes a binary attention payload (see `AttentionEncoding`) into nested arrays of per-row `Float32Array` views,
+     * indexed like the JSON payload: `attn[layer][head][token]`.
+     * 
+     * JSON-encoded attention (nested arrays) is returned unchanged. Sparse rows are `{indices, values}` views of their
+     * non-zero values instead: read rows with `attentionAt` and `forEachAttention`.
+     * 
+     * @param {*} attn the attention payload
+     * @returns the attention matrix, as `layer x head x token` nested arrays
+     */
+    function decodeAttention(attn) {
+        if (Array.isArray(attn))
+            return attn;
+
+        const [nLayers, nHeads] = attn.shape;
+        const offsets = attn.row_offsets;
+        const nRows = offsets.length - 1;
+        const nPacked = offsets[nRows];
+        const bytes = (typeof attn.data === 'string') ? base64ToBytes(attn.data) : attn.data; // Served slices are raw bytes
+
+        let values;
+        if (attn.encoding === 'float16') {
+            values = halfToFloat(new Uint16Array(bytes.buffer));
+        } else if (attn.encoding === 'uint8') {
+            // One scale per row of every head
+            const scales = new Float32Array(base64ToBytes(attn.scales).buffer);
+            values = new Float32Array(bytes.length);
+            for (let m = 0; m < nLayers * nHeads; m++) {
+                for (let t = 0; t < nRows; t++) {
+                    const scale = scales[m * nRows + t];
+                    for (let k = m * nPacked + offsets[t]; k < m * nPacked + offsets[t + 1]; k++)
+                        values[k] = bytes[k] * scale;
+                }
+            }
+        } else if (attn.encoding === 'sparse') {
+            // Only non-zero values are stored, grouped by row, with their column indices
+            const counts = new Int32Array(base64ToBytes(attn.counts).buffer);
+            const indexBytes = base64ToBytes(attn.indices).buffer;
+            const indices = attn.index_bytes === 2 ? new Int16Array(indexBytes) : new Int32Array(indexBytes);
+            const nonzero = halfToFloat(new Uint16Array(bytes.buffer));
+
+            // Rows are not expanded to dense arrays: each row keeps views of its column indices and values,
+            // so that memory and highlighting are proportional to the number of kept values (see `attentionAt`)
+            let k = 0, row = 0;
+            return Array.from({length: nLayers}, () =>
+                Array.from({length: nHeads}, () =>
+                    Array.from({length: nRows}, () => {
+                        const start = k;
+                        k += counts[row++];
+                        return {indices: indices.subarray(start, k), values: nonzero.subarray(start, k)};
+                    })
+                )
+            );
+        } else {
+            throw new Error(`Unknown attention encoding: ${attn.encoding}`);
+        }
+
+        return Array.from({length: nLayers}, (_, l) =>
+            Array.from({length: nHeads}, (_, h) => {
+                const base = (l * nHeads + h) * nPacked;
+                return Array.from({length: nRows}, (_, t) => values.subarray(base + offsets[t], base + offsets[t + 1]));
+            })
+        );
+    }
+
+    /**
+     * Returns the attention value of a column of a row, dense or sparse (see `decodeAttention`).
+     * 
+     * @param {*} row the attention row
+     * @param {number} column the column
+     * @returns the attention value, 0 for a column which is not stored in a sparse row
+     */
+    function attentionAt(row, column) {
+        if (row.indices === undefined)
+            return row[column];
+
+        // The column indices of a sparse row are sorted
+        let lo = 0, hi = row.indices.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (row.indices[mid] < column)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        return (lo < row.indices.length && row.indices[lo] === column) ? row.values[lo] : 0;
+    }
+
+    /**
+     * Calls a function with the column and value of every non-zero attention value of a row, dense or sparse
+     * (see `decodeAttention`). Sparse rows are only iterated over their stored values.
+     * 
+     * @param {*} row the attention row
+     * @param {function(number, number)} callback the function called with each column and value
+     */
+    function forEachAttention(row, callback) {
+        if (row.indices === undefined) {
+            for (let column = 0; column < row.length; column++)
+                if (row[column] !== 0)
+                    callback(column, row[column]);
+        } else {
+            for (let k = 0; k < row.indices.length; k++)
+                callback(row.indices[k], row.values[k]);
+        }
+    }
+
+    /**
+     * Reads a binary attention slice served by `att_viz serve`: the length of a JSON header (4-byte little-endian
+     * unsigned integer), the header (shape, row offsets and encoding), then the float16 values.
+     * 
+     * @param {ArrayBuffer} buffer the body of the response
+     * @returns the attention payload of the slice (see `decodeAttention`)
+     */
+    function readSlice(buffer) {
+        const headerLength = new DataView(buffer).getUint32(0, true);
+        const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+        header.data = new Uint8Array(buffer.slice(4 + headerLength)); // A copy, aligned for the float16 view
+        return header;
+    }
+
+    /**
+     * Decodes a base64 string into bytes.
+     * 
+     * @param {string} data the base64 string
+     * @returns the decoded bytes, in a new buffer
+     */
+    function base64ToBytes(data) {
+        const binary = atob(data);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++)
+            bytes[i] = binary.charCodeAt(i);
+        return bytes;
+    }
+
+    /**
+     * Converts half-precision floats to single-precision floats.
+     * 
+     * @param {Uint16Array} halves the bits of the half-precision floats
+     * @returns the corresponding `Float32Array`
+     */
+    function halfToFloat(halves) {
+        const values = new Float32Array(halves.length);
+        for (let i = 0; i < halves.length; i++) {
+            const h = halves[i];
+            const sign = (h & 0x8000) ? -1 : 1;
+            const exponent = (h >> 10) & 0x1f;
+            const fraction = h & 0x3ff;
+
+            if (exponent === 0)
+                values[i] = sign * fraction * 2 ** -24; // Subnormal numbers
+            else if (exponent === 31)
+                values[i] = fraction ? NaN : sign * Infinity;
+            else
+                values[i] = sign * (1 + fraction / 1024) * 2 ** (exponent - 15);
+        }
+        return values;
+    }
+
     /**
      * Returns a lighter version of the given colour.
      * 
@@ -0,0 +1,144 @@
+import json
+import os
+import re
+import unicodedata
+
+
+class FontMetrics:
+    """
+    Glyph advance widths of a font, used to lay tokens out in Python exactly as the browser would draw them.
+
+    With font metrics, `Renderer.create_token_info` computes the final position and width of every token, and the
+    visualization uses them as they are instead of measuring each token in the page (see `RenderConfig`).
+    Kerning is not taken into account.
+    """
+
+    # SVG text collapses white space: line breaks are removed, tabs become spaces, and runs of spaces are merged
+    _LINE_BREAKS = re.compile(r"[\n\r]")
+    _SPACES = re.compile(r" +")
+
+    def __init__(
+        self,
+        advances: dict[str, dict[str, float]],
+        units_per_em: float = 1000,
+        default_advance: float | None = None,
+        wide_advance: float | None = None,
+        font_size: float = 15,
+        family: str | None = None,
+    ):
+        """
+        `FontMetrics` constructor. See also `default`, for the bundled metrics of the visualization's font.
+
+        Args:
+            advances: the advance width of each character, in font units, for the `"normal"` and `"bold"` font weights
+
+            units_per_em: the number of font units per em (default `1000`)
+
+            default_advance: the advance width of characters missing from `advances` (default `None`, i.e. `units_per_em / 2`)
+
+            wide_advance: the advance width of missing East Asian wide characters (default `None`, i.e. `units_per_em`)
+
+            font_size: the font size of the visualization's tokens, in pixels (default `15`, see `TEXT_SIZE` in `attention_viz.js`)
+
+            family: the name of the font (default `None`)
+        """
+        self.advances = advances
+        self.units_per_em = units_per_em
+        self.default_advance = (
+            units_per_em / 2 if default_advance is None else default_advance
+        )
+        self.wide_advance = units_per_em if wide_advance is None else wide_advance
+        self.font_size = font_size
+        self.family = family
+
+    @classmethod
+    def default(cls, font_size: float = 15) -> "FontMetrics":
+        """
+        Loads the bundled metrics of Helvetica (which Arial, the visualization's fallback font, shares).
+
+        Args:
+            font_size: the font size of the visualization's tokens, in pixels (default `15`)
+
+        Returns:
+            the `FontMetrics` of the visualization's default font
+        """
+        with open(
+            os.path.join(
+                os.path.dirname(os.path.realpath(__file__)), "helvetica_metrics.json"
+            ),
+            mode="r",
+            encoding="UTF-8",
+        ) as fp:
+            table = json.load(fp)
+
+        return cls(
+            table["advances"],
+            units_per_em=table["units_per_em"],
+            default_advance=table["default_advance"],
+            wide_advance=table["wide_advance"],
+            font_size=font_size,
+            family=table["family"],
+        )
+
+    @classmethod
+    def displayed_text(cls, token: str) -> str:
+        """
+        Returns the text of a token as displayed by the visualization, after white space collapsing.
+
+        Args:
+            token: the token
+
+        Returns:
+            the displayed text, without leading and trailing white space
+        """
+        text = cls._LINE_BREAKS.sub("", token).replace("\t", " ")
+        return cls._SPACES.sub(" ", text).strip(" ")
+
+    def advance(self, char: str, bold: bool = False) -> float:
+        """
+        Returns the advance width of a character, in font units.
+
+        Args:
+            char: the character
+
+            bold: whether the character is drawn in bold (default `False`)
+
+        Returns:
+            the advance width of the character
+        """
+        advance = self.advances["bold" if bold else "normal"].get(char)
+        if advance is not None:
+            return advance
+
+        if unicodedata.combining(char) or unicodedata.category(char) in ("Mn", "Cf"):
+            return 0
+        if unicodedata.east_asian_width(char) in ("W", "F"):
+            return self.wide_advance
+        return self.default_advance
+
+    def text_width(self, token: str, bold: bool = False) -> float:
+        """
+        Computes the width of a token as displayed by the visualization.
+
+        Args:
+            token: the token
+
+            bold: whether the token is drawn in bold, as prompt tokens are (default `False`)
+
+        Returns:
+            the width of the displayed text, in pixels
+        """
+        units = sum(self.advance(c, bold) for c in self.displayed_text(token))
+        return units * self.font_size / self.units_per_em
+
+    def __repr__(self):
+        """
+        Debugging string representation of `FontMetrics`
+        """
+        return f"FontMetrics ({self.family}, {len(self.advances['normal'])} glyph(s), font size: {self.font_size})"
+
+    def __str__(self):
+        """
+        Regular string representation of `FontMetrics`
+        """
+        return self.__repr__()
@@ -0,0 +1,385 @@
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class StageRecord:
+    """
+    The measurements of one stage of the pipeline (see `Instrumentation`): its wall time, memory usage, the size of the
+    tensors it produced, and the size of the files it wrote.
+
+    Memory is attributed to the stage by `rss_delta_bytes` (the resident memory it kept) and `peak_rss_increase_bytes`
+    (how much it raised the peak RSS of the process). `process_peak_rss_bytes` is the peak RSS of the whole process
+    when the stage ended, including the memory of all of the previous stages.
+    """
+
+    def __init__(self, name: str, path: str, details: dict | None = None):
+        """
+        `StageRecord` constructor.
+
+        Args:
+            name: the name of the stage, e.g. `"format"`
+
+            path: the names of the enclosing stages and of this stage, separated by slashes, e.g. `"experiment/format"`
+
+            details: information about the stage, e.g. the save prefix (default `None`)
+        """
+        self.name = name
+        self.path = path
+        self.details = {} if details is None else details
+
+        self.seconds = 0.0
+        self.rss_delta_bytes: int | None = None
+        self.peak_rss_increase_bytes: int | None = None
+        self.process_peak_rss_bytes: int | None = None
+        self.python_peak_bytes: int | None = None
+        self.tensor_bytes = 0
+        self.output_bytes = 0
+        self.output_files: list[str] = []
+
+    def add_tensor(self, tensor) -> None:
+        """
+        Counts the bytes of a tensor (or of a `PackedAttention`) produced by the stage.
+
+        Args:
+            tensor: the tensor, or any object with an `nbytes` attribute
+        """
+        self.tensor_bytes += int(tensor.nbytes)
+
+    def add_output(self, path: str) -> None:
+        """
+        Counts the size of a file written by the stage.
+
+        Args:
+            path: the path of the file
+        """
+        self.output_files.append(path)
+        self.output_bytes += os.path.getsize(path)
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            the measurements, as a JSON-serializable dictionary
+        """
+        return {
+            "name": self.name,
+            "path": self.path,
+            "seconds": self.seconds,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "peak_rss_increase_bytes": self.peak_rss_increase_bytes,
+            "process_peak_rss_bytes": self.process_peak_rss_bytes,
+            "python_peak_bytes": self.python_peak_bytes,
+            "tensor_bytes": self.tensor_bytes,
+            "output_bytes": self.output_bytes,
+            "output_files": self.output_files,
+            "details": self.details,
+        }
+
+    def __repr__(self):
+        """
+        Debugging string representation of `StageRecord`
+        """
+        return f"StageRecord ({self.path}: {self.seconds:.3f}s, {self.tensor_bytes} tensor bytes, {self.output_bytes} output bytes)"
+
+    def __str__(self):
+        """
+        Regular string representation of `StageRecord`
+        """
+        return self.__repr__()
+
+
+class _DisabledStage(StageRecord):
+    """The stage yielded by `stage` when no `Instrumentation` is active: it measures nothing."""
+
+    def __init__(self):
+        super().__init__("", "")
+
+    def add_tensor(self, tensor) -> None:
+        pass
+
+    def add_output(self, path: str) -> None:
+        pass
+
+
+class Instrumentation:
+    """
+    Opt-in instrumentation of the pipeline: while an `Instrumentation` is active (in a `with` block), the stages of
+    `SelfAttentionModel.generate_text`, `AttentionMatrix.format`, `Renderer.render`, `save_completions` and
+    `process_saved_completions` are timed and measured. Every measured stage is passed to the observers as a
+    `StageRecord` when it ends, and kept for the report of the run (see `report`).
+
+    Stages run in the worker processes of `process_saved_completions` are only reported as a whole, by their save prefix.
+    """
+
+    def __init__(
+        self,
+        observers: list[Callable[[StageRecord], None]] | None = None,
+        trace_memory: bool = False,
+    ):
+        """
+        `Instrumentation` constructor.
+
+        Args:
+            observers: functions called with the `StageRecord` of every stage, when it ends (default `None`)
+
+            trace_memory: whether to trace the peak memory allocated by Python objects in every stage with `tracemalloc`,
+                which slows the pipeline down. Tensor memory is not traced: see the RSS of the stages (default `False`)
+        """
+        self.observers = [] if observers is None else list(observers)
+        self.trace_memory = trace_memory
+        self.records: list[StageRecord] = []
+
+        self._stack: list[StageRecord] = []
+        self._child_peaks: list[int] = []
+        self._started_tracing = False
+        self._previous = None
+
+    def add_observer(self, observer: Callable[[StageRecord], None]) -> None:
+        """
+        Adds an observer, called with the `StageRecord` of every stage when it ends.
+
+        Args:
+            observer: the observer
+        """
+        self.observers.append(observer)
+
+    def __enter__(self) -> "Instrumentation":
+        global _active
+        self._previous, _active = _active, self
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active
+        _active = self._previous
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str, **details) -> Iterator[StageRecord]:
+        """
+        Measures a stage. See `stage`.
+        """
+        record = StageRecord(
+            name, "/".join([r.name for r in self._stack] + [name]), details
+        )
+        tracing = tracemalloc.is_tracing() and self.trace_memory
+
+        if tracing:
+            # The peak of the enclosing stage so far must survive the reset
+            self._fold_peak(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(record)
+        self._child_peaks.append(0)
+        rss_before, peak_rss_before = _current_rss(), _peak_rss()
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            self._stack.pop()
+            child_peak = self._child_peaks.pop()
+
+            if tracing:
+                record.python_peak_bytes = max(
+                    child_peak, tracemalloc.get_traced_memory()[1]
+                )
+                self._fold_peak(record.python_peak_bytes)
+                tracemalloc.reset_peak()
+            rss_after, record.process_peak_rss_bytes = _current_rss(), _peak_rss()
+            if rss_before is not None and rss_after is not None:
+                record.rss_delta_bytes = rss_after - rss_before
+            if peak_rss_before is not None:
+                record.peak_rss_increase_bytes = (
+                    record.process_peak_rss_bytes - peak_rss_before
+                )
+
+            self._add(record)
+
+    def record(self, name: str, seconds: float, **details) -> StageRecord:
+        """
+        Records a stage measured elsewhere, e.g. in a worker process.
+
+        Args:
+            name: the name of the stage
+
+            seconds: the wall time of the stage
+
+            details: information about the stage
+
+        Returns:
+            the `StageRecord` of the stage
+        """
+        record = StageRecord(
+            name, "/".join([r.name for r in self._stack] + [name]), details
+        )
+        record.seconds = seconds
+        self._add(record)
+        return record
+
+    def _fold_peak(self, peak: int) -> None:
+        """Records a traced memory peak reached inside the innermost enclosing stage."""
+        if self._child_peaks:
+            self._child_peaks[-1] = max(self._child_peaks[-1], peak)
+
+    def _add(self, record: StageRecord) -> None:
+        """Keeps a finished stage, and passes it to the observers."""
+        self.records.append(record)
+        for observer in self.observers:
+            observer(record)
+
+    def report(self) -> dict:
+        """
+        Aggregates the measurements of the run.
+
+        Returns:
+            a JSON-serializable dictionary, with the environment, every stage in the order in which it ended, and the
+            totals of the stages of each path: their count, wall time, tensor and output bytes, RSS deltas and peak RSS
+            increases, and their memory peaks
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(
+                record.path,
+                {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "tensor_bytes": 0,
+                    "output_bytes": 0,
+                    "rss_delta_bytes": None,
+                    "peak_rss_increase_bytes": None,
+                    "process_peak_rss_bytes": None,
+                    "python_peak_bytes": None,
+                },
+            )
+            total["count"] += 1
+            total["seconds"] += record.seconds
+            total["tensor_bytes"] += record.tensor_bytes
+            total["output_bytes"] += record.output_bytes
+            for delta in ("rss_delta_bytes", "peak_rss_increase_bytes"):
+                if getattr(record, delta) is not None:
+                    total[delta] = (total[delta] or 0) + getattr(record, delta)
+            for peak in ("process_peak_rss_bytes", "python_peak_bytes"):
+                values = [
+                    v for v in (total[peak], getattr(record, peak)) if v is not None
+                ]
+                total[peak] = max(values, default=None)
+
+        return {
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "pid": os.getpid(),
+            },
+            "stages": [record.to_dict() for record in self.records],
+            "totals": totals,
+        }
+
+    def save_report(self, path: str) -> None:
+        """
+        Saves the report of the run (see `report`) as a JSON file.
+
+        Args:
+            path: the path of the JSON file
+        """
+        with open(path, "w", encoding="UTF-8") as fp:
+            json.dump(self.report(), fp, indent=2)
+
+    def __repr__(self):
+        """
+        Debugging string representation of `Instrumentation`
+        """
+        return f"Instrumentation ({len(self.records)} stage(s), {len(self.observers)} observer(s), trace memory: {self.trace_memory})"
+
+    def __str__(self):
+        """
+        Regular string representation of `Instrumentation`
+        """
+        return self.__repr__()
+
+
+# The instrumentation of the current run, set while an `Instrumentation` is active
+_active: Instrumentation | None = None
+
+
+def active() -> Instrumentation | None:
+    """
+    Returns:
+        the active `Instrumentation`, or `None` if the pipeline is not instrumented
+    """
+    return _active
+
+
+@contextmanager
+def stage(name: str, **details) -> Iterator[StageRecord]:
+    """
+    Measures a stage of the pipeline, if an `Instrumentation` is active: its wall time, RSS (see `StageRecord`) and,
+    with `trace_memory`, its peak Python memory. The stage adds its tensor and output sizes to the yielded record, which
+    ignores them when the pipeline is not instrumented.
+
+    Args:
+        name: the name of the stage
+
+        details: information about the stage, e.g. the save prefix
+
+    Returns:
+        a context manager yielding the `StageRecord` of the stage
+    """
+    if _active is None:
+        yield _DisabledStage()
+        return
+
+    with _active.stage(name, **details) as record:
+        yield record
+
+
+def record(name: str, seconds: float, **details) -> None:
+    """
+    Records a stage measured elsewhere, e.g. in a worker process, if an `Instrumentation` is active.
+
+    Args:
+        name: the name of the stage
+
+        seconds: the wall time of the stage
+
+        details: information about the stage, e.g. the save prefix
+    """
+    if _active is not None:
+        _active.record(name, seconds, **details)
+
+
+def _current_rss() -> int | None:
+    """The current resident set size of this process, in bytes (`None` where it cannot be measured)."""
+    try:
+        with open("/proc/self/statm") as fp:  # Only on Linux
+            resident_pages = int(fp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _peak_rss() -> int | None:
+    """The peak resident set size of this process, in bytes (`None` where it cannot be measured)."""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports kilobytes
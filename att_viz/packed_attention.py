@@ -0,0 +1,243 @@
+import torch
+
+
+class PackedAttention:
+    """
+    Compact storage for a formatted self-attention matrix.
+
+    Response token `i` attends to a growing number of previous tokens, so the formatted attention
+    matrix is lower triangular. Instead of a ragged nested list of Python floats, all rows are packed
+    back to back in one contiguous buffer (similarly to CSR sparse matrices), and located through
+    a vector of row offsets shared by every layer and head.
+
+    The buffer has shape `num_layers x num_heads x num_packed`, where `num_packed` is the total
+    number of attention values of a single head. Indexing (`packed[layer][head][token]`) and
+    `select` return views of the same buffer: no attention values are copied.
+    """
+
+    __slots__ = ("data", "row_offsets")
+
+    def __init__(self, data: torch.Tensor, row_offsets: torch.Tensor):
+        """
+        `PackedAttention` constructor.
+
+        Args:
+            data: the packed attention buffer, of shape `... x num_packed` (usually `num_layers x num_heads x num_packed`)
+
+            row_offsets: the start of every response token row in the last dimension of `data`, followed by the
+                end of the last row (has length `num_response_tokens + 1`)
+        """
+        self.data = data
+        self.row_offsets = row_offsets
+
+    @classmethod
+    def from_generate(
+        cls,
+        attention_matrix,
+        dtype: torch.dtype | None = None,
+        layers: list[int] | None = None,
+        heads: list[int] | None = None,
+        device: torch.device | str | None = None,
+    ) -> "PackedAttention":
+        """
+        Packs the out-of-the-box attention matrix from the model's generation methods.
+
+        Only the attention row of the last query token of each step is kept: for the first response token,
+        this is the last row of the `num_prompt_tokens x num_prompt_tokens` matrix.
+
+        The rows of all steps of a layer are concatenated on the device of that layer (which differs between layers
+        when the model is spread across devices), then copied to the packed buffer in a single transfer per layer.
+
+        Args:
+            attention_matrix: out-of-the-box attention matrix from the model's generation methods
+                (`num_response_tokens x num_layers x 1 x num_heads x a x b`)
+
+            dtype: the dtype of the packed buffer (default `None`, i.e. the dtype of the model's attention)
+
+            layers: the indices of the layers to keep (default `None`, i.e. all layers)
+
+            heads: the indices of the heads to keep (default `None`, i.e. all heads)
+
+            device: the device of the packed buffer (default `None`, i.e. the device of the first kept layer)
+
+        Returns:
+            the packed attention matrix, of shape `num_layers x num_heads x num_packed`
+        """
+        layers = range(len(attention_matrix[0])) if layers is None else layers
+        head_index = slice(None) if heads is None else list(heads)
+
+        first_layer = attention_matrix[0][layers[0]]
+        num_heads = first_layer.shape[-3] if heads is None else len(heads)
+
+        lengths = torch.tensor(
+            [token_attention[0].shape[-1] for token_attention in attention_matrix]
+        )
+        row_offsets = cls.offsets_from_lengths(lengths)
+
+        data = torch.empty(
+            (len(layers), num_heads, int(row_offsets[-1])),
+            dtype=first_layer.dtype if dtype is None else dtype,
+            device=first_layer.device if device is None else device,
+        )
+
+        for i, layer in enumerate(layers):
+            data[i].copy_(
+                torch.cat(
+                    [
+                        token_attention[layer][0, head_index, -1]
+                        for token_attention in attention_matrix
+                    ],
+                    dim=-1,
+                )
+            )
+
+        return cls(data, row_offsets)
+
+    @staticmethod
+    def step_rows(
+        token_attention,
+        layers: list[int] | None = None,
+        heads: list[int] | None = None,
+        device: torch.device | None = None,
+        batch_index: int = 0,
+    ) -> torch.Tensor:
+        """
+        Stacks the attention rows of the last query token of one generation step.
+
+        Args:
+            token_attention: the attention of one generation step: one `batch_size x num_heads x a x b` tensor per layer
+
+            layers: the indices of the layers to keep (default `None`, i.e. all layers)
+
+            heads: the indices of the heads to keep (default `None`, i.e. all heads)
+
+            device: the device on which to gather the rows (default `None`, i.e. the device of the first kept layer)
+
+            batch_index: the index of the sequence in the batch (default `0`)
+
+        Returns:
+            the attention rows, of shape `num_layers x num_heads x seq_len`
+        """
+        if layers is not None:
+            token_attention = [token_attention[layer] for layer in layers]
+
+        device = token_attention[0].device if device is None else device
+        head_index = slice(None) if heads is None else list(heads)
+
+        return torch.stack(
+            [
+                layer_attention[batch_index, head_index, -1].to(device)
+                for layer_attention in token_attention
+            ]
+        )
+
+    @staticmethod
+    def offsets_from_lengths(lengths: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the row offsets of a packed buffer from its row lengths.
+
+        Args:
+            lengths: the number of attended tokens for each response token
+
+        Returns:
+            the row offsets (has length `len(lengths) + 1`)
+        """
+        row_offsets = torch.zeros(len(lengths) + 1, dtype=torch.long)
+        torch.cumsum(torch.as_tensor(lengths, dtype=torch.long), 0, out=row_offsets[1:])
+        return row_offsets
+
+    @property
+    def lengths(self) -> torch.Tensor:
+        """The number of attended tokens for each response token."""
+        return self.row_offsets[1:] - self.row_offsets[:-1]
+
+    @property
+    def num_rows(self) -> int:
+        """The number of response tokens."""
+        return len(self.row_offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the packed buffer in bytes."""
+        return self.data.numel() * self.data.element_size()
+
+    def row(self, *index) -> torch.Tensor:
+        """
+        Returns a view of one response token row.
+
+        Args:
+            index: the leading indices (e.g. layer and head), followed by the response token index
+
+        Returns:
+            the attention row of the given response token, with length `num_prompt_tokens + token`
+        """
+        *lead, token = index
+        return self.data[tuple(lead)][
+            ..., self.row_offsets[token] : self.row_offsets[token + 1]
+        ]
+
+    def select(
+        self, layers: slice = slice(None), heads: slice = slice(None)
+    ) -> "PackedAttention":
+        """
+        Returns a view of a range of layers and heads, sharing the same buffer.
+
+        Args:
+            layers: the range of layers to keep
+
+            heads: the range of heads to keep
+
+        Returns:
+            the selected `PackedAttention`
+        """
+        return PackedAttention(self.data[layers, heads], self.row_offsets)
+
+    def to(self, *args, **kwargs) -> "PackedAttention":
+        """
+        Moves and/or casts the packed buffer (see `torch.Tensor.to`).
+
+        Returns:
+            the resulting `PackedAttention`
+        """
+        return PackedAttention(self.data.to(*args, **kwargs), self.row_offsets)
+
+    def tolist(self) -> list:
+        """
+        Converts the packed buffer to the ragged nested lists expected by the visualization.
+
+        Returns:
+            nested lists of shape `... x num_response_tokens x {varying: num_tokens_before_current_one}`
+        """
+        bounds = self.row_offsets.tolist()
+        spans = list(zip(bounds[:-1], bounds[1:]))
+
+        def unpack(values):
+            if values and isinstance(values[0], list):
+                return [unpack(v) for v in values]
+            return [values[start:end] for start, end in spans]
+
+        return unpack(self.data.tolist())
+
+    def __len__(self):
+        """The size of the first dimension (the number of response tokens for a single head)."""
+        return len(self.data) if self.data.dim() > 1 else self.num_rows
+
+    def __getitem__(self, index):
+        """
+        Indexes the leading dimensions, then response tokens: `packed[layer][head][token]` is a view of a single row.
+        """
+        if self.data.dim() > 1:
+            return PackedAttention(self.data[index], self.row_offsets)
+        return self.row(index)
+
+    def __repr__(self):
+        """
+        Debugging string representation of `PackedAttention`
+        """
+        return f"PackedAttention (shape {tuple(self.data.shape[:-1])}, {self.num_rows} row(s), {self.data.dtype})"
+
+    def __str__(self):
+        """
+        Regular string representation of `PackedAttention`
+        """
+        return self.__repr__()
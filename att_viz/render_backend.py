@@ -0,0 +1,16 @@
+from enum import Enum
+
+
+class RenderBackend(Enum):
+    """
+    Represents the possible rendering backends of the HTML visualization.
+    The supported backends are:
+        - `SVG`: one SVG element per token box and text
+        - `CANVAS`: two stacked canvases, for long texts
+    """
+
+    SVG = 1
+    """ Represents the SVG backend - every token is an SVG element, laid out by the browser. Suited to short texts. """
+
+    CANVAS = 2
+    """ Represents the Canvas backend - tokens are drawn once, and highlights are redrawn in one pass on hover, with hit-testing through a spatial index. Suited to texts of thousands of tokens. """
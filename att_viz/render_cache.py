@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+from enum import Enum
+from importlib.metadata import PackageNotFoundError, version
+from .attention_aggregation_method import AttentionAggregationMethod
+from .attention_store import AttentionStore
+from .renderer import RenderConfig
+
+# The directory of the att_viz sources hashed by `RenderCache`
+_PACKAGE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+
+
+class RenderCache:
+    """
+    A manifest of the visualizations rendered from saved completions, used by `process_saved_completions` to skip the
+    completions whose visualizations are up to date.
+
+    Every save prefix is recorded with a hash of everything its visualizations depend on: the content of its store,
+    the aggregation method, `zero_first_attention`, whether tokens are prettified, the `RenderConfig`, the version of
+    att_viz, and the source code which formats and renders attention (see `FORMATTER_SOURCES` and `RENDERER_SOURCES`).
+    A completion is rendered again only if this hash has changed, or if one of its output files is missing or has
+    changed size.
+
+    With an aggregation method, the formatted attention matrix (whose collapsed dimensions make it smaller than the
+    store) is also saved, next to the store (see `FORMATTED_SUFFIX`): when only the `RenderConfig` has changed, it is
+    rendered again without being formatted again.
+
+    Store contents are hashed once; the manifest keeps their hash until their size or modification time changes.
+    """
+
+    VERSION = 1
+    """ The version of the manifest and of the rendered outputs: outputs rendered with another version are rendered again. """
+
+    FORMATTED_SUFFIX = "_formatted.attviz"
+    """ The suffix of the stores holding formatted attention matrices, after the save prefix. """
+
+    FORMATTER_SOURCES = (
+        "attention_aggregation_method.py",
+        "attention_matrix.py",
+        "attention_rollout.py",
+        "attention_store.py",
+        "packed_attention.py",
+    )
+    """ The files of att_viz which formatted attention matrices depend on: when one changes, they are formatted again. """
+
+    RENDERER_SOURCES = (
+        "attention_encoding.py",
+        "attention_viz.js",
+        "font_metrics.py",
+        "helvetica_metrics.json",
+        "render_backend.py",
+        "renderer.py",
+        "token_cache.py",
+    )
+    """ The files of att_viz which visualizations depend on: when one changes, completions are rendered again. """
+
+    def __init__(self, path: str):
+        """
+        `RenderCache` constructor. Loads the manifest, if it exists.
+
+        Args:
+            path: the path of the manifest (a JSON file)
+        """
+        self.path = path
+        self._stores: dict[str, dict] = {}
+        self._renders: dict[str, dict] = {}
+        self._pending: dict[str, dict] = {}
+        self._formatter = self._source_hash(self.FORMATTER_SOURCES)
+        self._renderer = self._renderer_version()
+
+        if os.path.exists(path):
+            with open(path, encoding="UTF-8") as fp:
+                manifest = json.load(fp)
+
+            if manifest.get("version") == self.VERSION:
+                self._stores = manifest["stores"]
+                self._renders = manifest["renders"]
+
+    def content_hash(self, path: str) -> str:
+        """
+        Hashes the content of a file, unless the manifest holds its hash for its current size and modification time.
+
+        Args:
+            path: the path of the file
+
+        Returns:
+            the SHA-256 digest of the content of the file, in hexadecimal
+        """
+        stat = os.stat(path)
+        known = self._stores.get(path)
+        if (
+            known is not None
+            and known["size"] == stat.st_size
+            and known["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return known["sha256"]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+
+        self._stores[path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest.hexdigest(),
+        }
+        return digest.hexdigest()
+
+    def lookup(
+        self,
+        save_prefix: str,
+        render_config: RenderConfig,
+        aggregation_method: AttentionAggregationMethod,
+        prettify_tokens: bool,
+        zero_first_attention: bool = True,
+    ) -> tuple[bool, str | None, bool]:
+        """
+        Checks whether the visualizations of a save prefix are up to date. If they are not, the keys of the new
+        visualizations are kept until they are recorded by `add`.
+
+        Args:
+            save_prefix: the save prefix that has been used for storing the inference results
+
+            render_config: the rendering configuration. See `RenderConfig`.
+
+            aggregation_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`
+
+            prettify_tokens: indicates whether to remove special characters in tokens, e.g. Ġ.
+
+            zero_first_attention: whether to ignore self attention values towards the first token (default `True`)
+
+        Returns:
+            whether the visualizations are up to date, the path of the formatted attention matrix (`None` without
+            aggregation), and whether the formatted attention matrix at this path is up to date
+
+        Raises:
+            OSError: if the store cannot be read
+        """
+        format_key = self._hash(
+            {
+                "version": self.VERSION,
+                "store": self.content_hash(AttentionStore.path_for(save_prefix)),
+                "aggregation_method": aggregation_method.name,
+                "zero_first_attention": zero_first_attention,
+                "formatter": self._formatter,
+            }
+        )
+        render_key = self._hash(
+            {
+                "format": format_key,
+                "prettify_tokens": prettify_tokens,
+                "render_config": render_config,
+                "renderer": self._renderer,
+            }
+        )
+
+        entry = self._renders.get(save_prefix, {})
+        if entry.get("key") == render_key and all(
+            os.path.exists(path) and os.path.getsize(path) == size
+            for path, size in entry["outputs"].items()
+        ):
+            return True, None, False
+
+        self._pending[save_prefix] = {"key": render_key, "format_key": format_key}
+        if aggregation_method == AttentionAggregationMethod.NONE:
+            return False, None, False
+
+        formatted_path = f"{save_prefix}{self.FORMATTED_SUFFIX}"
+        reuse = entry.get("format_key") == format_key and os.path.exists(formatted_path)
+        return False, formatted_path, reuse
+
+    def add(self, save_prefix: str, outputs: list[str]) -> None:
+        """
+        Records the visualizations of a save prefix, rendered after `lookup`.
+
+        Args:
+            save_prefix: the save prefix
+
+            outputs: the paths of the files written by the renderer
+        """
+        entry = self._pending.pop(save_prefix, None)
+        if (
+            entry is None
+        ):  # The save prefix was not looked up, e.g. its store was missing
+            return
+
+        entry["outputs"] = {path: os.path.getsize(path) for path in outputs}
+        self._renders[save_prefix] = entry
+
+    def discard(self, save_prefix: str) -> None:
+        """
+        Forgets the visualizations of a save prefix, e.g. after it failed to render: it will be rendered again.
+
+        Args:
+            save_prefix: the save prefix
+        """
+        self._pending.pop(save_prefix, None)
+        self._renders.pop(save_prefix, None)
+
+    def save(self) -> None:
+        """
+        Saves the manifest. The file is replaced atomically.
+        """
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as fp:
+            json.dump(
+                {
+                    "version": self.VERSION,
+                    "stores": self._stores,
+                    "renders": self._renders,
+                },
+                fp,
+            )
+
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _renderer_version() -> dict:
+        """The version of att_viz and the hash of its rendering code (see `RENDERER_SOURCES`), which both change the outputs."""
+        try:
+            package_version = version("att_viz")
+        except PackageNotFoundError:  # Not installed, e.g. run from the repository
+            package_version = None
+
+        return {
+            "att_viz": package_version,
+            "sources": RenderCache._source_hash(RenderCache.RENDERER_SOURCES),
+        }
+
+    @staticmethod
+    def _source_hash(names: tuple[str, ...]) -> str:
+        """
+        Hashes source files of att_viz, so that outputs produced by an edited or upgraded version are produced again.
+
+        Args:
+            names: the names of the files, in the att_viz package
+
+        Returns:
+            the SHA-256 digest of the names and contents of the files, in hexadecimal
+        """
+        digest = hashlib.sha256()
+        for name in names:
+            with open(os.path.join(_PACKAGE_DIRECTORY, name), "rb") as fp:
+                digest.update(name.encode("UTF-8") + b"\0" + fp.read() + b"\0")
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _hash(inputs: dict) -> str:
+        """Hashes JSON-serializable inputs, or objects whose attributes are (e.g. `RenderConfig`, `FontMetrics`)."""
+
+        def default(obj):
+            if isinstance(obj, Enum):
+                return obj.name
+            return vars(obj)
+
+        data = json.dumps(inputs, sort_keys=True, default=default)
+        return hashlib.sha256(data.encode("UTF-8")).hexdigest()
+
+    def __len__(self) -> int:
+        """The number of save prefixes recorded in the manifest."""
+        return len(self._renders)
+
+    def __repr__(self):
+        """
+        Debugging string representation of `RenderCache`
+        """
+        return f"RenderCache ({self.path}: {len(self._renders)} save prefix(es), {len(self._stores)} store(s))"
+
+    def __str__(self):
+        """
+        Regular string representation of `RenderCache`
+        """
+        return self.__repr__()
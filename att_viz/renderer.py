@@ -1,10 +1,26 @@
+import base64
+import bisect
+import gzip
+import html
+import io
+import itertools
 import math
 import os
 import uuid
 import json
-from IPython.display import HTML, Javascript
+import torch
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, TextIO
+from IPython.display import HTML
 from .attention_matrix import AttentionMatrix
+from .packed_attention import PackedAttention
 from .attention_aggregation_method import AttentionAggregationMethod
+from .attention_encoding import AttentionEncoding
+from .font_metrics import FontMetrics
+from .instrumentation import stage
+from .render_backend import RenderBackend
+from .token_cache import TokenCache
 
 
 class RenderConfig:
@@ -22,6 +38,10 @@ class RenderConfig:
         token_height: float = 22.5,
         x_margin: float = 20,
         matrix_width: float = 115,
+        attention_encoding: AttentionEncoding = AttentionEncoding.JSON,
+        shared_assets: bool = False,
+        backend: RenderBackend = RenderBackend.SVG,
+        font_metrics: FontMetrics | None = None,
     ):
         """
         `RenderConfig` constructor.
@@ -42,6 +62,17 @@ class RenderConfig:
             x_margin: the margin on the x-axis of the HTML render.
 
             matrix_width: the space between the two attention rendition modes
+
+            attention_encoding: the encoding of the attention matrix in the HTML files. See `AttentionEncoding` (default `AttentionEncoding.JSON`)
+
+            shared_assets: indicates whether `Renderer.render` should write the visualization script, tokens and token layout once,
+                in files shared by all HTML files of a completion, instead of embedding them in every HTML file (default `False`)
+
+            backend: the rendering backend of the visualization. See `RenderBackend` (default `RenderBackend.SVG`)
+
+            font_metrics: the glyph advance widths of the visualization's font, e.g. `FontMetrics.default()`. If given,
+                token widths are computed from them instead of `num_chars_block`, and the visualization uses the token
+                layout as it is, without measuring tokens in the page (default `None`)
         """
 
         self.y_margin = y_margin
@@ -52,6 +83,10 @@ class RenderConfig:
         self.token_width = token_width
         self.min_token_width = min_token_width
         self.matrix_width = matrix_width
+        self.attention_encoding = attention_encoding
+        self.shared_assets = shared_assets
+        self.backend = backend
+        self.font_metrics = font_metrics
 
 
 class Renderer:
@@ -63,6 +98,7 @@ class Renderer:
         self,
         render_config: RenderConfig,
         aggregation_method: AttentionAggregationMethod = AttentionAggregationMethod.NONE,
+        token_cache: TokenCache | None = None,
     ):
         """
         `Renderer` constructor.
@@ -71,10 +107,17 @@ class Renderer:
             render_config: the rendering configuration. See `RenderConfig`.
 
             aggregation_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`.
+
+            token_cache: the prettified text and layout of the tokens already rendered, shared by all completions
+                rendered by this renderer. See `TokenCache` (default `None`, i.e. a new, empty cache)
         """
 
         self.render_config = render_config
         self.aggr_method = aggregation_method
+        self.token_cache = TokenCache() if token_cache is None else token_cache
+
+        # The visualization script is read once, and split around its template marker
+        self._template = self._load_template()
 
     def _create_token_info(
         self,
@@ -82,6 +125,7 @@ class Renderer:
         start_x: int,
         start_y: int,
         info: list[tuple[int, int, int, int]] | None,
+        prompt_length: int = 0,
     ) -> tuple[list[tuple[int, int, int, int]], float]:
         """
         Used for js visualization. Computes the (x, y) coordinates for a list of tokens, given the starting point (start_x, start_y)
@@ -95,46 +139,124 @@ class Renderer:
 
             info: the list of (x, y) coordinates this function should append to. Defaults to the empty list.
 
+            prompt_length: the number of prompt tokens, which are drawn in bold (only used with font metrics, default `0`)
+
         Returns:
             a pair (info, dy) where info is the modified array with (x, y) coordinates of the given tokens, and dy is the total height of the computed token sequence.
         """
         if info is None:
             info = []
 
-        dx = 0
-        dy = 0
+        spaces, widths, bold_widths = self.token_cache.layout(
+            tokens, self._layout_key(), self._measure_token
+        )
+        if self.render_config.font_metrics is not None:
+            widths[:prompt_length] = bold_widths[:prompt_length]
 
-        for t in tokens:
+        # A line ends after the token which makes it longer than `line_length`, or after a line break: both are
+        # found from the prefix sums of the widths, with one search per line instead of one test per token
+        offsets = list(itertools.accumulate(widths, initial=0))
+        line_breaks = [i for i, t in enumerate(tokens) if t == "\n"]
 
-            w = min(
-                self.render_config.token_width,
-                max(
-                    self.render_config.min_token_width,
-                    (len(t) / self.render_config.num_chars_block)
-                    * self.render_config.token_width,
-                ),
+        dy = 0
+        start = 0
+        while start < len(tokens):
+            end = bisect.bisect_right(
+                offsets, offsets[start] + self.render_config.line_length, start + 1
             )
-            info.append(
-                [start_x + dx, start_y + dy, w, 1 if (t.startswith(" ")) else 0]
+            line_break = bisect.bisect_left(line_breaks, start)
+            if line_break < len(line_breaks):
+                end = min(end, line_breaks[line_break] + 1)
+            end = min(end, len(tokens))
+
+            x = start_x - offsets[start]
+            y = start_y + dy
+            info.extend(
+                [x + offset, y, w, space]
+                for offset, w, space in zip(
+                    offsets[start:end], widths[start:end], spaces[start:end]
+                )
             )
 
-            dx += w
-
-            if dx > self.render_config.line_length or t == "\n":
-                dx = 0
+            if (
+                offsets[end] - offsets[start] > self.render_config.line_length
+                or tokens[end - 1] == "\n"
+            ):
                 dy += self.render_config.token_height
+            start = end
 
         return info, dy
 
+    def _layout_key(self) -> str:
+        """
+        Identifies the configuration token widths are computed with (see `TokenCache.layout`).
+
+        Returns:
+            the width-related parameters of the rendering configuration, as a JSON string
+        """
+        metrics = self.render_config.font_metrics
+        if metrics is None:
+            key = {
+                "num_chars_block": self.render_config.num_chars_block,
+                "token_width": self.render_config.token_width,
+                "min_token_width": self.render_config.min_token_width,
+            }
+        else:
+            key = {
+                "family": metrics.family,
+                "font_size": metrics.font_size,
+                "units_per_em": metrics.units_per_em,
+                "default_advance": metrics.default_advance,
+                "wide_advance": metrics.wide_advance,
+            }
+
+        return json.dumps(key, sort_keys=True)
+
+    def _measure_token(self, t: str) -> tuple[int, float, float]:
+        """
+        Computes the layout of a token (see `TokenCache.layout`).
+
+        Args:
+            t: a (prettified) token
+
+        Returns:
+            whether the token starts with a space, its width, and its width in bold (only different with font metrics)
+        """
+        space = 1 if (t.startswith(" ")) else 0
+        metrics = self.render_config.font_metrics
+
+        if metrics is not None:
+            # The exact width drawn by the visualization: a leading space offset, then the text
+            offset = 0.3 * (0.25 + space) * metrics.font_size
+            return (
+                space,
+                offset + metrics.text_width(t),
+                offset + metrics.text_width(t, bold=True),
+            )
+
+        w = min(
+            self.render_config.token_width,
+            max(
+                self.render_config.min_token_width,
+                (len(t) / self.render_config.num_chars_block)
+                * self.render_config.token_width,
+            ),
+        )
+        return space, w, w
+
     def create_token_info(
-        self, tokens: list[str]
+        self, tokens: list[str], prompt_length: int = 0
     ) -> tuple[list[tuple[int, int, int, int]], float]:
         """
         Used for js visualization. Computes the (x, y) coordinates for a list of tokens.
 
+        With font metrics (see `RenderConfig`), the coordinates and widths are final: the visualization uses them as they are.
+
         Args:
             tokens: an array of tokens
 
+            prompt_length: the number of prompt tokens, which are drawn in bold (only used with font metrics, default `0`)
+
         Returns:
             a pair (res, dy) where res contains the (x, y) coordinates of the given tokens, and dy is the total height of the computed token sequence.
         """
@@ -145,6 +267,7 @@ class Renderer:
             start_x=self.render_config.x_margin,
             start_y=self.render_config.y_margin,
             info=all_info,
+            prompt_length=prompt_length,
         )
 
         return res, dy
@@ -159,16 +282,349 @@ class Renderer:
         Returns:
             an array of formatted tokens
         """
-        return [
+        return self.token_cache.prettify(tokens, self._prettify_token)
+
+    @staticmethod
+    def _prettify_token(t: str) -> str:
+        """
+        Replaces common LLM special tokens in a single token (see `_format_special_chars`).
+
+        Args:
+            t: a token
+
+        Returns:
+            the formatted token
+        """
+        return (
             t.replace("Ġ", " ")
             .replace("▁", " ")
             .replace("</w>", "")
             .replace("Ċ", ",")
             .replace("<0x0A>", "\n")
-            for t in tokens
-        ]
+        )
 
-    def _populate_html(self, attn_data: dict, vis_id: int) -> HTML:
+    @staticmethod
+    def _json_default(obj):
+        """
+        Serializes the attention matrix into nested lists, only when the JSON payload is written.
+
+        Args:
+            obj: an object not natively serializable by `json`
+
+        Returns:
+            the JSON-serializable version of `obj`
+        """
+        if isinstance(obj, (PackedAttention, torch.Tensor)):
+            return obj.tolist()
+
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    @staticmethod
+    def _load_template() -> tuple[str, str]:
+        """
+        Reads the visualization script, split around its `PYTHON_PARAMS` template marker.
+
+        Returns:
+            the parts of the script before and after the marker
+        """
+        with open(
+            os.path.join(
+                os.path.dirname(os.path.realpath(__file__)), "attention_viz.js"
+            ),
+            mode="r",
+            encoding="UTF-8",
+        ) as fp:
+            before, after = fp.read().split("PYTHON_PARAMS", 1)
+
+        return before, after
+
+    @staticmethod
+    def _write_json(fp: TextIO, obj) -> None:
+        """
+        Writes the JSON serialization of `obj` to a file, one attention row at a time for packed attention matrices,
+        so that no string holding a whole attention matrix is ever built.
+
+        Args:
+            fp: the file to write to
+
+            obj: the object to serialize (see `json.dumps`)
+        """
+        if not isinstance(obj, PackedAttention):
+            fp.write(json.dumps(obj, default=Renderer._json_default))
+            return
+
+        if obj.data.dim() > 1:
+            fp.write("[")
+            for i in range(len(obj)):
+                if i > 0:
+                    fp.write(", ")
+                Renderer._write_json(fp, obj[i])
+            fp.write("]")
+            return
+
+        # A single head: lists of rows
+        values = obj.data.tolist()
+        bounds = obj.row_offsets.tolist()
+        fp.write(
+            json.dumps(
+                [values[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+            )
+        )
+
+    @staticmethod
+    def _write_base64(fp: TextIO, tensor: torch.Tensor) -> None:
+        """
+        Writes the raw bytes of a tensor to a file as a base64 JSON string, one block at a time.
+
+        Args:
+            fp: the file to write to
+
+            tensor: the tensor to encode
+        """
+        data = memoryview(tensor.contiguous().numpy()).cast("B")
+        block_size = (
+            3 << 20
+        )  # A multiple of 3, so that blocks are encoded without padding
+
+        fp.write('"')
+        for start in range(0, len(data), block_size):
+            fp.write(base64.b64encode(data[start : start + block_size]).decode("ascii"))
+        fp.write('"')
+
+    @staticmethod
+    def _write_encoded(
+        fp: TextIO, attention: PackedAttention, encoding: AttentionEncoding
+    ) -> None:
+        """
+        Writes a packed attention matrix to a file as a binary payload, decoded by the visualization script.
+
+        The payload holds the shape of the leading dimensions, the row offsets, and the packed values
+        (see `PackedAttention`) in base64. With `AttentionEncoding.UINT8`, every attention row is divided by its
+        maximum and rounded to 256 levels; the scales (maximum / 255) are written as float32 values. With
+        `AttentionEncoding.SPARSE`, only non-zero values are written (as float16), with their column indices and
+        the number of non-zero values of every row.
+
+        Args:
+            fp: the file to write to
+
+            attention: the packed attention matrix, of shape `num_layers x num_heads x num_packed`
+
+            encoding: `AttentionEncoding.FLOAT16`, `AttentionEncoding.UINT8` or `AttentionEncoding.SPARSE`
+        """
+        data = attention.data.detach().cpu()
+
+        fp.write(
+            json.dumps(
+                {
+                    "encoding": encoding.name.lower(),
+                    "shape": list(data.shape[:-1]),
+                    "row_offsets": attention.row_offsets.tolist(),
+                }
+            )[:-1]
+        )
+
+        if encoding == AttentionEncoding.FLOAT16:
+            fp.write(', "data": ')
+            Renderer._write_base64(fp, data.to(torch.float16))
+        elif encoding == AttentionEncoding.UINT8:
+            data = data.float()
+            row_index = torch.repeat_interleave(
+                torch.arange(attention.num_rows), attention.lengths
+            )
+            row_max = torch.zeros(
+                (*data.shape[:-1], attention.num_rows)
+            ).scatter_reduce_(
+                -1, row_index.expand_as(data), data, "amax", include_self=False
+            )
+            scales = row_max / 255
+
+            quantized = torch.round(
+                data / scales.clamp(min=torch.finfo(torch.float32).tiny)[..., row_index]
+            )
+
+            fp.write(', "data": ')
+            Renderer._write_base64(fp, quantized.clamp(0, 255).to(torch.uint8))
+            fp.write(', "scales": ')
+            Renderer._write_base64(fp, scales)
+        elif encoding == AttentionEncoding.SPARSE:
+            nonzero = data != 0
+            row_index = torch.repeat_interleave(
+                torch.arange(attention.num_rows), attention.lengths
+            )
+            columns = torch.arange(data.shape[-1]) - attention.row_offsets[row_index]
+            index_dtype = (
+                torch.int16 if int(attention.lengths.max()) <= 2**15 else torch.int32
+            )
+
+            # Values are written in the order of their (layer, head, row), as are the counts of every row
+            counts = torch.zeros(
+                (*data.shape[:-1], attention.num_rows), dtype=torch.int32
+            ).index_add_(-1, row_index, nonzero.int())
+
+            fp.write(f', "index_bytes": {index_dtype.itemsize}, "counts": ')
+            Renderer._write_base64(fp, counts)
+            fp.write(', "indices": ')
+            Renderer._write_base64(fp, columns.expand_as(data)[nonzero].to(index_dtype))
+            fp.write(', "data": ')
+            Renderer._write_base64(fp, data[nonzero].to(torch.float16))
+        else:
+            raise ValueError(f"{encoding} is not a binary encoding")
+
+        fp.write("}")
+
+    def _write_params(
+        self, fp: TextIO, attn_data: dict, vis_id: str, exclude: Iterable[str] = ()
+    ) -> None:
+        """
+        Writes the parameters of the visualization script as JSON, encoding the attention matrix as configured
+        (see `RenderConfig.attention_encoding`).
+
+        Args:
+            fp: the file to write to
+
+            attn_data: attention-related information (see `_populate_html`)
+
+            vis_id: the desired root element id of the HTML document
+
+            exclude: the keys of `attn_data` not to write (default: none). Values which are functions write themselves
+                to the file they are given (see `render_viewer`)
+        """
+        fp.write('{"attention": {')
+        items = [(key, value) for key, value in attn_data.items() if key not in exclude]
+        for i, (key, value) in enumerate(items):
+            if i > 0:
+                fp.write(", ")
+            fp.write(json.dumps(key) + ": ")
+            if (
+                key == "attn"
+                and isinstance(value, PackedAttention)
+                and self.render_config.attention_encoding != AttentionEncoding.JSON
+            ):
+                self._write_encoded(fp, value, self.render_config.attention_encoding)
+            elif callable(value):
+                value(fp)
+            else:
+                self._write_json(fp, value)
+        fp.write('}, "root_div_id": ' + json.dumps(vis_id))
+        if self.render_config.backend != RenderBackend.SVG:
+            fp.write(
+                ', "backend": ' + json.dumps(self.render_config.backend.name.lower())
+            )
+        fp.write("}")
+
+    def _write_html(
+        self,
+        fp: TextIO,
+        attn_data: dict,
+        vis_id: str,
+        assets: tuple[str, str] | None = None,
+    ) -> None:
+        """
+        Writes an HTML file for self-attention visualization, populated with the given information.
+
+        The JSON payload is written directly between the two halves of the visualization script. With shared `assets`
+        (see `_write_shared_assets`), the HTML file only holds the payload of its own chunk, and loads the rest.
+
+        Args:
+            fp: the file to write to
+
+            attn_data: attention-related information (see `_populate_html`)
+
+            vis_id: the desired root element id of the HTML document
+
+            assets: the relative paths of the shared tokens and script files (default `None`, i.e. the file is self-contained)
+        """
+        fp.write(
+            '<script src="https://cdnjs.cloudflare.com/ajax/libs/require.js/2.3.6/require.min.js"></script>'
+        )
+        fp.write(f"""
+            <title>att_viz</title>
+            <div id="{vis_id}" style="font-family:'Helvetica Neue', Helvetica, Arial, sans-serif;">
+                <span style="user-select:none">
+                    Layer: <select id="layer"></select>
+                </span>
+                <div id='vis'></div>
+            </div>
+        """)
+
+        if assets is not None:
+            tokens_src, script_src = assets
+
+            # Classic scripts rather than fetch requests, so that files can be opened from file://
+            fp.write(f'\n<script src="{html.escape(tokens_src)}"></script>')
+            fp.write('\n<script type="text/javascript">\nwindow.attVizParams = ')
+            self._write_params(fp, attn_data, vis_id, exclude=self._SHARED_KEYS)
+            fp.write(";\n</script>")
+            fp.write(f'\n<script src="{html.escape(script_src)}"></script>\n')
+            return
+
+        fp.write('\n<script type="text/javascript">\n')
+        fp.write(self._template[0])
+        self._write_params(fp, attn_data, vis_id)
+        fp.write(self._template[1])
+        fp.write("\n</script>\n")
+
+    def _write_html_file(
+        self,
+        path: str,
+        attn_data: dict,
+        vis_id: str,
+        assets: tuple[str, str] | None = None,
+    ) -> str:
+        """
+        Writes an HTML file for self-attention visualization to disk. See `_write_html`.
+
+        Args:
+            path: the path of the HTML file
+
+            attn_data: attention-related information (see `_populate_html`)
+
+            vis_id: the desired root element id of the HTML document
+
+            assets: the relative paths of the shared tokens and script files (default `None`, i.e. the file is self-contained)
+
+        Returns:
+            the path of the HTML file
+        """
+        with open(path, mode="w", encoding="UTF-8") as fp:
+            self._write_html(fp, attn_data, vis_id, assets)
+
+        return path
+
+    def _write_shared_assets(
+        self, save_prefix: str, shared_data: dict
+    ) -> tuple[str, str]:
+        """
+        Writes the files shared by all HTML files of a completion: the tokens and their layout, and the visualization
+        script, which reads its parameters from the `attVizShared` and `attVizParams` globals set by these files.
+
+        Args:
+            save_prefix: which prefix to use when saving the files
+
+            shared_data: the attention-related information common to all HTML files (see `_shared_data`)
+
+        Returns:
+            the paths of the tokens and script files, relative to the HTML files
+        """
+        tokens_path = f"{save_prefix}tokens.js"
+        script_path = f"{save_prefix}attention_viz.js"
+
+        with open(tokens_path, mode="w", encoding="UTF-8") as fp:
+            fp.write("window.attVizShared = ")
+            self._write_json(fp, shared_data)
+            fp.write(";\n")
+
+        with open(script_path, mode="w", encoding="UTF-8") as fp:
+            fp.write(self._template[0])
+            fp.write(
+                "Object.assign({}, window.attVizParams, "
+                '{"attention": Object.assign({}, window.attVizShared, window.attVizParams.attention)})'
+            )
+            fp.write(self._template[1])
+
+        return os.path.basename(tokens_path), os.path.basename(script_path)
+
+    def _populate_html(self, attn_data: dict, vis_id: str) -> HTML:
         """
         Creates the structure of an HTML file for self-attention visualization, and populates it with the given information.
 
@@ -195,52 +651,81 @@ class Renderer:
         Returns:
             The resulting `Ipython.display.HTML` object
         """
-        # Compose html
-        vis_html = f"""
-            <title>att_viz</title>
-            <div id="{vis_id}" style="font-family:'Helvetica Neue', Helvetica, Arial, sans-serif;">
-                <span style="user-select:none">
-                    Layer: <select id="layer"></select>
-                </span>
-                <div id='vis'></div>
-            </div>
+        buffer = io.StringIO()
+        self._write_html(buffer, attn_data, vis_id)
+        return HTML(buffer.getvalue())
+
+    @staticmethod
+    def _bounded_map(
+        fn: Callable, items: Iterable[tuple], executor: Executor, max_in_flight: int
+    ) -> Iterator:
         """
+        Applies a function to items with an executor, keeping at most `max_in_flight` of them pending.
 
-        params = {
-            "attention": attn_data,
-            "root_div_id": vis_id,
-        }
+        Args:
+            fn: the function to apply
 
-        html1 = HTML(
-            '<script src="https://cdnjs.cloudflare.com/ajax/libs/require.js/2.3.6/require.min.js"></script>'
-        )
+            items: the argument tuples of every call
 
-        html2 = HTML(vis_html)
+            executor: the thread or process pool running the calls
 
-        __location__ = os.path.realpath(
-            os.path.join(os.getcwd(), os.path.dirname(__file__))
-        )
-        with open(
-            os.path.join(__location__, "attention_viz.js"), mode="r", encoding="UTF-8"
-        ) as fp:
-            vis_js = fp.read().replace("PYTHON_PARAMS", json.dumps(params))
-            html3 = Javascript(vis_js)
-            script = (
-                '\n<script type="text/javascript">\n' + html3.data + "\n</script>\n"
-            )
+            max_in_flight: the maximum number of submitted calls whose results have not been produced
 
-            head_html = HTML(html1.data + html2.data + script)
-            return head_html
+        Returns:
+            a generator of the results, in the order of `items`
+        """
+        assert max_in_flight > 0
 
-    def _make_htmls(
+        pending = deque()
+        for args in items:
+            if len(pending) == max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, *args))
+
+        while pending:
+            yield pending.popleft().result()
+
+    # The attention-related information which is the same for every chunk of a completion
+    _SHARED_KEYS = ("name", "tokens", "prompt_length", "pos", "pos_final", "dy_total")
+
+    def _shared_data(self, tokens: list[str], prompt_length: int) -> dict:
+        """
+        Computes the attention-related information which is the same for every chunk of a completion.
+
+        Args:
+            tokens: the list of tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+        Returns:
+            the name of the visualization, the tokens, the prompt length, and the token positioning information
+        """
+        with stage("layout", num_tokens=len(tokens)):
+            token_info, dy = self.create_token_info(tokens, prompt_length)
+
+        data = {
+            "name": "Response -> Prompt",
+            "tokens": tokens,
+            "prompt_length": prompt_length,
+            "pos": token_info,
+            "dy_total": dy,
+        }
+
+        if self.render_config.font_metrics is not None:
+            # The token layout is final: the visualization does not measure the tokens
+            data["pos_final"] = True
+
+        return data
+
+    def _iter_chunks(
         self,
         tokens: list[str],
         prompt_length: int,
         attention_matrix: AttentionMatrix,
         render_in_chunks: bool = True,
-    ) -> list[HTML]:
+    ) -> Iterator[tuple[dict, str, str]]:
         """
-        Makes one or more HTML visualizations.
+        Lazily slices the attention matrix into the data of each HTML visualization.
 
         Args:
             tokens: the list of tokens of the prompt and model completion
@@ -252,71 +737,180 @@ class Renderer:
             render_in_chunks: indicates whether to render in chunks or not (default `True`)
 
         Returns:
-            a list of the resulting `IPython.display.HTML` object(s)
+            a generator of (attention data, root element id, name) triplets, one per HTML visualization
         """
 
         id_base = f"AttViz-{(uuid.uuid4().hex)}"
 
-        token_info, dy = self.create_token_info(tokens)
-
-        htmls = []
-
         attn_data = {
-            "name": "Response -> Prompt",
-            "tokens": tokens,
-            "prompt_length": prompt_length,
-            "pos": token_info,
-            "dy_total": dy,
+            **self._shared_data(tokens, prompt_length),
             "head_start_idx": 0,
-            "layer_idx" : 0
+            "layer_idx": 0,
         }
 
-        ## If the aggregation method is not none, we will not render in chunks, as some dimensions have collapsed.
-        render_in_chunks = (
-            render_in_chunks and self.aggr_method == AttentionAggregationMethod.NONE
-        )
+        ## Chunks split the heads of a layer: if the head dimension has collapsed, we will not render in chunks.
+        render_in_chunks = render_in_chunks and not self.aggr_method.collapses_heads
+        layer_indices = self._layer_indices(attention_matrix)
 
         if render_in_chunks:
 
             for layer_idx in range(attention_matrix.num_layers):
-                layer_attention = [
-                    attention_matrix.attention_matrix[layer_idx]
-                ]  # shape: 1 x num_heads x num_res_tokens x num_tokens_before
-
                 for chunk_idx in range(math.ceil(attention_matrix.num_heads / 8)):
                     start = chunk_idx * 8
                     end = min(attention_matrix.num_heads, start + 8)
-                    chunk_attention = [layer_attention[0][start:end]]
-
-                    attn_data.update(
-                        {
-                            "attn": chunk_attention,
-                            "num_heads": end - start,
-                            "num_layers": 1,
-                            "head_start_idx": start,
-                            "layer_idx": layer_idx,
-                        }
+
+                    # shape: 1 x (end - start) x num_res_tokens x num_tokens_before
+                    chunk_attention = attention_matrix.get_slice(
+                        layers=slice(layer_idx, layer_idx + 1),
+                        heads=slice(start, end),
                     )
 
+                    # Layers and heads are labelled with their indices in the model
+                    chunk_data = {
+                        **attn_data,
+                        "attn": chunk_attention,
+                        "num_heads": end - start,
+                        "num_layers": 1,
+                        "head_start_idx": attention_matrix.head_indices[start],
+                        "head_indices": attention_matrix.head_indices[start:end],
+                        "layer_idx": layer_indices[layer_idx],
+                        "layer_indices": [layer_indices[layer_idx]],
+                    }
+
                     # Generate unique div id to enable multiple visualizations in one notebook
-                    uid_str = f"Layer-{layer_idx}__Chunk-{chunk_idx}"
+                    uid_str = f"Layer-{layer_indices[layer_idx]}__Chunk-{chunk_idx}"
 
-                    res = self._populate_html(attn_data, vis_id=f"{id_base}__{uid_str}")
-                    htmls.append({"html": res, "name": uid_str})
+                    yield chunk_data, f"{id_base}__{uid_str}", uid_str
 
         else:
             attn_data.update(
                 {
-                    "attn": attention_matrix.attention_matrix,
-                    "num_heads": attention_matrix.num_heads,
-                    "num_layers": attention_matrix.num_layers,
+                    "attn": attention_matrix.get_slice(),
+                    **self._all_layers_data(attention_matrix),
                 }
             )
 
-            res = self._populate_html(attn_data, vis_id=id_base)  # We keep the base id
-            htmls.append({"html": res, "name": ""})
+            yield attn_data, id_base, ""  # We keep the base id
 
-        return htmls
+    @staticmethod
+    def _layer_indices(attention_matrix: AttentionMatrix) -> list[int]:
+        """
+        Returns the labels of the layers of a formatted attention matrix.
+
+        Args:
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+        Returns:
+            the model indices of the layers, or their positions if the layer dimension has collapsed
+        """
+        if attention_matrix.num_layers == len(attention_matrix.layer_indices):
+            return attention_matrix.layer_indices
+        return list(
+            range(attention_matrix.num_layers)
+        )  # Aggregated layers have no model index
+
+    @staticmethod
+    def _all_layers_data(attention_matrix: AttentionMatrix) -> dict:
+        """
+        Computes the dimensions and indices of a visualization of all layers and heads of an attention matrix.
+
+        Args:
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+        Returns:
+            the number of heads and layers, and their indices in the model
+        """
+        return {
+            "num_heads": attention_matrix.num_heads,
+            "num_layers": attention_matrix.num_layers,
+            "head_indices": (
+                attention_matrix.head_indices
+                if attention_matrix.num_heads == len(attention_matrix.head_indices)
+                else list(range(attention_matrix.num_heads))
+            ),  # Aggregated heads have no model index
+            "layer_idx": Renderer._layer_indices(attention_matrix)[0],
+            "layer_indices": Renderer._layer_indices(attention_matrix),
+        }
+
+    def iter_htmls(
+        self,
+        tokens: list[str],
+        prompt_length: int,
+        attention_matrix: AttentionMatrix,
+        render_in_chunks: bool = True,
+        executor: Executor | None = None,
+        max_in_flight: int = 4,
+    ) -> Iterator[dict]:
+        """
+        Makes one or more HTML visualizations, one at a time.
+
+        Each visualization is produced only when the previous one has been consumed, so that a caller writing them
+        to disk holds a single one in memory. With an `executor`, visualizations are serialized in parallel by its
+        workers, while at most `max_in_flight` of them are pending; they are still produced in order.
+
+        Args:
+            tokens: the list of tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+            render_in_chunks: indicates whether to render in chunks or not (default `True`)
+
+            executor: a thread or process pool serializing the visualizations (default `None`, i.e. serialize them in this thread)
+
+            max_in_flight: the maximum number of visualizations submitted to `executor` but not yet produced (default `4`)
+
+        Returns:
+            a generator of `{"html": IPython.display.HTML, "name": str}` dictionaries, one per HTML visualization
+        """
+        chunks = self._iter_chunks(
+            tokens, prompt_length, attention_matrix, render_in_chunks
+        )
+
+        if executor is None:
+            for attn_data, vis_id, name in chunks:
+                yield {"html": self._populate_html(attn_data, vis_id), "name": name}
+            return
+
+        # Names stay in this process: only the data of each visualization is sent to the executor
+        names = deque()
+
+        def submitted():
+            for attn_data, vis_id, name in chunks:
+                names.append(name)
+                yield attn_data, vis_id
+
+        for document in self._bounded_map(
+            self._populate_html, submitted(), executor, max_in_flight
+        ):
+            yield {"html": document, "name": names.popleft()}
+
+    def _make_htmls(
+        self,
+        tokens: list[str],
+        prompt_length: int,
+        attention_matrix: AttentionMatrix,
+        render_in_chunks: bool = True,
+    ) -> list[HTML]:
+        """
+        Makes one or more HTML visualizations.
+
+        Args:
+            tokens: the list of tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+            render_in_chunks: indicates whether to render in chunks or not (default `True`)
+
+        Returns:
+            a list of the resulting `IPython.display.HTML` object(s)
+        """
+        return list(
+            self.iter_htmls(tokens, prompt_length, attention_matrix, render_in_chunks)
+        )
 
     def render(
         self,
@@ -326,10 +920,15 @@ class Renderer:
         prettify_tokens: bool = True,
         render_in_chunks: bool = True,
         save_prefix: str = "att_viz_",
-    ) -> None:
+        executor: Executor | None = None,
+        max_in_flight: int = 4,
+    ) -> list[str]:
         """
         Creates and saves one or more interactive HTML visualizations of the given attention matrix.
 
+        Each visualization is written to its file as soon as its chunk of the attention matrix has been sliced, without
+        building it in memory first. With an `executor`, files are written in parallel by its workers.
+
         Args:
             tokens: the list of tokens of the prompt and model completion
 
@@ -342,20 +941,203 @@ class Renderer:
             render_in_chunks: indicates whether to render in chunks or not (default `True`)
 
             save_prefix: which prefix to use when saving the HTML visualizations (default `"att_viz_"`)
+
+            executor: a thread or process pool serializing the visualizations (default `None`, i.e. serialize them in this thread)
+
+            max_in_flight: the maximum number of visualizations submitted to `executor` but not yet written (default `4`)
+
+        Returns:
+            the paths of the written files
         """
 
         if prettify_tokens:
             tokens = self._format_special_chars(tokens)
 
-        htmls = self._make_htmls(
-            tokens, prompt_length, attention_matrix, render_in_chunks
-        )
+        written = []
+
+        with stage("render", save_prefix=save_prefix) as rendering:
+            assets = None
+            if self.render_config.shared_assets:
+                assets = self._write_shared_assets(
+                    save_prefix, self._shared_data(tokens, prompt_length)
+                )
+                written += [
+                    os.path.join(os.path.dirname(save_prefix), asset)
+                    for asset in assets
+                ]
+
+            files = (
+                (f"{save_prefix}{name}.html", attn_data, vis_id, assets)
+                for attn_data, vis_id, name in self._iter_chunks(
+                    tokens, prompt_length, attention_matrix, render_in_chunks
+                )
+            )
+
+            if executor is None:
+                paths = (self._write_html_file(*args) for args in files)
+            else:
+                paths = self._bounded_map(
+                    self._write_html_file, files, executor, max_in_flight
+                )
+
+            written += paths
+
+            for path in written:
+                rendering.add_output(path)
+
+        return written
+
+    def _write_layer_payload(self, fp: TextIO, attention: PackedAttention) -> None:
+        """
+        Writes the attention payload of a single layer, encoded as configured (see `RenderConfig.attention_encoding`).
+
+        Args:
+            fp: the file to write to
+
+            attention: the packed attention of the layer, of shape `1 x num_heads x num_packed`
+        """
+        if self.render_config.attention_encoding == AttentionEncoding.JSON:
+            self._write_json(fp, attention)
+        else:
+            self._write_encoded(fp, attention, self.render_config.attention_encoding)
+
+    def _write_layer_sources(
+        self,
+        fp: TextIO,
+        attention_matrix: AttentionMatrix,
+        vis_id: str,
+        sidecar_prefix: str | None,
+    ) -> None:
+        """
+        Writes the attention of a single-page viewer, one layer at a time: each layer is either embedded as a
+        gzip-compressed base64 blob, or written to a sidecar script and referenced by its path.
+
+        Args:
+            fp: the file to write to
+
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+            vis_id: the root element id of the viewer, which keys the layers of its sidecar scripts
+
+            sidecar_prefix: which prefix to use when saving the sidecar scripts (`None` to embed the layers)
+        """
+        fp.write('{"encoding": "layers", "layers": [')
+
+        for layer in range(attention_matrix.num_layers):
+            if layer > 0:
+                fp.write(", ")
+
+            payload = io.StringIO()
+            self._write_layer_payload(
+                payload, attention_matrix.get_slice(layers=slice(layer, layer + 1))
+            )
+
+            if sidecar_prefix is None:
+                blob = gzip.compress(payload.getvalue().encode("UTF-8"), mtime=0)
+                fp.write('{"gzip": ')
+                self._write_json(fp, base64.b64encode(blob).decode("ascii"))
+                fp.write("}")
+                continue
+
+            path = f"{sidecar_prefix}layer-{self._layer_indices(attention_matrix)[layer]}.js"
+            key = f"{vis_id}/{layer}"
+            with open(path, mode="w", encoding="UTF-8") as sidecar:
+                sidecar.write(
+                    f"(window.attVizLayers = window.attVizLayers || {{}})[{json.dumps(key)}] = "
+                )
+                sidecar.write(payload.getvalue())
+                sidecar.write(";\n")
+
+            fp.write(json.dumps({"src": os.path.basename(path), "key": key}))
+
+        fp.write("]}")
+
+    def render_viewer(
+        self,
+        tokens: list[str],
+        prompt_length: int,
+        attention_matrix: AttentionMatrix,
+        prettify_tokens: bool = True,
+        save_prefix: str = "att_viz_",
+        sidecar_files: bool = False,
+    ) -> str:
+        """
+        Creates and saves a single-page interactive HTML visualization of all layers of the given attention matrix.
+
+        Unlike `render`, which writes one HTML file per layer and chunk of heads, the viewer holds every layer, and
+        only decodes the attention of a layer when it is selected: opening it costs the token layout and the first
+        layer. Layers are either embedded in the page as compressed blobs, or written next to it in sidecar scripts,
+        which are only read when their layer is selected.
+
+        Args:
+            tokens: the list of tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+            prettify_tokens: indicates whether to remove special characters in tokens, e.g. Ġ. (default `True`)
+
+            save_prefix: which prefix to use when saving the viewer and its sidecar scripts (default `"att_viz_"`)
+
+            sidecar_files: indicates whether to write every layer to a `{save_prefix}layer-{index}.js` file instead
+                of embedding it in the page (default `False`)
+
+        Returns:
+            the path of the viewer, `{save_prefix}viewer.html`
+        """
+        if prettify_tokens:
+            tokens = self._format_special_chars(tokens)
+
+        vis_id = f"AttViz-{(uuid.uuid4().hex)}"
+        sidecar_prefix = save_prefix if sidecar_files else None
 
-        for html in htmls:
-            with open(
-                f"{save_prefix}{html['name']}.html", mode="w", encoding="UTF-8"
-            ) as fp:
-                fp.write(html["html"].data)
+        with stage("render_viewer", save_prefix=save_prefix) as rendering:
+            attn_data = self._viewer_data(
+                tokens,
+                prompt_length,
+                attention_matrix,
+                lambda fp: self._write_layer_sources(
+                    fp, attention_matrix, vis_id, sidecar_prefix
+                ),
+            )
+
+            path = self._write_html_file(f"{save_prefix}viewer.html", attn_data, vis_id)
+            rendering.add_output(path)
+            if sidecar_files:
+                for index in self._layer_indices(attention_matrix):
+                    rendering.add_output(f"{save_prefix}layer-{index}.js")
+
+        return path
+
+    def _viewer_data(
+        self,
+        tokens: list[str],
+        prompt_length: int,
+        attention_matrix: AttentionMatrix,
+        write_layers: Callable[[TextIO], None],
+    ) -> dict:
+        """
+        Computes the attention-related information of a single-page viewer, whose layers are loaded on demand.
+
+        Args:
+            tokens: the list of (prettified) tokens of the prompt and model completion
+
+            prompt_length: the length of the prompt in tokens
+
+            attention_matrix: a formatted `AttentionMatrix` (see `AttentionMatrix.format`)
+
+            write_layers: writes the sources of the layers to the file it is given (see `_write_layer_sources`)
+
+        Returns:
+            the attention-related information, to be written by `_write_html`
+        """
+        return {
+            **self._shared_data(tokens, prompt_length),
+            "head_start_idx": 0,
+            "attn": write_layers,
+            **self._all_layers_data(attention_matrix),
+        }
 
     def __repr__(self):
         """
@@ -1,7 +1,12 @@
-import pickle
+import contextlib
+import os
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from .attention_capture import AttentionCapture
 from .attention_matrix import AttentionMatrix
+from .attention_store import AttentionStore
+from .instrumentation import stage
+from .packed_attention import PackedAttention
 
 
 class SelfAttentionModel:
@@ -49,6 +54,10 @@ class SelfAttentionModel:
         max_new_tokens: int = 512,
         save_prefix: str | None = None,
         prompt_template: str | None = "user\n{p}<|endoftext|>\nassistant\n",
+        stream_attention: bool = False,
+        attention_dtype: torch.dtype | None = None,
+        layers: list[int] | None = None,
+        heads: list[int] | None = None,
         **generation_kwargs,
     ) -> tuple[list[str], AttentionMatrix, int]:
         """
@@ -59,11 +68,26 @@ class SelfAttentionModel:
 
             max_new_tokens: the maximum number of tokens to be generated
 
-            save_prefix: the prefix to use if saving the computation results (default `None`)
+            save_prefix: the prefix to use if saving the computation results in an `AttentionStore` (default `None`)
 
             prompt_template: the prompt template to use for text generation (default: `"user\n{p}<|endoftext|>\nassistant\n"`)
 
-            generation_kwargs: other keyword arguments to be passed to the model's `generate` method
+            stream_attention: whether to capture attention step by step during generation (see `AttentionCapture`) instead of
+                collecting it from the model's outputs. Memory on the model's device then no longer grows with the number
+                of generated tokens, and with `save_prefix` the attention is written to disk as it is produced (default `False`)
+
+            attention_dtype: the dtype in which to capture (when streaming) or save the attention matrix, e.g. `torch.float16` (default `None`, i.e. the model's dtype)
+
+            layers: the indices of the layers whose attention should be kept (default `None`, i.e. all layers)
+
+            heads: the indices of the heads whose attention should be kept (default `None`, i.e. all heads)
+
+                The returned attention matrix only holds the selected layers and heads. With `stream_attention`, only they
+                are captured; otherwise, the model outputs the attention of all layers and heads until generation ends,
+                and the others are released then.
+
+            generation_kwargs: other keyword arguments to be passed to the model's `generate` method, except
+                `return_dict_in_generate` and `output_attentions`, which are set by att_viz (see `_generation_kwargs`)
 
         Returns:
             the generated completion (as a string and as a list of tokens), attention matrix, and prompt length (in tokens)
@@ -77,40 +101,339 @@ class SelfAttentionModel:
             model_input = model_input.to("cuda")
 
         input_length = model_input.shape[-1]
-
-        gen = self.model.generate(
-            model_input,
-            max_new_tokens=max_new_tokens,
-            min_new_tokens=0,
-            do_sample=False,
-            output_attentions=True,
-            return_dict_in_generate=True,
-            **generation_kwargs,
+        generation_kwargs = self._generation_kwargs(
+            max_new_tokens, generation_kwargs, return_dict=not stream_attention
         )
 
-        completion = gen["sequences"][0]
-        attentions = gen["attentions"]
+        if stream_attention:
+            capture = AttentionCapture(
+                self.model,
+                input_length,
+                max_new_tokens,
+                dtype=attention_dtype,
+                store_path=(
+                    AttentionStore.path_for(save_prefix)
+                    if save_prefix is not None
+                    else None
+                ),
+                layers=layers,
+                heads=heads,
+            )
+
+            with stage("generate", prompt_length=input_length) as generation:
+                with capture:
+                    completion = self.model.generate(model_input, **generation_kwargs)[
+                        0
+                    ]
+
+                completion_tokens = self.tokenizer.convert_ids_to_tokens(completion)
+                attention_matrix = capture.close(
+                    completion_tokens, model_name=self.model_name_or_directory
+                )
+                generation.add_tensor(attention_matrix.attention_matrix)
+                if save_prefix is not None:
+                    generation.add_output(AttentionStore.path_for(save_prefix))
+
+            return completion_tokens, attention_matrix, input_length
+
+        with stage("generate", prompt_length=input_length) as generation:
+            gen = self.model.generate(model_input, **generation_kwargs)
 
-        attention_matrix = AttentionMatrix(attentions)
+            completion = gen["sequences"][0]
+            attentions = gen["attentions"]
+            for step in attentions:
+                for layer_attention in step:
+                    generation.add_tensor(layer_attention)
+            del gen
+
+            if layers is not None or heads is not None:
+                # Only the selected rows are kept: the attention of the other layers and heads is released
+                attentions = PackedAttention.from_generate(
+                    attentions, None, layers, heads
+                )
+
+        attention_matrix = AttentionMatrix(attentions, layers, heads)
         completion_tokens = self.tokenizer.convert_ids_to_tokens(completion)
 
         if save_prefix is not None:
-            with (
-                open(
-                    f"{save_prefix}_completion_tokens.pickle", "wb"
-                ) as fp_completion_tokens,
-                open(f"{save_prefix}_attention_matrix.pickle", "wb") as fp_att,
-                open(f"{save_prefix}_input_length.pickle", "wb") as fp_inp_len,
-            ):
-
-                fp_completion_tokens.write(
-                    pickle.dumps(completion_tokens, pickle.HIGHEST_PROTOCOL)
+            with stage("save", save_prefix=save_prefix) as saving:
+                if not isinstance(attentions, PackedAttention):
+                    packed = PackedAttention.from_generate(attentions, attention_dtype)
+                elif attention_dtype is not None:
+                    packed = attentions.to(attention_dtype)
+                else:
+                    packed = attentions
+                AttentionStore.write(
+                    AttentionStore.path_for(save_prefix),
+                    packed,
+                    completion_tokens,
+                    input_length,
+                    model_name=self.model_name_or_directory,
+                    layer_indices=layers,
+                    head_indices=heads,
                 )
-                fp_att.write(pickle.dumps(attention_matrix, pickle.HIGHEST_PROTOCOL))
-                fp_inp_len.write(pickle.dumps(input_length, pickle.HIGHEST_PROTOCOL))
+                saving.add_tensor(packed)
+                saving.add_output(AttentionStore.path_for(save_prefix))
 
         return completion_tokens, attention_matrix, input_length
 
+    @staticmethod
+    def _generation_kwargs(
+        max_new_tokens: int, generation_kwargs: dict, return_dict: bool
+    ) -> dict:
+        """
+        Builds the keyword arguments of the model's `generate` method. Attention is always output, and the outputs of
+        `generate` are always collected the same way: the caller cannot override either.
+
+        Args:
+            max_new_tokens: the maximum number of tokens to be generated
+
+            generation_kwargs: the keyword arguments passed by the caller
+
+            return_dict: whether `generate` should return a dictionary holding the attention (rather than only the
+                sequences, when attention is captured by `AttentionCapture`)
+
+        Returns:
+            the keyword arguments of `generate`
+
+        Raises:
+            ValueError: if `generation_kwargs` sets `return_dict_in_generate`, or disables `output_attentions`
+        """
+        if "return_dict_in_generate" in generation_kwargs:
+            raise ValueError(
+                "return_dict_in_generate cannot be passed: att_viz collects the outputs of generate itself"
+            )
+        if not generation_kwargs.get("output_attentions", True):
+            raise ValueError(
+                "output_attentions cannot be disabled: attention is needed for the visualization"
+            )
+
+        return {
+            "max_new_tokens": max_new_tokens,
+            "min_new_tokens": 0,
+            "do_sample": False,
+            **generation_kwargs,
+            "output_attentions": True,
+            "return_dict_in_generate": return_dict,
+        }
+
+    def generate_batch(
+        self,
+        prompts: list[str],
+        max_new_tokens: int = 512,
+        save_prefixes: list[str] | None = None,
+        prompt_template: str | None = "user\n{p}<|endoftext|>\nassistant\n",
+        attention_dtype: torch.dtype | None = None,
+        layers: list[int] | None = None,
+        heads: list[int] | None = None,
+        **generation_kwargs,
+    ) -> list[tuple[list[str], AttentionMatrix, int]]:
+        """
+        Generates text for several prompts with a single call to the model's `generate` method.
+
+        Prompts are left-padded to the same length. The attention of each sequence is captured separately
+        (see `AttentionCapture`), without the padding columns and without the steps generated after the end of
+        the sequence, so that every result matches what `generate_text` returns for the same prompt.
+
+        Args:
+            prompts: the prompts to use for text generation
+
+            max_new_tokens: the maximum number of tokens to be generated
+
+            save_prefixes: the prefixes to use if saving the computation results in `AttentionStore` files - should have the same length as `prompts` (default `None`)
+
+            prompt_template: the prompt template to use for text generation (default: `"user\n{p}<|endoftext|>\nassistant\n"`)
+
+            attention_dtype: the dtype in which to capture the attention matrices, e.g. `torch.float16` (default `None`, i.e. the model's dtype)
+
+            layers: the indices of the layers whose attention should be kept (default `None`, i.e. all layers)
+
+            heads: the indices of the heads whose attention should be kept (default `None`, i.e. all heads)
+
+            generation_kwargs: other keyword arguments to be passed to the model's `generate` method, except
+                `return_dict_in_generate` and `output_attentions`, which are set by att_viz (see `_generation_kwargs`)
+
+        Returns:
+            for each prompt, the generated completion (as a list of tokens), attention matrix, and prompt length (in tokens)
+        """
+        assert save_prefixes is None or len(save_prefixes) == len(prompts)
+
+        encoded = [
+            self.tokenizer.encode(
+                (
+                    prompt_template.format(p=prompt)
+                    if prompt_template is not None
+                    else prompt
+                ),
+                return_tensors="pt",
+            )[0]
+            for prompt in prompts
+        ]
+        prompt_lengths = [len(prompt_input) for prompt_input in encoded]
+        input_length = max(prompt_lengths)
+
+        generation_kwargs = self._generation_kwargs(
+            max_new_tokens, generation_kwargs, return_dict=False
+        )
+        pad_token_id = generation_kwargs.pop("pad_token_id", None)
+        if pad_token_id is None:
+            pad_token_id = (
+                self.tokenizer.pad_token_id
+                if self.tokenizer.pad_token_id is not None
+                else self.tokenizer.eos_token_id
+            )
+
+        model_input = torch.full((len(prompts), input_length), pad_token_id)
+        attention_mask = torch.zeros((len(prompts), input_length), dtype=torch.long)
+        for i, prompt_input in enumerate(encoded):
+            model_input[i, input_length - len(prompt_input) :] = prompt_input
+            attention_mask[i, input_length - len(prompt_input) :] = 1
+
+        if torch.cuda.is_available():
+            model_input = model_input.to("cuda")
+            attention_mask = attention_mask.to("cuda")
+
+        captures = [
+            AttentionCapture(
+                self.model,
+                prompt_length,
+                max_new_tokens,
+                dtype=attention_dtype,
+                store_path=(
+                    AttentionStore.path_for(save_prefixes[i])
+                    if save_prefixes is not None
+                    else None
+                ),
+                layers=layers,
+                heads=heads,
+                batch_index=i,
+                padding=input_length - prompt_length,
+            )
+            for i, prompt_length in enumerate(prompt_lengths)
+        ]
+
+        with contextlib.ExitStack() as stack:
+            for capture in captures:
+                stack.enter_context(capture)
+
+            sequences = self.model.generate(
+                model_input,
+                attention_mask=attention_mask,
+                pad_token_id=pad_token_id,
+                **generation_kwargs,
+            )
+
+        eos_token_ids = generation_kwargs.get(
+            "eos_token_id", self.model.generation_config.eos_token_id
+        )
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+
+        results = []
+        for i, capture in enumerate(captures):
+            # Sequences which ended early are padded until the whole batch has ended
+            generated = sequences[i, input_length:].tolist()
+            num_steps = next(
+                (
+                    step + 1
+                    for step, token in enumerate(generated)
+                    if token in eos_token_ids
+                ),
+                len(generated),
+            )
+
+            completion = sequences[
+                i, input_length - prompt_lengths[i] : input_length + num_steps
+            ]
+            completion_tokens = self.tokenizer.convert_ids_to_tokens(completion)
+            attention_matrix = capture.close(
+                completion_tokens,
+                model_name=self.model_name_or_directory,
+                num_steps=num_steps,
+            )
+
+            results.append((completion_tokens, attention_matrix, prompt_lengths[i]))
+
+        return results
+
+    def estimate_batch_size(
+        self,
+        prompts: list[str],
+        max_new_tokens: int = 512,
+        prompt_template: str | None = "user\n{p}<|endoftext|>\nassistant\n",
+    ) -> int:
+        """
+        Estimates how many of the given prompts can be generated together by `generate_batch`, from the available memory.
+
+        The memory needed by a sequence is estimated as its key-value cache, plus the attention weights of the
+        prompt processing step (all layers and heads, for the longest prompt). Half of the available memory is kept free.
+
+        Args:
+            prompts: the prompts to use for text generation
+
+            max_new_tokens: the maximum number of tokens to be generated
+
+            prompt_template: the prompt template to use for text generation (default: `"user\n{p}<|endoftext|>\nassistant\n"`)
+
+        Returns:
+            the estimated batch size, between 1 and the number of prompts
+        """
+        available_memory = self._available_memory()
+        if available_memory is None or len(prompts) <= 1:
+            return 1
+
+        prompt_length = max(
+            len(
+                self.tokenizer.encode(
+                    prompt_template.format(p=prompt)
+                    if prompt_template is not None
+                    else prompt
+                )
+            )
+            for prompt in prompts
+        )
+
+        config = self.model.config
+        num_layers = config.num_hidden_layers
+        num_heads = config.num_attention_heads
+        num_key_value_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        itemsize = self.model.dtype.itemsize
+
+        key_value_cache = (
+            2
+            * num_layers
+            * num_key_value_heads
+            * head_dim
+            * (prompt_length + max_new_tokens)
+            * itemsize
+        )
+        prompt_attention = num_layers * num_heads * prompt_length**2 * itemsize
+
+        batch_size = int(0.5 * available_memory // (key_value_cache + prompt_attention))
+        return max(1, min(len(prompts), batch_size))
+
+    @staticmethod
+    def _available_memory() -> int | None:
+        """
+        Returns the memory available for generation in bytes: free memory on the GPUs if any, available RAM otherwise.
+
+        Returns:
+            the available memory, or `None` if it cannot be determined
+        """
+        if torch.cuda.is_available():
+            return sum(
+                torch.cuda.mem_get_info(device)[0]
+                for device in range(torch.cuda.device_count())
+            )
+
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            return None
+
     def __repr__(self):
         """
         Debugging string representation of `SelfAttentionModel`
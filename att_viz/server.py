@@ -0,0 +1,418 @@
+import hashlib
+import html
+import io
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+import torch
+from .attention_aggregation_method import AttentionAggregationMethod
+from .attention_matrix import LazyAttentionMatrix
+from .attention_store import AttentionStore
+from .renderer import RenderConfig, Renderer
+
+
+class AttentionServer:
+    """
+    Serves the completions saved in a directory of `AttentionStore` files (see `save_completions`), without
+    rendering them first: attention slices are read from the memory-mapped stores and formatted when requested.
+
+    Endpoints:
+        - `/`: the list of saved completions
+        - `/view?prefix=...`: the single-page viewer of a completion (see `Renderer.render_viewer`), which requests
+          each layer from `/attn` when it is selected
+        - `/attn?prefix=...&layer=3&heads=0-7&tokens=100-200`: a formatted slice of the attention of a completion.
+          `layer` is the position of the layer in the store, and the optional `heads` and `tokens` are inclusive
+          ranges of heads and response tokens (default: all of them)
+
+    Prefixes are the save prefixes of the completions, relative to the served directory. Attention slices are
+    binary: the length of a JSON header (4-byte little-endian unsigned integer), the header (encoding, shape,
+    row offsets, first response token), then the float16 attention values (see `PackedAttention`). Responses carry
+    `ETag` and `Last-Modified` headers derived from the store file, so that browsers can revalidate them.
+    """
+
+    CACHE_CONTROL = "private, max-age=3600"
+    """ The `Cache-Control` header of viewer pages and attention slices. """
+
+    def __init__(
+        self,
+        store_dir: str,
+        renderer: Renderer | None = None,
+        prettify_tokens: bool = True,
+        max_open_stores: int = 64,
+    ):
+        """
+        `AttentionServer` constructor.
+
+        Args:
+            store_dir: the directory holding the `AttentionStore` files, possibly in subdirectories
+
+            renderer: the renderer of the viewer pages, whose aggregation method formats the attention slices
+                (default `None`, i.e. `Renderer(RenderConfig())`)
+
+            prettify_tokens: indicates whether to remove special characters in tokens, e.g. Ġ. (default `True`)
+
+            max_open_stores: the maximum number of stores kept memory-mapped between requests (default `64`)
+        """
+        self.store_dir = os.path.realpath(store_dir)
+        self.renderer = renderer if renderer is not None else Renderer(RenderConfig())
+        self.prettify_tokens = prettify_tokens
+        self.max_open_stores = max_open_stores
+
+        self._matrices = OrderedDict()  # Least recently used first
+        self._lock = threading.Lock()
+
+    def store_path(self, prefix: str) -> str:
+        """
+        Returns the path of the store of a completion, which must be inside the served directory.
+
+        Args:
+            prefix: the save prefix of the completion, relative to the served directory
+
+        Returns:
+            the path of the store file
+        """
+        path = os.path.realpath(
+            os.path.join(self.store_dir, AttentionStore.path_for(prefix))
+        )
+
+        if not path.startswith(self.store_dir + os.sep) or not os.path.isfile(path):
+            raise FileNotFoundError(f"No attention store for {prefix!r}")
+        return path
+
+    def prefixes(self) -> list[str]:
+        """
+        Lists the save prefixes of the completions in the served directory.
+
+        Returns:
+            the save prefixes, relative to the served directory, in alphabetical order
+        """
+        prefixes = []
+        for directory, _, files in os.walk(self.store_dir):
+            for name in files:
+                if name.endswith(AttentionStore.SUFFIX):
+                    path = os.path.relpath(
+                        os.path.join(directory, name), self.store_dir
+                    )
+                    prefixes.append(
+                        path.removesuffix(AttentionStore.SUFFIX).replace(os.sep, "/")
+                    )
+
+        return sorted(prefixes)
+
+    def _matrix(self, prefix: str) -> LazyAttentionMatrix:
+        """
+        Opens the formatted, memory-mapped attention matrix of a completion, reusing it across requests.
+
+        Args:
+            prefix: the save prefix of the completion
+
+        Returns:
+            the formatted `LazyAttentionMatrix` of the completion
+        """
+        path = self.store_path(prefix)
+        mtime = os.stat(path).st_mtime_ns
+
+        with self._lock:
+            cached = self._matrices.get(path)
+            if cached is not None and cached[0] == mtime:
+                self._matrices.move_to_end(path)
+                return cached[1]
+
+        matrix = LazyAttentionMatrix(AttentionStore(path))
+        matrix.format(self.renderer.aggr_method, True, dtype=torch.float16)
+
+        with self._lock:
+            self._matrices[path] = (mtime, matrix)
+            self._matrices.move_to_end(path)
+            while len(self._matrices) > self.max_open_stores:
+                self._matrices.popitem(last=False)
+
+        return matrix
+
+    def validators(self, prefix: str, query: str) -> tuple[str, str]:
+        """
+        Computes the caching validators of a response about a completion.
+
+        Args:
+            prefix: the save prefix of the completion
+
+            query: the query of the request, which identifies the response for a given store file
+
+        Returns:
+            the `ETag` and `Last-Modified` header values
+        """
+        stat = os.stat(self.store_path(prefix))
+        key = f"{prefix}\0{stat.st_mtime_ns}\0{stat.st_size}\0{query}\0{self.renderer.aggr_method.name}"
+
+        etag = hashlib.sha1(key.encode("UTF-8")).hexdigest()
+        return f'"{etag}"', formatdate(stat.st_mtime, usegmt=True)
+
+    @staticmethod
+    def _parse_range(value: str | None, length: int, name: str) -> slice:
+        """
+        Parses an inclusive range, e.g. `0-7` or `3`.
+
+        Args:
+            value: the range, or `None` for the whole dimension
+
+            length: the size of the dimension
+
+            name: the name of the range, for error messages
+
+        Returns:
+            the corresponding slice
+        """
+        if value is None:
+            return slice(0, length)
+
+        start, _, end = value.partition("-")
+        start = int(start)
+        end = int(end) if end else start
+
+        if not 0 <= start <= end < length:
+            raise ValueError(f"Invalid {name} range {value!r} (size {length})")
+        return slice(start, end + 1)
+
+    def attention_slice(
+        self,
+        prefix: str,
+        layer: int,
+        heads: str | None = None,
+        tokens: str | None = None,
+    ) -> bytes:
+        """
+        Reads, formats and encodes a slice of the attention of a completion.
+
+        Args:
+            prefix: the save prefix of the completion
+
+            layer: the position of the layer in the store
+
+            heads: the inclusive range of heads, e.g. `"0-7"` (default `None`, i.e. all heads)
+
+            tokens: the inclusive range of response tokens, e.g. `"100-200"` (default `None`, i.e. all response tokens)
+
+        Returns:
+            the binary attention slice (see `AttentionServer`)
+        """
+        matrix = self._matrix(prefix)
+        layers = self._parse_range(str(layer), matrix.num_layers, "layer")
+        heads = self._parse_range(heads, matrix.num_heads, "heads")
+        rows = self._parse_range(tokens, matrix.attention_matrix.num_rows, "tokens")
+
+        packed = matrix.get_slice(layers=layers, heads=heads)
+        offsets = packed.row_offsets[rows.start : rows.stop + 1]
+        data = packed.data[..., int(offsets[0]) : int(offsets[-1])]
+
+        header = json.dumps(
+            {
+                "encoding": "float16",
+                "shape": list(data.shape[:-1]),
+                "row_offsets": (offsets - offsets[0]).tolist(),
+                "first_row": rows.start,
+            }
+        ).encode("UTF-8")
+
+        return (
+            struct.pack("<I", len(header))
+            + header
+            + data.to(torch.float16).contiguous().numpy().tobytes()
+        )
+
+    def viewer_page(self, prefix: str) -> bytes:
+        """
+        Writes the single-page viewer of a completion, whose layers are requested from `/attn` when selected.
+
+        Args:
+            prefix: the save prefix of the completion
+
+        Returns:
+            the HTML page, encoded in UTF-8
+        """
+        matrix = self._matrix(prefix)
+        store = matrix.store
+        tokens = store.tokens
+        if self.prettify_tokens:
+            tokens = self.renderer._format_special_chars(tokens)
+
+        def write_layers(fp):
+            sources = [
+                {"url": f"attn?prefix={quote(prefix)}&layer={layer}"}
+                for layer in range(matrix.num_layers)
+            ]
+            fp.write(json.dumps({"encoding": "layers", "layers": sources}))
+
+        # Deterministic, so that the page can be revalidated
+        vis_id = "AttViz-" + hashlib.sha1(store.path.encode("UTF-8")).hexdigest()
+
+        buffer = io.StringIO()
+        self.renderer._write_html(
+            buffer,
+            self.renderer._viewer_data(
+                tokens, store.prompt_length, matrix, write_layers
+            ),
+            vis_id,
+        )
+        return buffer.getvalue().encode("UTF-8")
+
+    def index_page(self) -> bytes:
+        """
+        Writes the list of the completions in the served directory, linking to their viewers.
+
+        Returns:
+            the HTML page, encoded in UTF-8
+        """
+        items = "\n".join(
+            f'<li><a href="view?prefix={html.escape(quote(prefix))}">{html.escape(prefix)}</a></li>'
+            for prefix in self.prefixes()
+        )
+        return (
+            f"<!DOCTYPE html>\n<title>att_viz</title>\n"
+            f"<h1>{html.escape(self.store_dir)}</h1>\n<ul>\n{items}\n</ul>\n"
+        ).encode("UTF-8")
+
+    def make_server(
+        self, host: str = "127.0.0.1", port: int = 8000
+    ) -> ThreadingHTTPServer:
+        """
+        Creates the HTTP server, without starting it (see `serve_forever`).
+
+        Args:
+            host: the address to listen on (default `"127.0.0.1"`, i.e. only local connections)
+
+            port: the port to listen on, or `0` for any free port (default `8000`)
+
+        Returns:
+            the HTTP server, which handles every request in its own thread
+        """
+        httpd = ThreadingHTTPServer((host, port), _AttentionRequestHandler)
+        httpd.attention_server = self
+        return httpd
+
+    def __repr__(self):
+        """
+        Debugging string representation of `AttentionServer`
+        """
+        return f"AttentionServer ({self.store_dir}, {self.renderer.aggr_method})"
+
+    def __str__(self):
+        """
+        Regular string representation of `AttentionServer`
+        """
+        return self.__repr__()
+
+
+class _AttentionRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of an `AttentionServer`.
+    """
+
+    def do_GET(self):
+        """Routes a GET request to the `AttentionServer` of the HTTP server."""
+        server = self.server.attention_server
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            if url.path == "/":
+                self._send(server.index_page(), "text/html; charset=utf-8")
+                return
+
+            if url.path not in ("/view", "/attn"):
+                raise FileNotFoundError(url.path)
+
+            prefix = query["prefix"]
+            etag, last_modified = server.validators(prefix, url.query)
+            if self.headers.get("If-None-Match") == etag:
+                self._send(None, None, etag, last_modified)
+                return
+
+            if url.path == "/view":
+                body = server.viewer_page(prefix)
+                content_type = "text/html; charset=utf-8"
+            else:
+                body = server.attention_slice(
+                    prefix, int(query["layer"]), query.get("heads"), query.get("tokens")
+                )
+                content_type = "application/octet-stream"
+
+            self._send(body, content_type, etag, last_modified)
+        except FileNotFoundError as e:
+            self.send_error(HTTPStatus.NOT_FOUND, str(e))
+        except (KeyError, ValueError) as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, f"Invalid request: {e}")
+
+    def _send(
+        self,
+        body: bytes | None,
+        content_type: str | None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> None:
+        """
+        Sends a response.
+
+        Args:
+            body: the body of the response, or `None` for a `304 Not Modified` response
+
+            content_type: the `Content-Type` of the body
+
+            etag: the `ETag` of the response, if it can be cached (default `None`)
+
+            last_modified: the `Last-Modified` date of the response, if it can be cached (default `None`)
+        """
+        self.send_response(
+            HTTPStatus.OK if body is not None else HTTPStatus.NOT_MODIFIED
+        )
+
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", AttentionServer.CACHE_CONTROL)
+
+        if body is not None:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if body is not None:
+            self.wfile.write(body)
+
+
+def serve(
+    store_dir: str,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    aggregation_method: AttentionAggregationMethod = AttentionAggregationMethod.NONE,
+    prettify_tokens: bool = True,
+) -> None:
+    """
+    Serves the completions saved in a directory until interrupted. See `AttentionServer`.
+
+    Args:
+        store_dir: the directory holding the `AttentionStore` files
+
+        host: the address to listen on (default `"127.0.0.1"`, i.e. only local connections)
+
+        port: the port to listen on (default `8000`)
+
+        aggregation_method: the aggregation method of the served attention. See `AttentionAggregationMethod`.
+
+        prettify_tokens: indicates whether to remove special characters in tokens, e.g. Ġ. (default `True`)
+    """
+    server = AttentionServer(
+        store_dir, Renderer(RenderConfig(), aggregation_method), prettify_tokens
+    )
+
+    with server.make_server(host, port) as httpd:
+        print(f"Serving {server.store_dir} on http://{host}:{httpd.server_address[1]}/")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
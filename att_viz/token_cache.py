@@ -0,0 +1,203 @@
+import json
+import os
+import re
+from typing import Callable
+
+
+class TokenCache:
+    """
+    Memoizes, for the vocabulary of a tokenizer, what rendering computes for every token: its prettified text (see
+    `Renderer._format_special_chars`), and its layout: whether it starts with a space, and its width in regular and in bold.
+
+    The completions rendered by a `Renderer` usually share one tokenizer, so that most of their tokens are already
+    cached after the first ones. Tokens are keyed by their string, as held by `AttentionStore`. Widths depend on the
+    rendering configuration: they are only reused with the layout key they were computed with.
+
+    The cache can be saved next to the stores of a tokenizer (see `path_for`) and loaded back by later renders. The
+    tokens added by the renderers of other processes are sent back with `take_added`, and merged with `merge`.
+    """
+
+    SUFFIX = "_token_cache.json"
+    """ The suffix of the files holding token caches. """
+
+    def __init__(self, tokenizer_name: str | None = None):
+        """
+        `TokenCache` constructor. Creates an empty cache.
+
+        Args:
+            tokenizer_name: the name or directory of the model whose tokenizer produced the tokens (default `None`)
+        """
+        self.tokenizer_name = tokenizer_name
+
+        self._texts: dict[str, str] = {}
+        self._layout_key: str | None = None
+        self._layout: dict[str, tuple[int, float, float]] = {}
+
+        # The tokens added since the cache was created, loaded or last taken from (see `take_added`)
+        self._added_texts: set[str] = set()
+        self._added_layout: set[str] = set()
+
+    @staticmethod
+    def path_for(directory: str, tokenizer_name: str | None = None) -> str:
+        """
+        Returns the path of the token cache of a tokenizer, in the directory of its stores.
+
+        Args:
+            directory: the directory holding the stores
+
+            tokenizer_name: the name or directory of the model whose tokenizer produced the tokens (default `None`)
+
+        Returns:
+            the path of the cache file
+        """
+        name = re.sub(r"[^\w.-]+", "_", tokenizer_name or "tokens").strip("_.")
+        return os.path.join(directory, f"{name or 'tokens'}{TokenCache.SUFFIX}")
+
+    def prettify(
+        self, tokens: list[str], prettify_token: Callable[[str], str]
+    ) -> list[str]:
+        """
+        Prettifies tokens, computing the text of each distinct token only once.
+
+        Args:
+            tokens: an array of tokens
+
+            prettify_token: computes the prettified text of a token missing from the cache
+
+        Returns:
+            an array of prettified tokens
+        """
+        texts = self._texts
+        for t in set(tokens).difference(texts):
+            texts[t] = prettify_token(t)
+            self._added_texts.add(t)
+
+        return [texts[t] for t in tokens]
+
+    def layout(
+        self,
+        tokens: list[str],
+        layout_key: str,
+        measure_token: Callable[[str], tuple[int, float, float]],
+    ) -> tuple[list[int], list[float], list[float]]:
+        """
+        Looks up the layout of tokens, measuring each distinct token only once.
+
+        Args:
+            tokens: an array of (prettified) tokens
+
+            layout_key: identifies the rendering configuration the widths are computed with; the cached widths of
+                another configuration are discarded
+
+            measure_token: computes the leading space flag, width and bold width of a token missing from the cache
+
+        Returns:
+            the leading space flags, widths and bold widths of the tokens
+        """
+        if layout_key != self._layout_key:
+            self._layout_key = layout_key
+            self._layout = {}
+            self._added_layout = set()
+
+        layout = self._layout
+        for t in set(tokens).difference(layout):
+            layout[t] = measure_token(t)
+            self._added_layout.add(t)
+
+        entries = [layout[t] for t in tokens]
+        return (
+            [entry[0] for entry in entries],
+            [entry[1] for entry in entries],
+            [entry[2] for entry in entries],
+        )
+
+    def take_added(self) -> "TokenCache":
+        """
+        Returns the tokens added since the cache was created, loaded or last taken from, e.g. to send the tokens
+        rendered by a worker process back to the main process.
+
+        Returns:
+            a `TokenCache` holding only the added tokens (see `merge`)
+        """
+        added = TokenCache(self.tokenizer_name)
+        added._texts = {t: self._texts[t] for t in self._added_texts}
+        added._layout_key = self._layout_key
+        added._layout = {t: self._layout[t] for t in self._added_layout}
+
+        self._added_texts, self._added_layout = set(), set()
+        return added
+
+    def merge(self, other: "TokenCache") -> None:
+        """
+        Adds the tokens of another cache to this one. Widths computed with another layout key than this cache's replace
+        its widths, as in `layout`.
+
+        Args:
+            other: the other cache, e.g. the tokens added by a worker process (see `take_added`)
+        """
+        self._texts.update(other._texts)
+
+        if not other._layout:
+            return
+        if other._layout_key != self._layout_key:
+            self._layout_key = other._layout_key
+            self._layout = {}
+        self._layout.update(other._layout)
+
+    def __len__(self) -> int:
+        """The number of distinct tokens held by the cache."""
+        return len(self._texts.keys() | self._layout.keys())
+
+    def save(self, path: str) -> None:
+        """
+        Saves the cache as a JSON file. The file is replaced atomically, so that concurrent renders can share it.
+
+        Args:
+            path: the path of the cache file (see `path_for`)
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as fp:
+            json.dump(
+                {
+                    "tokenizer_name": self.tokenizer_name,
+                    "texts": self._texts,
+                    "layout_key": self._layout_key,
+                    "layout": self._layout,
+                },
+                fp,
+                ensure_ascii=False,
+            )
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TokenCache":
+        """
+        Loads a cache saved by `save`.
+
+        Args:
+            path: the path of the cache file
+
+        Returns:
+            the loaded `TokenCache`
+        """
+        with open(path, encoding="UTF-8") as fp:
+            data = json.load(fp)
+
+        cache = cls(data["tokenizer_name"])
+        cache._texts = data["texts"]
+        cache._layout_key = data["layout_key"]
+        cache._layout = {t: tuple(entry) for t, entry in data["layout"].items()}
+        return cache
+
+    def __repr__(self):
+        """
+        Debugging string representation of `TokenCache`
+        """
+        return f"TokenCache ({self.tokenizer_name}: {len(self._texts)} prettified token(s), {len(self._layout)} measured token(s))"
+
+    def __str__(self):
+        """
+        Regular string representation of `TokenCache`
+        """
+        return self.__repr__()
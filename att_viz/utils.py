@@ -1,9 +1,21 @@
+import io
+import os
 import pickle
 import gc
+import time
+import torch
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable
 from .self_attention_model import SelfAttentionModel
 from .renderer import RenderConfig, Renderer
-from .attention_matrix import AttentionMatrix
+from .attention_matrix import AttentionMatrix, LazyAttentionMatrix
+from .attention_store import AttentionStore
+from .packed_attention import PackedAttention
+from .render_cache import RenderCache
+from .token_cache import TokenCache
 from .attention_aggregation_method import AttentionAggregationMethod
+from .instrumentation import record, stage
 
 
 class Experiment:
@@ -52,20 +64,27 @@ class Experiment:
 
             save_prefix_html: which prefix to use when saving the HTML visualizations (default `"att_viz_"`)
         """
-        completion_tokens, attention_matrix, prompt_length = self.model.generate_text(
-            prompt, max_new_tokens, save_prefix, prompt_template, **generation_kwargs
-        )
+        with stage("experiment"):
+            completion_tokens, attention_matrix, prompt_length = (
+                self.model.generate_text(
+                    prompt,
+                    max_new_tokens,
+                    save_prefix,
+                    prompt_template,
+                    **generation_kwargs,
+                )
+            )
 
-        attention_matrix.format(aggr_method, zero_first_attention=False)
+            attention_matrix.format(aggr_method, zero_first_attention=False)
 
-        self.renderer.render(
-            completion_tokens,
-            prompt_length,
-            attention_matrix,
-            prettify_tokens=True,
-            render_in_chunks=(aggr_method == AttentionAggregationMethod.NONE),
-            save_prefix=save_prefix_html,
-        )
+            self.renderer.render(
+                completion_tokens,
+                prompt_length,
+                attention_matrix,
+                prettify_tokens=True,
+                render_in_chunks=not aggr_method.collapses_heads,
+                save_prefix=save_prefix_html,
+            )
 
     def __repr__(self):
         """
@@ -86,6 +105,7 @@ def save_completions(
     save_prefixes: list[str],
     max_new_tokens: int = 512,
     prompt_template: str | None = "user\n{p}<|endoftext|>\nassistant\n",
+    batch_size: int | str = 1,
     **generation_kwargs,
 ) -> None:
     """
@@ -102,21 +122,248 @@ def save_completions(
 
         prompt_template: the prompt template to use for text generation (default: `"user\n{p}<|endoftext|>\nassistant\n"`)
 
+        batch_size: the number of prompts to generate together (see `SelfAttentionModel.generate_batch`), or `"auto"` to
+            estimate it from the available memory (default `1`, i.e. one prompt at a time)
+
         generation_kwargs: other keyword arguments to be passed to the model's `generate` method
     """
     assert len(prompts) == len(save_prefixes)
+    assert batch_size == "auto" or (isinstance(batch_size, int) and batch_size > 0)
+
+    with stage("load_model", model=model_name_or_directory):
+        model = SelfAttentionModel(model_name_or_directory)
+
+    if batch_size == "auto":
+        batch_size = model.estimate_batch_size(prompts, max_new_tokens, prompt_template)
+
+    if batch_size == 1:
+        for prompt, save_prefix in zip(prompts, save_prefixes):
+            with stage("save_completion", save_prefix=save_prefix):
+                _ = model.generate_text(
+                    prompt,
+                    max_new_tokens,
+                    save_prefix,
+                    prompt_template,
+                    **generation_kwargs,
+                )
+                del _
+                gc.collect()
+    else:
+        # Batched generation always streams the attention of each sequence to its store
+        generation_kwargs.pop("stream_attention", None)
+
+        for start in range(0, len(prompts), batch_size):
+            batch_prefixes = save_prefixes[start : start + batch_size]
+
+            with stage(
+                "save_completions_batch", save_prefixes=batch_prefixes
+            ) as saving:
+                _ = model.generate_batch(
+                    prompts[start : start + batch_size],
+                    max_new_tokens,
+                    batch_prefixes,
+                    prompt_template,
+                    **generation_kwargs,
+                )
+                for save_prefix in batch_prefixes:
+                    saving.add_output(AttentionStore.path_for(save_prefix))
+                del _
+                gc.collect()
 
-    model = SelfAttentionModel(model_name_or_directory)
+    del model
+    gc.collect()
+
+
+class ProcessingSummary:
+    """
+    The outcome of `process_saved_completions`: the processing time of every save prefix, and the error of every failed one.
+    """
 
-    for prompt, save_prefix in zip(prompts, save_prefixes):
-        _ = model.generate_text(
-            prompt, max_new_tokens, save_prefix, prompt_template, **generation_kwargs
+    def __init__(self):
+        """
+        `ProcessingSummary` constructor.
+        """
+        self.timings: dict[str, float] = {}
+        self.failures: dict[str, str] = {}
+        self.skipped: list[str] = []
+
+    def add(
+        self,
+        save_prefix: str,
+        elapsed: float,
+        error: str | None = None,
+        skipped: bool = False,
+    ) -> None:
+        """
+        Records the outcome of a save prefix.
+
+        Args:
+            save_prefix: the save prefix
+
+            elapsed: the time spent processing the save prefix, in seconds
+
+            error: the error message if processing failed (default `None`)
+
+            skipped: whether the visualizations of the save prefix were up to date, and not rendered again (default `False`)
+        """
+        self.timings[save_prefix] = elapsed
+        if error is not None:
+            self.failures[save_prefix] = error
+        if skipped:
+            self.skipped.append(save_prefix)
+
+    @property
+    def succeeded(self) -> list[str]:
+        """The save prefixes which have been rendered successfully, or were up to date."""
+        return [p for p in self.timings if p not in self.failures]
+
+    def __repr__(self):
+        """
+        Debugging string representation of `ProcessingSummary`
+        """
+        return f"ProcessingSummary ({len(self.succeeded)} rendered, {len(self.skipped)} up to date, {len(self.failures)} failed, {sum(self.timings.values()):.2f}s)"
+
+    def __str__(self):
+        """
+        Regular string representation of `ProcessingSummary`
+        """
+        return self.__repr__()
+
+
+def _process_saved_completion(
+    renderer: Renderer,
+    save_prefix: str,
+    prettify_tokens: bool,
+    formatted_path: str | None = None,
+    reuse_formatted: bool = False,
+) -> tuple[str, float, str | None, list[str]]:
+    """
+    Renders the inference results of a single save prefix, without raising errors.
+
+    Args:
+        renderer: the renderer to use
+
+        save_prefix: the save prefix that has been used for storing the inference results
+
+        prettify_tokens: indicates whether to remove special characters in tokens, e.g. Ġ.
+
+        formatted_path: the store of the formatted attention matrix, which is rendered instead of the completion's
+            store (see `RenderCache`) (default `None`, i.e. format the completion's store while rendering it)
+
+        reuse_formatted: whether the store at `formatted_path` is up to date; otherwise, it is written first (default `False`)
+
+    Returns:
+        the save prefix, the processing time in seconds, the error message if processing failed, and the paths of
+        the written visualizations
+    """
+    start = time.perf_counter()
+
+    try:
+        store = AttentionStore(AttentionStore.path_for(save_prefix))
+
+        if formatted_path is None:
+            attention_matrix = LazyAttentionMatrix(store)
+            attention_matrix.format(renderer.aggr_method, True)
+        else:
+            if not reuse_formatted:
+                _write_formatted(store, renderer.aggr_method, formatted_path)
+
+            # The stored attention matrix is already formatted: it is rendered as it is
+            attention_matrix = LazyAttentionMatrix(AttentionStore(formatted_path))
+            attention_matrix.format(AttentionAggregationMethod.NONE, False)
+
+        outputs = renderer.render(
+            store.tokens,
+            store.prompt_length,
+            attention_matrix,
+            prettify_tokens,
+            render_in_chunks=not renderer.aggr_method.collapses_heads,
+            save_prefix=save_prefix,
+        )
+    except Exception as e:
+        return (
+            save_prefix,
+            time.perf_counter() - start,
+            f"{type(e).__name__}: {e}",
+            [],
         )
-        del _
-        gc.collect()
 
-    del model
-    gc.collect()
+    return save_prefix, time.perf_counter() - start, None, outputs
+
+
+def _write_formatted(
+    store: AttentionStore, aggregation_method: AttentionAggregationMethod, path: str
+) -> None:
+    """
+    Formats the attention matrix of a store, and writes it to a new store.
+
+    Args:
+        store: the store of the unformatted attention matrix
+
+        aggregation_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`
+
+        path: the path of the store of the formatted attention matrix
+    """
+    attention_matrix = LazyAttentionMatrix(store)
+    attention_matrix.format(aggregation_method, True)
+
+    AttentionStore.write(
+        path,
+        attention_matrix.get_slice(),
+        store.tokens,
+        store.prompt_length,
+        model_name=store.model_name,
+        layer_indices=(
+            None if aggregation_method.collapses_layers else store.layer_indices
+        ),
+        head_indices=None if aggregation_method.collapses_heads else store.head_indices,
+    )
+
+
+# The renderer of a `process_saved_completions` worker process, created once by `_init_worker`
+_worker_renderer = None
+
+
+def _init_worker(
+    render_config: RenderConfig,
+    aggregation_method: AttentionAggregationMethod,
+    token_cache: TokenCache,
+) -> None:
+    """
+    Initializes a `process_saved_completions` worker process.
+
+    Args:
+        render_config: the rendering configuration. See `RenderConfig`.
+
+        aggregation_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`
+
+        token_cache: the initial token cache of the worker's renderer. See `TokenCache`.
+    """
+    global _worker_renderer
+    _worker_renderer = Renderer(
+        render_config=render_config,
+        aggregation_method=aggregation_method,
+        token_cache=token_cache,
+    )
+
+
+def _process_in_worker(
+    save_prefix: str,
+    prettify_tokens: bool,
+    formatted_path: str | None,
+    reuse_formatted: bool,
+) -> tuple[tuple[str, float, str | None, list[str]], TokenCache]:
+    """
+    Renders the inference results of a single save prefix in a worker process. See `_process_saved_completion`.
+
+    Returns:
+        the result of `_process_saved_completion`, and the tokens added to the worker's token cache while rendering
+        (see `TokenCache.take_added`)
+    """
+    result = _process_saved_completion(
+        _worker_renderer, save_prefix, prettify_tokens, formatted_path, reuse_formatted
+    )
+    return result, _worker_renderer.token_cache.take_added()
 
 
 def process_saved_completions(
@@ -124,9 +371,18 @@ def process_saved_completions(
     aggregation_method: AttentionAggregationMethod,
     save_prefixes: list[str],
     prettify_tokens: bool = True,
-) -> None:
+    workers: int = 1,
+    max_in_flight: int | None = None,
+    progress: Callable[[int, int, str, float, str | None], None] | None = None,
+    token_cache_path: str | None = None,
+    render_cache_path: str | None = None,
+) -> ProcessingSummary:
     """
-    Render inference results obtained using `save_completions`.
+    Render inference results obtained using `save_completions`, read from their `AttentionStore` files.
+
+    The stores are memory-mapped (see `LazyAttentionMatrix`): only the layers and heads being rendered are read into memory.
+    A save prefix which cannot be rendered (e.g. a missing or corrupt store) is recorded as a failure in the returned
+    summary, and does not stop the others from being rendered.
 
     Args:
         render_config: the rendering configuration. See `RenderConfig`.
@@ -136,33 +392,256 @@ def process_saved_completions(
         save_prefixes: the list of save prefixes that have been used for storing inference results
 
         prettify_tokens: indicates whether to remove special characters in tokens, e.g. Ġ. (default `True`)
+
+        workers: the number of worker processes rendering save prefixes in parallel (default `1`, i.e. render in this process)
+
+        max_in_flight: the maximum number of save prefixes submitted to the workers but not yet reported, which bounds
+            the memory held by pending results (default `None`, i.e. twice the number of workers)
+
+        progress: a function called after each save prefix, in the order of `save_prefixes`, with the number of processed
+            save prefixes, their total number, the save prefix, its processing time in seconds, and its error message
+            if it failed (default `None`)
+
+        token_cache_path: the file of the prettified text and layout of the tokens of the completions' tokenizer,
+            e.g. `TokenCache.path_for(directory, model_name)`. The cache is loaded from it if it exists, and saved to it
+            once the tokens of the rendered completions have been added, including those rendered by worker processes
+            (default `None`, i.e. do not persist it)
+
+        render_cache_path: the manifest of the visualizations already rendered (see `RenderCache`). The save prefixes
+            whose visualizations are up to date are skipped, and reported with a processing time of `0` (default `None`,
+            i.e. render every save prefix)
+
+    Returns:
+        the processing times and failures of the save prefixes. See `ProcessingSummary`.
     """
+    assert workers > 0
 
-    renderer = Renderer(
-        render_config=render_config, aggregation_method=aggregation_method
+    summary = ProcessingSummary()
+    token_cache = (
+        TokenCache.load(token_cache_path)
+        if token_cache_path is not None and os.path.exists(token_cache_path)
+        else TokenCache()
     )
 
+    render_cache = None if render_cache_path is None else RenderCache(render_cache_path)
+
+    def plan(save_prefix: str) -> tuple[str, str | None, bool] | None:
+        # The arguments of `_process_saved_completion`, or `None` if the visualizations are up to date
+        if render_cache is None:
+            return save_prefix, None, False
+
+        try:
+            up_to_date, formatted_path, reuse_formatted = render_cache.lookup(
+                save_prefix, render_config, aggregation_method, prettify_tokens
+            )
+        except OSError:  # The missing store is reported when rendering
+            return save_prefix, None, False
+
+        return None if up_to_date else (save_prefix, formatted_path, reuse_formatted)
+
+    def report(result: tuple[str, float, str | None, list[str] | None]) -> None:
+        # Up to date save prefixes have no outputs (`None`)
+        save_prefix, elapsed, error, outputs = result
+        summary.add(save_prefix, elapsed, error, skipped=outputs is None)
+
+        if render_cache is not None and outputs is not None:
+            if error is None:
+                render_cache.add(save_prefix, outputs)
+            else:
+                render_cache.discard(save_prefix)
+
+        if progress is not None:
+            progress(len(summary.timings), len(save_prefixes), *result[:3])
+
+    try:
+        with stage("process_saved_completions", workers=workers):
+            if workers == 1:
+                _process_in_this_process(
+                    Renderer(render_config, aggregation_method, token_cache),
+                    save_prefixes,
+                    prettify_tokens,
+                    plan,
+                    report,
+                )
+            else:
+                # Workers start from the loaded cache, and send the tokens they add back with their results
+                _process_in_workers(
+                    (render_config, aggregation_method, token_cache),
+                    save_prefixes,
+                    prettify_tokens,
+                    workers,
+                    max_in_flight,
+                    plan,
+                    report,
+                )
+    finally:
+        # What has been rendered is not rendered again, even if rendering was interrupted
+        if render_cache is not None:
+            render_cache.save()
+
+    if token_cache_path is not None:
+        token_cache.save(token_cache_path)
+
+    return summary
+
+
+def _process_in_this_process(
+    renderer: Renderer,
+    save_prefixes: list[str],
+    prettify_tokens: bool,
+    plan: Callable[[str], tuple[str, str | None, bool] | None],
+    report: Callable[[tuple[str, float, str | None, list[str] | None]], None],
+) -> None:
+    """
+    Renders saved completions one after the other, in this process. See `process_saved_completions`.
+    """
     for save_prefix in save_prefixes:
+        args = plan(save_prefix)
+        if args is None:
+            report((save_prefix, 0.0, None, None))
+            continue
+
+        with stage("process_saved_completion", save_prefix=save_prefix) as processing:
+            result = _process_saved_completion(
+                renderer, args[0], prettify_tokens, *args[1:]
+            )
+            processing.details["error"] = result[2]
+
+        report(result)
+
+
+def _process_in_workers(
+    worker_args: tuple[RenderConfig, AttentionAggregationMethod, TokenCache],
+    save_prefixes: list[str],
+    prettify_tokens: bool,
+    workers: int,
+    max_in_flight: int | None,
+    plan: Callable[[str], tuple[str, str | None, bool] | None],
+    report: Callable[[tuple[str, float, str | None, list[str] | None]], None],
+) -> None:
+    """
+    Renders saved completions in parallel, in worker processes initialized with `worker_args` (see `_init_worker`).
+    See `process_saved_completions`.
+
+    The stages run by the workers are not instrumented: every save prefix is recorded as a whole, with the processing
+    time measured by its worker. The tokens added to the token caches of the workers are merged into the token cache of
+    `worker_args`.
+    """
+    token_cache = worker_args[2]
+
+    def report_worker_result(
+        worker_result: tuple[
+            tuple[str, float, str | None, list[str] | None], TokenCache | None
+        ],
+    ) -> None:
+        result, added_tokens = worker_result
+        if added_tokens is not None:
+            token_cache.merge(added_tokens)
+
+        if result[3] is not None:
+            record(
+                "process_saved_completion",
+                result[1],
+                save_prefix=result[0],
+                error=result[2],
+            )
+        report(result)
+
+    max_in_flight = 2 * workers if max_in_flight is None else max_in_flight
+    assert max_in_flight > 0
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=worker_args,
+    ) as executor:
+        pending = deque()
+
+        for save_prefix in save_prefixes:
+            if len(pending) == max_in_flight:
+                report_worker_result(pending.popleft().result())
+
+            args = plan(save_prefix)
+            if args is None:
+                # Up to date save prefixes are reported in order, after the ones submitted before them
+                skipped = Future()
+                skipped.set_result(((save_prefix, 0.0, None, None), None))
+                pending.append(skipped)
+            else:
+                pending.append(
+                    executor.submit(
+                        _process_in_worker, args[0], prettify_tokens, *args[1:]
+                    )
+                )
+
+        while pending:
+            report_worker_result(pending.popleft().result())
+
+
+class _CpuUnpickler(pickle.Unpickler):
+    """
+    Unpickles tensors onto the CPU, whatever the device they were pickled on: pickled tensors hold their storages as
+    `torch.save` payloads, tagged with their device, which cannot be restored on a machine without that device.
+    """
+
+    def find_class(self, module: str, name: str):
+        if module == "torch.storage" and name == "_load_from_bytes":
+            return lambda data: torch.load(
+                io.BytesIO(data), map_location="cpu", weights_only=False
+            )
+
+        return super().find_class(module, name)
+
+
+def convert_pickled_completions(
+    save_prefixes: list[str],
+    model_name_or_directory: str | None = None,
+    remove_pickles: bool = False,
+) -> None:
+    """
+    Converts inference results saved as pickle triplets (`_completion_tokens.pickle`, `_attention_matrix.pickle`
+    and `_input_length.pickle`) by previous versions of `save_completions` into `AttentionStore` files.
+
+    Attention matrices are loaded onto the CPU, so that pickles saved from GPU runs can be converted on any machine.
+    Only convert pickles from trusted sources: unpickling can execute arbitrary code.
+
+    Args:
+        save_prefixes: the list of save prefixes that have been used for storing inference results
+
+        model_name_or_directory: the name or directory of the model that generated the completions, recorded in the store (default `None`)
+
+        remove_pickles: whether to delete the pickle files once converted (default `False`)
+    """
+    for save_prefix in save_prefixes:
+        pickle_paths = [
+            f"{save_prefix}_{suffix}.pickle"
+            for suffix in ["completion_tokens", "attention_matrix", "input_length"]
+        ]
+
         with (
-            open(
-                f"{save_prefix}_completion_tokens.pickle", "rb"
-            ) as fp_completion_tokens,
-            open(f"{save_prefix}_attention_matrix.pickle", "rb") as fp_att,
-            open(f"{save_prefix}_input_length.pickle", "rb") as fp_inp_len,
+            open(pickle_paths[0], "rb") as fp_completion_tokens,
+            open(pickle_paths[1], "rb") as fp_att,
+            open(pickle_paths[2], "rb") as fp_inp_len,
         ):
-
             completion_tokens: list[str] = pickle.loads(fp_completion_tokens.read())
-            attention_matrix: AttentionMatrix = pickle.loads(fp_att.read())
+            attention_matrix: AttentionMatrix = _CpuUnpickler(fp_att).load()
             input_length: int = pickle.loads(fp_inp_len.read())
 
-            attention_matrix.format(aggregation_method, True)
-            renderer.render(
-                completion_tokens,
-                input_length,
-                attention_matrix,
-                prettify_tokens,
-                render_in_chunks=(
-                    aggregation_method == AttentionAggregationMethod.NONE
-                ),
-                save_prefix=save_prefix,
-            )
+        assert (
+            not attention_matrix.is_formatted
+        ), f"{pickle_paths[1]} contains a formatted attention matrix"
+
+        AttentionStore.write(
+            AttentionStore.path_for(save_prefix),
+            PackedAttention.from_generate(attention_matrix.attention_matrix),
+            completion_tokens,
+            input_length,
+            model_name=model_name_or_directory,
+        )
+
+        del attention_matrix
+        gc.collect()
+
+        if remove_pickles:
+            for path in pickle_paths:
+                os.remove(path)
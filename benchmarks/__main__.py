@@ -0,0 +1,100 @@
+import argparse
+import itertools
+import json
+
+from .suite import (
+    STAGES,
+    AttentionAggregationMethod,
+    BenchmarkConfig,
+    compare,
+    run_benchmarks,
+)
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Command line entry point of the benchmarks: `python -m benchmarks`, from the repository root.
+
+    Every size option takes one or more values; all of their combinations are benchmarked.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks att_viz on synthetic attention, offline and on the CPU.",
+    )
+    parser.add_argument("--layers", type=int, nargs="+", default=[12])
+    parser.add_argument("--heads", type=int, nargs="+", default=[12])
+    parser.add_argument("--prompt-length", type=int, nargs="+", default=[64])
+    parser.add_argument("--completion-length", type=int, nargs="+", default=[256])
+    parser.add_argument(
+        "--aggregation",
+        choices=[method.name.lower() for method in AttentionAggregationMethod],
+        nargs="+",
+        default=["none"],
+    )
+    parser.add_argument(
+        "--completions",
+        type=int,
+        default=4,
+        help="the number of saved completions of the process_saved_completions stage",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--stages", choices=list(STAGES), nargs="+", default=list(STAGES)
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="the number of runs of every stage; the fastest is reported",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="run every stage in this process (faster, but peak RSS accumulates across stages)",
+    )
+    parser.add_argument("--output", help="the JSON file the results are written to")
+    parser.add_argument(
+        "--compare", help="a JSON file of previous results, to compare against"
+    )
+    args = parser.parse_args(argv)
+
+    configs = [
+        BenchmarkConfig(
+            num_layers=layers,
+            num_heads=heads,
+            prompt_length=prompt_length,
+            completion_length=completion_length,
+            aggregation_method=AttentionAggregationMethod[aggregation.upper()],
+            num_completions=args.completions,
+            workers=args.workers,
+            seed=args.seed,
+        )
+        for layers, heads, prompt_length, completion_length, aggregation in itertools.product(
+            args.layers,
+            args.heads,
+            args.prompt_length,
+            args.completion_length,
+            args.aggregation,
+        )
+    ]
+
+    results = run_benchmarks(
+        configs, args.stages, repeat=args.repeat, isolated=not args.in_process
+    )
+
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+
+        print(f"\nCompared to {args.compare}:")
+        for line in compare(baseline, results):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+import torch
+
+try:
+    from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+    from ..att_viz.attention_matrix import AttentionMatrix
+    from ..att_viz.attention_store import AttentionStore
+    from ..att_viz.instrumentation import _peak_rss
+    from ..att_viz.packed_attention import PackedAttention
+    from ..att_viz.renderer import RenderConfig, Renderer
+    from ..att_viz.utils import process_saved_completions
+    from .. import post_processing
+except ImportError:  # Run as `python -m benchmarks`, from the repository root
+    from att_viz.attention_aggregation_method import AttentionAggregationMethod
+    from att_viz.attention_matrix import AttentionMatrix
+    from att_viz.attention_store import AttentionStore
+    from att_viz.instrumentation import _peak_rss
+    from att_viz.packed_attention import PackedAttention
+    from att_viz.renderer import RenderConfig, Renderer
+    from att_viz.utils import process_saved_completions
+    import post_processing
+from .synthetic import synthetic_attentions, synthetic_tokens
+
+
+class BenchmarkConfig:
+    """
+    The size of the synthetic completions of a benchmark run, and how they are processed.
+    """
+
+    def __init__(
+        self,
+        num_layers: int = 12,
+        num_heads: int = 12,
+        prompt_length: int = 64,
+        completion_length: int = 256,
+        aggregation_method: AttentionAggregationMethod = AttentionAggregationMethod.NONE,
+        num_completions: int = 4,
+        workers: int = 1,
+        seed: int = 0,
+    ):
+        """
+        `BenchmarkConfig` constructor.
+
+        Args:
+            num_layers: the number of layers of the synthetic model (default `12`)
+
+            num_heads: the number of heads per layer (default `12`)
+
+            prompt_length: the length of the prompt in tokens (default `64`)
+
+            completion_length: the number of generated tokens (default `256`)
+
+            aggregation_method: the aggregation method of the attention matrix. See `AttentionAggregationMethod`.
+
+            num_completions: the number of saved completions rendered by `process_saved_completions` (default `4`)
+
+            workers: the number of worker processes of `process_saved_completions` (default `1`)
+
+            seed: the seed of the synthetic attention and tokens (default `0`)
+        """
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.prompt_length = prompt_length
+        self.completion_length = completion_length
+        self.aggregation_method = aggregation_method
+        self.num_completions = num_completions
+        self.workers = workers
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            the configuration, as a JSON-serializable dictionary
+        """
+        return {
+            **vars(self),
+            "aggregation_method": self.aggregation_method.name,
+        }
+
+    def __repr__(self):
+        """
+        Debugging string representation of `BenchmarkConfig`
+        """
+        return (
+            f"BenchmarkConfig ({self.num_layers} layer(s), {self.num_heads} head(s), {self.prompt_length} prompt "
+            f"token(s), {self.completion_length} completion token(s), {self.aggregation_method.name})"
+        )
+
+    def __str__(self):
+        """
+        Regular string representation of `BenchmarkConfig`
+        """
+        return self.__repr__()
+
+
+def _tokens(config: BenchmarkConfig) -> list[str]:
+    """The prompt and completion tokens of the synthetic completion."""
+    return synthetic_tokens(
+        config.prompt_length + config.completion_length, config.seed
+    )
+
+
+def _attentions(config: BenchmarkConfig, seed_offset: int = 0) -> tuple:
+    """The attention tuple of a synthetic completion."""
+    return synthetic_attentions(
+        config.num_layers,
+        config.num_heads,
+        config.prompt_length,
+        config.completion_length,
+        seed=config.seed + seed_offset,
+    )
+
+
+def _formatted_matrix(config: BenchmarkConfig) -> AttentionMatrix:
+    """The formatted attention matrix of the synthetic completion."""
+    attention_matrix = AttentionMatrix(_attentions(config))
+    attention_matrix.format(config.aggregation_method, zero_first_attention=True)
+    return attention_matrix
+
+
+def _renderer(config: BenchmarkConfig) -> Renderer:
+    """The renderer of the benchmarks."""
+    return Renderer(RenderConfig(), config.aggregation_method)
+
+
+def _output_bytes(workdir: str, prefix: str) -> int:
+    """The total size of the files written with a save prefix."""
+    return sum(
+        entry.stat().st_size
+        for entry in os.scandir(workdir)
+        if entry.name.startswith(prefix) and entry.name.endswith((".html", ".js"))
+    )
+
+
+# Every stage is a pair of functions: the first prepares its inputs (untimed), the second runs the measured
+# operation on them, and returns the number of bytes it produced
+def _setup_format(config, workdir):
+    return _attentions(config)
+
+
+def _run_format(config, workdir, attentions):
+    attention_matrix = AttentionMatrix(attentions)
+    attention_matrix.format(config.aggregation_method, zero_first_attention=True)
+    return attention_matrix.attention_matrix.nbytes
+
+
+def _setup_token_info(config, workdir):
+    return _tokens(config)
+
+
+def _run_token_info(config, workdir, tokens):
+    token_info, _ = _renderer(config).create_token_info(tokens, config.prompt_length)
+    return len(json.dumps(token_info))
+
+
+def _setup_make_htmls(config, workdir):
+    return _tokens(config), _formatted_matrix(config)
+
+
+def _run_make_htmls(config, workdir, inputs):
+    tokens, attention_matrix = inputs
+    htmls = _renderer(config)._make_htmls(
+        tokens, config.prompt_length, attention_matrix
+    )
+    return sum(len(html["html"].data.encode("UTF-8")) for html in htmls)
+
+
+def _run_render(config, workdir, inputs):
+    tokens, attention_matrix = inputs
+    _renderer(config).render(
+        tokens,
+        config.prompt_length,
+        attention_matrix,
+        save_prefix=os.path.join(workdir, "render_"),
+    )
+    return _output_bytes(workdir, "render_")
+
+
+def _setup_process_saved_completions(config, workdir):
+    save_prefixes = []
+    for i in range(config.num_completions):
+        save_prefix = os.path.join(workdir, f"completion_{i}")
+        AttentionStore.write(
+            AttentionStore.path_for(save_prefix),
+            PackedAttention.from_generate(_attentions(config, i)),
+            _tokens(config),
+            config.prompt_length,
+        )
+        save_prefixes.append(save_prefix)
+
+    return save_prefixes
+
+
+def _run_process_saved_completions(config, workdir, save_prefixes):
+    summary = process_saved_completions(
+        RenderConfig(),
+        config.aggregation_method,
+        save_prefixes,
+        workers=config.workers,
+    )
+    assert not summary.failures, summary.failures
+    return _output_bytes(workdir, "completion_")
+
+
+def _setup_post_processing(config, workdir):
+    # A single HTML file holding every layer, as reprocessed by `post_processing.py`
+    save_prefix = os.path.join(workdir, "unchunked_")
+    _renderer(config).render(
+        _tokens(config),
+        config.prompt_length,
+        _formatted_matrix(config),
+        render_in_chunks=False,
+        save_prefix=save_prefix,
+    )
+    return f"{save_prefix}.html"
+
+
+def _run_post_processing(config, workdir, html_path):
+    output_path = post_processing.reprocess_html_file(
+        html_path, os.path.join(workdir, "reprocessed.html")
+    )
+    return os.path.getsize(output_path)
+
+
+STAGES = {
+    "format": (_setup_format, _run_format),
+    "token_info": (_setup_token_info, _run_token_info),
+    "make_htmls": (_setup_make_htmls, _run_make_htmls),
+    "render": (_setup_make_htmls, _run_render),
+    "process_saved_completions": (
+        _setup_process_saved_completions,
+        _run_process_saved_completions,
+    ),
+    "post_processing": (_setup_post_processing, _run_post_processing),
+}
+""" The benchmarked stages: `AttentionMatrix.format`, `Renderer.create_token_info`, `Renderer._make_htmls`,
+`Renderer.render`, `process_saved_completions` and `post_processing.reprocess_html_file`. """
+
+
+def run_stage(stage: str, config: BenchmarkConfig) -> dict:
+    """
+    Runs a stage once, in this process, in a temporary directory.
+
+    Args:
+        stage: the name of the stage (see `STAGES`)
+
+        config: the size of the synthetic completions
+
+    Returns:
+        the measurements: wall time in seconds, peak RSS before and after the stage (`None` where it cannot be
+        measured, e.g. on Windows), and output bytes
+    """
+    setup, run = STAGES[stage]
+
+    with tempfile.TemporaryDirectory(prefix="att_viz_bench_") as workdir:
+        inputs = setup(config, workdir)
+        rss_before = _peak_rss()
+
+        start = time.perf_counter()
+        output_bytes = run(config, workdir, inputs)
+        seconds = time.perf_counter() - start
+
+        return {
+            "stage": stage,
+            "seconds": seconds,
+            "peak_rss_bytes": _peak_rss(),
+            "setup_peak_rss_bytes": rss_before,
+            "output_bytes": output_bytes,
+        }
+
+
+def _run_stage_in_child(stage: str, config: BenchmarkConfig, results) -> None:
+    """Runs a stage in a benchmark child process, and sends its measurements to the parent."""
+    results.put(run_stage(stage, config))
+
+
+def run_isolated(stage: str, config: BenchmarkConfig) -> dict:
+    """
+    Runs a stage once, in a new process, so that its peak RSS is not inflated by the previous stages.
+
+    Args:
+        stage: the name of the stage (see `STAGES`)
+
+        config: the size of the synthetic completions
+
+    Returns:
+        the measurements of the stage (see `run_stage`)
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+
+    process = context.Process(target=_run_stage_in_child, args=(stage, config, results))
+    process.start()
+    process.join()
+
+    if process.exitcode != 0:
+        raise RuntimeError(
+            f"The {stage} benchmark failed (exit code {process.exitcode})"
+        )
+    return results.get()
+
+
+def run_benchmarks(
+    configs: list[BenchmarkConfig],
+    stages: list[str] | None = None,
+    repeat: int = 1,
+    isolated: bool = True,
+    progress=print,
+) -> dict:
+    """
+    Runs the benchmark stages for every configuration.
+
+    Args:
+        configs: the sizes of the synthetic completions
+
+        stages: the names of the stages to run (default `None`, i.e. all `STAGES`)
+
+        repeat: the number of runs of every stage; the fastest is reported, with the times of all runs (default `1`)
+
+        isolated: indicates whether to run every stage in a new process, for accurate peak RSS (default `True`)
+
+        progress: called with a line of text after every stage (default `print`; `None` to report nothing)
+
+    Returns:
+        the results, as a JSON-serializable dictionary: the environment, and the measurements of every stage
+    """
+    stages = list(STAGES) if stages is None else stages
+    results = []
+
+    for config in configs:
+        for stage in stages:
+            runs = [
+                (run_isolated if isolated else run_stage)(stage, config)
+                for _ in range(repeat)
+            ]
+            best = min(runs, key=lambda run: run["seconds"])
+            result = {
+                **best,
+                "config": config.to_dict(),
+                "all_seconds": [run["seconds"] for run in runs],
+            }
+            results.append(result)
+
+            if progress is not None:
+                progress(format_result(result))
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def _key(result: dict) -> tuple:
+    """Identifies the stage and configuration of a result."""
+    return result["stage"], json.dumps(result["config"], sort_keys=True)
+
+
+def _size(config: dict) -> str:
+    """A short description of a configuration."""
+    return (
+        f"L={config['num_layers']} H={config['num_heads']} P={config['prompt_length']} "
+        f"C={config['completion_length']} {config['aggregation_method'].lower()}"
+    )
+
+
+def format_result(result: dict) -> str:
+    """
+    Args:
+        result: the measurements of a stage (see `run_benchmarks`)
+
+    Returns:
+        a one-line summary of the measurements
+    """
+    peak_rss = (
+        f"{'n/a':>9}"
+        if result["peak_rss_bytes"] is None
+        else f"{result['peak_rss_bytes'] / 2**20:9.1f}"
+    )
+    return (
+        f"{result['stage']:<26} {_size(result['config']):<40} {result['seconds']:9.3f} s "
+        f"{peak_rss} MiB {result['output_bytes'] / 2**20:9.2f} MiB out"
+    )
+
+
+def compare(baseline: dict, current: dict) -> list[str]:
+    """
+    Compares two benchmark runs, stage by stage.
+
+    Args:
+        baseline: the results of the reference run (see `run_benchmarks`)
+
+        current: the results of the new run
+
+    Returns:
+        one line per stage and configuration of both runs, with the time, peak RSS and output size ratios
+    """
+    previous = {_key(result): result for result in baseline["results"]}
+    lines = []
+
+    for result in current["results"]:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+
+        ratios = [
+            (
+                result[metric] / old[metric]
+                if old[metric] and result[metric] is not None
+                else float("nan")
+            )
+            for metric in ("seconds", "peak_rss_bytes", "output_bytes")
+        ]
+        lines.append(
+            f"{result['stage']:<26} {_size(result['config']):<40} time x{ratios[0]:.2f}  "
+            f"peak RSS x{ratios[1]:.2f}  output x{ratios[2]:.2f}"
+        )
+
+    return lines
@@ -0,0 +1,92 @@
+import random
+import torch
+
+
+def synthetic_attentions(
+    num_layers: int,
+    num_heads: int,
+    prompt_length: int,
+    completion_length: int,
+    dtype: torch.dtype = torch.float32,
+    seed: int = 0,
+) -> tuple:
+    """
+    Generates a random attention tuple shaped like the `attentions` returned by a model's `generate` method.
+
+    The first step holds the causal attention of the whole prompt (`1 x num_heads x prompt_length x prompt_length`),
+    every following step the attention row of its new token (`1 x num_heads x 1 x seq_len`). Rows are softmax
+    distributions, as in a real model.
+
+    Args:
+        num_layers: the number of layers
+
+        num_heads: the number of heads per layer
+
+        prompt_length: the length of the prompt in tokens
+
+        completion_length: the number of generated tokens (decoding steps)
+
+        dtype: the dtype of the attention values (default `torch.float32`)
+
+        seed: the seed of the random values (default `0`)
+
+    Returns:
+        the attention tuple: `completion_length x num_layers` tensors
+    """
+    generator = torch.Generator().manual_seed(seed)
+    causal_mask = torch.ones(prompt_length, prompt_length).triu(1).bool()
+
+    attentions = []
+    for step in range(completion_length):
+        num_queries = prompt_length if step == 0 else 1
+        seq_len = prompt_length + step
+
+        layers = []
+        for _ in range(num_layers):
+            scores = torch.randn(
+                (1, num_heads, num_queries, seq_len), generator=generator
+            )
+            if step == 0:
+                scores.masked_fill_(causal_mask, float("-inf"))
+            layers.append(torch.softmax(scores * 2, dim=-1).to(dtype))
+
+        attentions.append(tuple(layers))
+
+    return tuple(attentions)
+
+
+# Mostly short words, as produced by BPE tokenizers, with some punctuation and line breaks
+_VOCABULARY = [
+    " the",
+    " of",
+    " and",
+    " attention",
+    " model",
+    "ization",
+    " token",
+    "s",
+    ",",
+    ".",
+    "\n",
+    " visualization",
+    "Ġhead",
+    " layer",
+    " a",
+    " is",
+]
+
+
+def synthetic_tokens(num_tokens: int, seed: int = 0) -> list[str]:
+    """
+    Generates random tokens, as returned by a tokenizer.
+
+    Args:
+        num_tokens: the number of tokens
+
+        seed: the seed of the random tokens (default `0`)
+
+    Returns:
+        the tokens
+    """
+    rng = random.Random(seed)
+    return [rng.choice(_VOCABULARY) for _ in range(num_tokens)]
@@ -1,74 +1,198 @@
 import click
-from tqdm import trange
+from tqdm import tqdm
 import numpy as np
-import codecs, json 
+import torch
+import json
+import re
+from itertools import chain
 from pathlib import Path
 
+try:
+	from .att_viz.attention_aggregation_method import AttentionAggregationMethod
+	from .att_viz.attention_matrix import LazyAttentionMatrix
+	from .att_viz.attention_reprocessing import AttentionReprocessing
+	from .att_viz.attention_store import AttentionStore
+	from .att_viz.packed_attention import PackedAttention
+	from .att_viz.renderer import RenderConfig, Renderer
+except ImportError:  # Run as a script, from the repository root
+	from att_viz.attention_aggregation_method import AttentionAggregationMethod
+	from att_viz.attention_matrix import LazyAttentionMatrix
+	from att_viz.attention_reprocessing import AttentionReprocessing
+	from att_viz.attention_store import AttentionStore
+	from att_viz.packed_attention import PackedAttention
+	from att_viz.renderer import RenderConfig, Renderer
+
+
+# Brackets of the nested attention lists
+_BRACKETS = re.compile(r'[\[\]]')
+
+
+def reprocess_layer(layer_table, cutoff=0.5, corrfactor=1./3., firstignored=1):
+	'''
+	Reprocesses the attention of all heads of a layer at once (see `reprocess_attention`).
+
+	The ragged rows (`num_heads x num_response_tokens x {varying}`) are packed into a single tensor (see `PackedAttention`),
+	so that the statistics, the filter and the power are computed for whole layers instead of value by value.
+	'''
+	num_heads = len(layer_table)
+	if num_heads == 0:
+		return []
+
+	lengths = torch.tensor([len(row) for row in layer_table[0]], dtype=torch.long)
+	values = np.fromiter(chain.from_iterable(chain.from_iterable(layer_table)), float, num_heads * int(lengths.sum()))
+
+	packed = PackedAttention(torch.from_numpy(values).view(num_heads, -1), PackedAttention.offsets_from_lengths(lengths))
+	return AttentionReprocessing(cutoff, corrfactor, firstignored).apply(packed).tolist()
+
+
+def reprocess_attention(base_table, cutoff=0.5, corrfactor=1./3., firstignored=1, progress=False):
+	'''
+	Improves weigths visualization interpretability by only keeping values with more than <cutoff> times standard deviations above
+	mean (looking at only the prompt tokens after the first <firstignored> ones), and passing all the weights to the power of <corrfactor>.
+	The first <firstignored> tokens of every row have their attention set to zero (see `AttentionReprocessing`).
+
+	`base_table` is the attention of a visualization (`num_layers x num_heads x num_response_tokens x {varying}` nested lists),
+	which is reprocessed one layer at a time. Returns the reprocessed nested lists.
+	'''
+	layers = tqdm(base_table) if progress else base_table
+	return [reprocess_layer(layer_table, cutoff, corrfactor, firstignored) for layer_table in layers]
+
+
+def _copy_until(chunks, outfile, marker):
+	'''
+	Copies text from <chunks> to <outfile> up to and including the first occurrence of <marker>.
+	Returns the rest of the chunk holding the marker, or `None` if the marker was not found.
+	'''
+	tail = ''
+	for chunk in chunks:
+		text = tail + chunk
+		idx = text.find(marker)
+		if idx >= 0:
+			outfile.write(text[:idx + len(marker)])
+			return text[idx + len(marker):]
+
+		# Keep the end of the text, in case the marker spans two chunks
+		keep = min(len(text), len(marker) - 1)
+		outfile.write(text[:len(text) - keep])
+		tail = text[len(text) - keep:]
+
+	outfile.write(tail)
+	return None
+
+
+def _reprocess_stream(chunks, outfile, cutoff, corrfactor, firstignored, progress=None):
+	'''
+	Copies the nested attention lists of a payload from <chunks> to <outfile>, reprocessing them one layer at a time.
+	Returns the rest of the chunk holding the end of the attention lists.
+	'''
+	depth = 0
+	layer = []  # The text of the current layer
+
+	for chunk in chunks:
+		if depth == 0 and chunk.strip():
+			if not chunk.lstrip().startswith('['):
+				raise ValueError('Only JSON-encoded attention can be reprocessed')
+
+		start = 0  # The start of the text which has been neither copied nor buffered
+		for match in _BRACKETS.finditer(chunk):
+			idx = match.start()
+			if match.group() == '[':
+				depth += 1
+				if depth == 2:  # A layer starts
+					outfile.write(chunk[start:idx])
+					start = idx
+			else:
+				depth -= 1
+				if depth == 1:  # A layer ends
+					layer.append(chunk[start:idx + 1])
+					start = idx + 1
+
+					layer_table = json.loads(''.join(layer))
+					layer = []
+					outfile.write(json.dumps(reprocess_layer(layer_table, cutoff, corrfactor, firstignored)))
+					if progress is not None:
+						progress.update()
+				elif depth == 0:  # The attention lists end
+					outfile.write(chunk[start:idx + 1])
+					return chunk[idx + 1:]
+
+		if depth >= 2:
+			layer.append(chunk[start:])
+		else:
+			outfile.write(chunk[start:])
+
+	raise ValueError('The attention payload is truncated')
+
+
+def reprocess_html_file(infilepath, outfilepath=None, cutoff=0.5, corrfactor=1./3., firstignored=1, progress=False, chunk_size=1 << 20):
+	'''
+	Reprocesses the attention payload of an HTML visualization (see `reprocess_attention`), and writes the result to
+	<outfilepath> (by default, <infilepath stem>_reprocessed<suffix> in the current directory). Returns the output path.
+
+	The file is streamed in chunks of <chunk_size> characters: the payload is never parsed as a whole, only one layer
+	of attention is held in memory at a time, and everything but the attention values is copied unchanged.
+	Only JSON-encoded attention can be reprocessed (the default `AttentionEncoding.JSON`).
+	'''
+	infilepath = Path(infilepath)
+	if outfilepath is None:
+		outfilepath = infilepath.stem + '_reprocessed' + infilepath.suffix
+
+	with open(infilepath, 'rt') as infile, open(outfilepath, 'wt') as outfile:
+		chunks = iter(lambda: infile.read(chunk_size), '')
+
+		rest = _copy_until(chunks, outfile, '"attn": ')
+		if rest is not None:
+			with tqdm(unit=' layers', disable=not progress) as layers:
+				rest = _reprocess_stream(chain([rest], chunks), outfile, cutoff, corrfactor, firstignored, layers)
+			outfile.write(rest)
+
+		for chunk in chunks:
+			outfile.write(chunk)
+
+	return outfilepath
+
+
+def reprocess_store(save_prefix, output_prefix=None, cutoff=0.5, corrfactor=1./3., firstignored=1,
+	aggregation_method=AttentionAggregationMethod.NONE, render_config=None, prettify_tokens=True):
+	'''
+	Renders a completion saved by `save_completions` with reprocessed attention (see `AttentionReprocessing`), read from its
+	`AttentionStore` file: no HTML is parsed, and only the layers being rendered are held in memory.
+	The visualizations are saved with <output_prefix> (by default, <save_prefix>_reprocessed).
+	'''
+	if output_prefix is None:
+		output_prefix = save_prefix + '_reprocessed'
+
+	store = AttentionStore(AttentionStore.path_for(save_prefix))
+	attention_matrix = LazyAttentionMatrix(store)
+	attention_matrix.format(aggregation_method, True, reprocessing=AttentionReprocessing(cutoff, corrfactor, firstignored))
+
+	renderer = Renderer(render_config if render_config is not None else RenderConfig(), aggregation_method)
+	renderer.render(
+		store.tokens,
+		store.prompt_length,
+		attention_matrix,
+		prettify_tokens,
+		render_in_chunks=not aggregation_method.collapses_heads,
+		save_prefix=output_prefix,
+	)
+
 
 @click.command()
 @click.option('--cutoff', default=0.5, help='sigmas')
 @click.option('--corrfactor', default=1./3., help='factor to renormalize attention weights (lower is stronger)')
 @click.option('--firstignored', default=1, help='first tokens to ignore')
+@click.option('--store', is_flag=True, help='INFILEPATH is a save prefix: re-render from its attention store instead of reprocessing an HTML file')
 @click.argument('infilepath')
-def reprocess_html(infilepath, cutoff, corrfactor, firstignored):
+def reprocess_html(infilepath, cutoff, corrfactor, firstignored, store):
 	'''
 	Improves weigths visualization interpretability by only visualizing tokens with more than <cutoff> times standard deviations above 
 	mean (looking at only the prompt tokens after the first <firstignored> ones), and passing all the weightst to the power of <corrfactor>. Given the problems with shallow initialization, attention for shorter
 	prompts tend to focus on the first tokens, the first <firstignored> tokens  in the prompt will have thier attention set to zero
 	'''
-
-	infilepath = Path(infilepath)
-	outfilepath = infilepath.stem + '_reprocessed' + infilepath.suffix
-
-
-	with open(infilepath, 'rt') as infile, open(outfilepath, 'wt') as outfile:
-	    for line in infile:
-	    	if 'const params' in line:
-	    		print("payload line characters: %d" % len(line))
-	    		
-	    		start_idx = line.find('{')
-	    		end_idx = line.find('; // HACK')
-
-	    		json_isolate = line[start_idx:end_idx]
-	    		payload_dict = json.loads(json_isolate)
-
-	    		base_table = payload_dict['attention']['attn']
-	    		corrected_table = []
-	    		
-	    		for _i in trange(len(base_table)):
-	    			corrected_lvl_1 = []
-	    		
-	    			for _j in trange(len(base_table[_i]), leave=False):
-
-	    				corrected_lvl_2 = []
-	    				min_len = 2
-	    				for _k in trange(len(base_table[_i][_j]), leave=False):	
-
-	    					if min_len == 2:
-		    					min_len = len(base_table[_i][_j][_k])
-
-
-	    					base_table[_i][_j][_k][:firstignored] = 0
-	    					arr = np.array(base_table[_i][_j][_k])
-	    					std = np.std(arr[firstignored:min_len])
-	    					mean = np.mean(arr[firstignored:min_len])
-	    					keep_mask = arr > mean + cutoff * std
-
-	    					keep_mask = keep_mask.tolist()
-	    					corrected_lvl_3 = [float(_base_float)**corrfactor if keep_mask[i] else 0 for i, _base_float in enumerate(base_table[_i][_j][_k])]
-	    		
-	    					corrected_lvl_2.append(corrected_lvl_3)
-	    				corrected_lvl_1.append(corrected_lvl_2)
-	    			corrected_table.append(corrected_lvl_1)
-
-	    		payload_dict['attention']['attn'] = corrected_table
-
-	    		new_text = json.dumps(payload_dict)
-	    		new_line = line[:start_idx] + new_text + line[end_idx:]
-
-	    		outfile.write(new_line)
-	    	else:
-	    		outfile.write(line)
+	if store:
+		reprocess_store(infilepath, cutoff=cutoff, corrfactor=corrfactor, firstignored=firstignored)
+	else:
+		reprocess_html_file(infilepath, cutoff=cutoff, corrfactor=corrfactor, firstignored=firstignored, progress=True)
 
 
 if __name__ == "__main__":
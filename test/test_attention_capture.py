@@ -0,0 +1,312 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_capture import AttentionCapture
+from ..att_viz.attention_matrix import LazyAttentionMatrix
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
+from ..att_viz.self_attention_model import SelfAttentionModel
+
+
+def get_tiny_model():
+    """Builds a small randomly initialized model, without downloading anything."""
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    config._attn_implementation = "eager"
+
+    return LlamaForCausalLM(config).eval()
+
+
+def generate(model, model_input, **kwargs):
+    return model.generate(
+        model_input,
+        max_new_tokens=6,
+        min_new_tokens=6,
+        do_sample=False,
+        output_attentions=True,
+        pad_token_id=0,
+        **kwargs,
+    )
+
+
+def test_capture_matches_returned_attentions():
+    model = get_tiny_model()
+    model_input = torch.tensor([[1, 2, 3, 4, 5]])
+
+    expected = PackedAttention.from_generate(
+        generate(model, model_input, return_dict_in_generate=True)["attentions"]
+    )
+
+    with AttentionCapture(model, 5, 6) as capture:
+        sequences = generate(model, model_input, return_dict_in_generate=False)
+
+    attention_matrix = capture.close([str(t) for t in sequences[0].tolist()])
+
+    assert (attention_matrix.num_layers, attention_matrix.num_heads) == (3, 4)
+    assert torch.equal(
+        attention_matrix.attention_matrix.row_offsets, expected.row_offsets
+    )
+    assert torch.allclose(attention_matrix.attention_matrix.data, expected.data)
+
+    # The hook has been removed
+    assert not model._forward_hooks
+
+
+def test_capture_to_store_with_downcasting(tmp_path):
+    model = get_tiny_model()
+    model_input = torch.tensor([[1, 2, 3, 4, 5]])
+    path = str(tmp_path / "example_attention.attviz")
+
+    expected = PackedAttention.from_generate(
+        generate(model, model_input, return_dict_in_generate=True)["attentions"]
+    )
+
+    # Generating fewer tokens than the capacity leaves room that is compacted away
+    with AttentionCapture(
+        model, 5, 10, dtype=torch.float16, store_path=path
+    ) as capture:
+        sequences = generate(model, model_input, return_dict_in_generate=False)
+
+    tokens = [str(t) for t in sequences[0].tolist()]
+    attention_matrix = capture.close(tokens, model_name="tiny")
+
+    assert isinstance(attention_matrix, LazyAttentionMatrix)
+
+    store = AttentionStore(path)
+
+    assert store.tokens == tokens
+    assert store.prompt_length == 5
+    assert store.dtype == torch.float16
+    assert torch.equal(store.row_offsets, expected.row_offsets)
+    assert torch.allclose(store.read().data.float(), expected.data, atol=1e-3)
+
+
+class MockTokenizer:
+    def encode(self, *args, **kwargs):
+        return torch.tensor([[1, 2, 3, 4, 5]])
+
+    def convert_ids_to_tokens(self, ids):
+        return [str(i) for i in ids.tolist()]
+
+
+def test_generate_text_streaming(mocker, tmp_path):
+    model = get_tiny_model()
+    model.generation_config.pad_token_id = 0
+    mocker.patch.object(
+        SelfAttentionModel, "load_model", return_value=(model, MockTokenizer())
+    )
+    m = SelfAttentionModel("tiny")
+
+    tokens, expected, prompt_length = m.generate_text(
+        "Hello", 6, prompt_template=None, min_new_tokens=6
+    )
+    expected.format(AttentionAggregationMethod.NONE, False)
+
+    save_prefix = str(tmp_path / "example")
+    streamed_tokens, streamed, streamed_prompt_length = m.generate_text(
+        "Hello",
+        6,
+        save_prefix=save_prefix,
+        prompt_template=None,
+        stream_attention=True,
+        min_new_tokens=6,
+    )
+    streamed.format(AttentionAggregationMethod.NONE, False)
+
+    assert streamed_tokens == tokens
+    assert streamed_prompt_length == prompt_length == 5
+    assert torch.allclose(streamed.get_slice().data, expected.get_slice().data)
+    assert AttentionStore(AttentionStore.path_for(save_prefix)).model_name == "tiny"
+
+
+@pytest.mark.parametrize("stream_attention", [False, True])
+def test_generate_arguments_set_by_att_viz_are_checked(
+    mocker, tmp_path, stream_attention
+):
+    model = get_tiny_model()
+    model.generation_config.pad_token_id = 0
+    mocker.patch.object(
+        SelfAttentionModel, "load_model", return_value=(model, MockTokenizer())
+    )
+    m = SelfAttentionModel("tiny")
+
+    def generate_text(**kwargs):
+        return m.generate_text(
+            "Hello",
+            2,
+            save_prefix=str(tmp_path / "example"),
+            prompt_template=None,
+            stream_attention=stream_attention,
+            **kwargs,
+        )
+
+    for kwargs in [
+        {"return_dict_in_generate": True},
+        {"return_dict_in_generate": False},
+        {"output_attentions": False},
+    ]:
+        with pytest.raises(ValueError, match=next(iter(kwargs))):
+            generate_text(**kwargs)
+        with pytest.raises(ValueError, match=next(iter(kwargs))):
+            m.generate_batch(["Hi", "Hello"], 2, prompt_template=None, **kwargs)
+    assert not list(tmp_path.iterdir())
+
+    tokens, attention_matrix, _ = generate_text(output_attentions=True)
+    assert len(tokens) == 7 and attention_matrix.num_layers == 3
+
+
+def test_capture_selected_layers_and_heads(tmp_path):
+    model = get_tiny_model()
+    model_input = torch.tensor([[1, 2, 3, 4, 5]])
+    path = str(tmp_path / "example_attention.attviz")
+
+    expected = PackedAttention.from_generate(
+        generate(model, model_input, return_dict_in_generate=True)["attentions"],
+        layers=[2],
+        heads=[1, 3],
+    )
+
+    with AttentionCapture(
+        model, 5, 6, store_path=path, layers=[2], heads=[1, 3]
+    ) as capture:
+        sequences = generate(model, model_input, return_dict_in_generate=False)
+
+    attention_matrix = capture.close([str(t) for t in sequences[0].tolist()])
+
+    assert attention_matrix.layer_indices == [2]
+    assert attention_matrix.head_indices == [1, 3]
+    assert (attention_matrix.num_layers, attention_matrix.num_heads) == (1, 2)
+
+    store = AttentionStore(path)
+
+    assert store.layer_indices == [2]
+    assert store.head_indices == [1, 3]
+    assert torch.allclose(store.read().data, expected.data)
+
+
+@pytest.mark.parametrize("stream_attention", [False, True])
+def test_generate_text_keeps_only_selected_layers_and_heads(
+    mocker, tmp_path, stream_attention
+):
+    model = get_tiny_model()
+    model.generation_config.pad_token_id = 0
+    mocker.patch.object(
+        SelfAttentionModel, "load_model", return_value=(model, MockTokenizer())
+    )
+    m = SelfAttentionModel("tiny")
+
+    _, full, _ = m.generate_text("Hello", 6, prompt_template=None, min_new_tokens=6)
+    expected = PackedAttention.from_generate(
+        full.attention_matrix, layers=[2], heads=[1, 3]
+    )
+
+    save_prefix = str(tmp_path / "example")
+    _, selected, _ = m.generate_text(
+        "Hello",
+        6,
+        save_prefix=save_prefix,
+        prompt_template=None,
+        stream_attention=stream_attention,
+        layers=[2],
+        heads=[1, 3],
+        min_new_tokens=6,
+    )
+
+    # The attention of the other layers and heads is not held by the returned matrix
+    assert isinstance(selected.attention_matrix, PackedAttention)
+    assert selected.attention_matrix.data.shape == expected.data.shape
+    assert torch.allclose(selected.attention_matrix.data, expected.data)
+    assert (selected.layer_indices, selected.head_indices) == ([2], [1, 3])
+
+    selected.format(AttentionAggregationMethod.NONE, False)
+    assert torch.allclose(selected.get_slice().data, expected.data)
+
+    store = AttentionStore(AttentionStore.path_for(save_prefix))
+    assert (store.layer_indices, store.head_indices) == ([2], [1, 3])
+    assert torch.allclose(store.read().data, expected.data)
+
+
+class PromptTokenizer:
+    """Encodes each character of a prompt as one token, so that prompts have different lengths."""
+
+    pad_token_id = 0
+    eos_token_id = None
+
+    def encode(self, text, *args, **kwargs):
+        ids = [1 + ord(c) % 63 for c in text]
+        return torch.tensor([ids]) if kwargs.get("return_tensors") else ids
+
+    def convert_ids_to_tokens(self, ids):
+        return [str(i) for i in ids.tolist()]
+
+
+def test_generate_batch_matches_generate_text(mocker, tmp_path):
+    model = get_tiny_model()
+    mocker.patch.object(
+        SelfAttentionModel, "load_model", return_value=(model, PromptTokenizer())
+    )
+    m = SelfAttentionModel("tiny")
+    prompts = ["Hi", "Hello there"]
+
+    # End the first sequence early, while the other one keeps generating
+    first, second = [
+        m.generate_text(prompt, 6, prompt_template=None, pad_token_id=0)[0][
+            len(prompt) :
+        ]
+        for prompt in prompts
+    ]
+    model.generation_config.eos_token_id = next(
+        int(token) for token in first[1:] if token not in second
+    )
+
+    expected = [
+        m.generate_text(prompt, 6, prompt_template=None, pad_token_id=0)
+        for prompt in prompts
+    ]
+    save_prefixes = [str(tmp_path / "first"), str(tmp_path / "second")]
+    batched = m.generate_batch(prompts, 6, save_prefixes, prompt_template=None)
+
+    assert len(expected[0][0]) - len(prompts[0]) < 6
+    assert len(expected[1][0]) - len(prompts[1]) == 6
+
+    for (tokens, attention, length), (b_tokens, b_attention, b_length) in zip(
+        expected, batched
+    ):
+        attention.format(AttentionAggregationMethod.NONE, False)
+        b_attention.format(AttentionAggregationMethod.NONE, False)
+
+        assert b_tokens == tokens
+        assert b_length == length
+        assert torch.equal(
+            b_attention.attention_matrix.row_offsets,
+            attention.attention_matrix.row_offsets,
+        )
+        assert torch.allclose(
+            b_attention.get_slice().data, attention.get_slice().data, atol=1e-5
+        )
+
+
+def test_estimate_batch_size(mocker):
+    mocker.patch.object(
+        SelfAttentionModel,
+        "load_model",
+        return_value=(get_tiny_model(), PromptTokenizer()),
+    )
+    m = SelfAttentionModel("tiny")
+
+    mocker.patch.object(SelfAttentionModel, "_available_memory", return_value=None)
+    assert m.estimate_batch_size(["a", "b", "c"], 6, prompt_template=None) == 1
+
+    mocker.patch.object(SelfAttentionModel, "_available_memory", return_value=2**30)
+    assert m.estimate_batch_size(["a", "b", "c"], 6, prompt_template=None) == 3
+
+    mocker.patch.object(SelfAttentionModel, "_available_memory", return_value=2**10)
+    assert m.estimate_batch_size(["a", "b", "c"], 6, prompt_template=None) == 1
@@ -3,7 +3,9 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 import gc
 from copy import deepcopy
 from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
-from ..att_viz.attention_matrix import AttentionMatrix
+from ..att_viz.attention_matrix import AttentionMatrix, LazyAttentionMatrix
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
 
 
 def get_completion_matrix():
@@ -35,6 +37,24 @@ def get_completion_matrix():
     return attentions
 
 
+def get_synthetic_completion_matrix(
+    num_layers=3, num_heads=4, num_prompt_tokens=5, num_response_tokens=6
+):
+    """Builds a `generate`-style attention tuple without loading a model."""
+    attentions = []
+    for i in range(num_response_tokens):
+        num_queries = num_prompt_tokens if i == 0 else 1
+        seq_len = num_prompt_tokens + i
+        attentions.append(
+            tuple(
+                torch.softmax(torch.rand(1, num_heads, num_queries, seq_len), dim=-1)
+                for _ in range(num_layers)
+            )
+        )
+
+    return tuple(attentions)
+
+
 def test_constructor_on_good_input():
     num_layers = 20
     num_heads = 16
@@ -203,3 +223,175 @@ def test_formatting_headwise_averaging_yes_zeroing_of_first_attn():
                 )
 
                 assert torch.allclose(torch.tensor(computed_mean), expected_mean)
+
+
+def test_formatting_synthetic_matrix_matches_per_token_rows():
+    num_layers, num_heads, num_prompt_tokens, num_response_tokens = 3, 4, 5, 6
+    attn_matrix = get_synthetic_completion_matrix(
+        num_layers, num_heads, num_prompt_tokens, num_response_tokens
+    )
+
+    a = AttentionMatrix(attn_matrix)
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+
+    assert a.num_layers == num_layers
+    assert a.num_heads == num_heads
+
+    for layer in range(num_layers):
+        for head in range(num_heads):
+            assert len(a.attention_matrix[layer][head]) == num_response_tokens
+            for token in range(num_response_tokens):
+                row = a.attention_matrix[layer][head][token]
+                expected = attn_matrix[token][layer][0][head][-1].clone()
+                expected[0] = 0
+
+                assert len(row) == num_prompt_tokens + token
+                assert torch.equal(row, expected)
+
+    # The original tensors are left untouched
+    assert attn_matrix[0][0][0][0][-1][0] != 0
+
+
+def test_formatting_synthetic_matrix_headwise_averaging():
+    attn_matrix = get_synthetic_completion_matrix()
+
+    a = AttentionMatrix(attn_matrix)
+    a.format(AttentionAggregationMethod.HEADWISE_AVERAGING, zero_first_attention=False)
+
+    assert a.num_heads == 1
+
+    for layer in range(a.num_layers):
+        for token in range(len(attn_matrix)):
+            expected = torch.mean(attn_matrix[token][layer][0, :, -1], 0)
+            assert torch.allclose(a.attention_matrix[layer][0][token], expected)
+
+
+def test_formatting_synthetic_matrix_collapsed_dimensions():
+    attn_matrix = get_synthetic_completion_matrix()
+    packed = PackedAttention.from_generate(attn_matrix).data
+
+    expected = {
+        AttentionAggregationMethod.LAYERWISE_AVERAGING: packed.mean(0, keepdim=True),
+        AttentionAggregationMethod.HEADWISE_MAX: packed.amax(1, keepdim=True),
+        AttentionAggregationMethod.GLOBAL_AVERAGING: packed.mean((0, 1), keepdim=True),
+    }
+
+    for aggr_method, data in expected.items():
+        a = AttentionMatrix(attn_matrix)
+        a.format(aggr_method, zero_first_attention=False)
+
+        assert (a.num_layers, a.num_heads) == tuple(data.shape[:2])
+        assert a.num_layers == (1 if aggr_method.collapses_layers else 3)
+        assert a.num_heads == (1 if aggr_method.collapses_heads else 4)
+        assert torch.allclose(a.attention_matrix.data, data)
+
+
+def test_formatting_with_reduced_precision():
+    attn_matrix = get_synthetic_completion_matrix()
+
+    a = AttentionMatrix(attn_matrix)
+    a.format(AttentionAggregationMethod.NONE, False, dtype=torch.float16)
+
+    assert a.attention_matrix.data.dtype == torch.float16
+    assert torch.allclose(
+        a.attention_matrix[1][2][3].float(),
+        attn_matrix[3][1][0][2][-1],
+        atol=1e-3,
+    )
+
+
+def test_formatting_copies_to_the_host_once(mocker):
+    attn_matrix = get_synthetic_completion_matrix()
+    spy = mocker.spy(PackedAttention, "to")
+
+    a = AttentionMatrix(attn_matrix)
+    a.format(AttentionAggregationMethod.HEADWISE_AVERAGING, True, dtype=torch.float16)
+
+    assert spy.call_count == 1
+    assert spy.call_args.args[1:] == ("cpu",)
+    assert a.attention_matrix.data.dtype == torch.float16
+    assert a.attention_matrix.data.device.type == "cpu"
+
+    # The formatted matrix can also stay on the device of the model's attention
+    b = AttentionMatrix(attn_matrix)
+    b.format(AttentionAggregationMethod.HEADWISE_AVERAGING, True, device=None)
+
+    assert spy.call_count == 1
+    assert torch.allclose(b.attention_matrix.data.half(), a.attention_matrix.data)
+
+
+def test_lazy_attention_matrix_matches_eager_formatting(tmp_path):
+    attn_matrix = get_synthetic_completion_matrix(3, 12, 5, 6)
+    store = AttentionStore.write(
+        str(tmp_path / "example_attention.attviz"),
+        PackedAttention.from_generate(attn_matrix),
+        [f"token_{i}" for i in range(11)],
+        5,
+    )
+
+    for aggr_method in AttentionAggregationMethod:
+        eager = AttentionMatrix(attn_matrix)
+        eager.format(aggr_method, zero_first_attention=True)
+
+        lazy = LazyAttentionMatrix(store)
+        lazy.format(aggr_method, zero_first_attention=True)
+
+        # The mapped, unformatted matrix of a lazy matrix keeps all of its layers
+        assert (lazy.num_layers, lazy.num_heads) == (eager.num_layers, eager.num_heads)
+        assert lazy == eager or aggr_method.collapses_layers
+        assert torch.allclose(lazy.get_slice().data, eager.get_slice().data)
+
+        layers = slice(0, 1) if aggr_method.collapses_layers else slice(2, 3)
+        heads = slice(0, 1) if aggr_method.collapses_heads else slice(8, 12)
+        chunk = lazy.get_slice(layers=layers, heads=heads)
+        assert torch.allclose(chunk.data, eager.get_slice(layers, heads).data)
+
+    # Formatting never modifies the store
+    assert torch.equal(
+        store.read().data, PackedAttention.from_generate(attn_matrix).data
+    )
+
+
+def test_lazy_attention_matrix_slices_are_copied_to_the_device(tmp_path, mocker):
+    store = AttentionStore.write(
+        str(tmp_path / "example_attention.attviz"),
+        PackedAttention.from_generate(get_synthetic_completion_matrix()),
+        [f"token_{i}" for i in range(11)],
+        5,
+    )
+    spy = mocker.spy(PackedAttention, "to")
+
+    lazy = LazyAttentionMatrix(store)
+    lazy.format(AttentionAggregationMethod.NONE, True, dtype=torch.float16)
+    chunk = lazy.get_slice(layers=slice(0, 1))
+
+    assert spy.call_count == 1
+    assert spy.call_args.args[1:] == ("cpu",)
+    assert chunk.data.dtype == torch.float16 and chunk.data.device.type == "cpu"
+
+    # Slices can also stay on the CPU, where the store is read and formatted
+    lazy.format(AttentionAggregationMethod.NONE, True, device=None)
+    lazy.get_slice()
+    assert spy.call_count == 1
+
+
+def test_formatting_selected_layers_and_heads():
+    attn_matrix = get_synthetic_completion_matrix(4, 6, 5, 3)
+
+    a = AttentionMatrix(attn_matrix, layers=[3, 1], heads=[0, 4, 5])
+
+    assert (a.num_layers, a.num_heads) == (2, 3)
+
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=False)
+
+    assert a.layer_indices == [3, 1]
+    assert a.head_indices == [0, 4, 5]
+    assert a.attention_matrix.data.shape[:2] == (2, 3)
+
+    for token in range(3):
+        assert torch.equal(
+            a.attention_matrix[0][2][token], attn_matrix[token][3][0][5][-1]
+        )
+        assert torch.equal(
+            a.attention_matrix[1][1][token], attn_matrix[token][1][0][4][-1]
+        )
@@ -0,0 +1,58 @@
+import pytest
+import torch
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_matrix import AttentionMatrix
+from ..att_viz.attention_rollout import AttentionRollout
+from ..att_viz.packed_attention import PackedAttention
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def reference_rollout(packed, residual):
+    """Multiplies the full attention matrices of every layer, prompt rows being identity rows."""
+    num_layers = packed.data.shape[0]
+    lengths = packed.lengths.tolist()
+    size = max(lengths)
+
+    rollout = torch.eye(size, dtype=torch.float64)
+    for layer in range(num_layers):
+        attention = torch.eye(size, dtype=torch.float64)
+        for i, length in enumerate(lengths):
+            attention[length - 1] = 0
+            attention[length - 1, :length] = packed.row(layer, i).double().mean(0)
+
+        mixed = (
+            residual * torch.eye(size, dtype=torch.float64) + (1 - residual) * attention
+        )
+        rollout = mixed @ rollout
+
+    return [rollout[length - 1, :length] for length in lengths]
+
+
+@pytest.mark.parametrize("residual", [0.5, 0.2])
+def test_rollout_matches_matrix_products(residual):
+    packed = PackedAttention.from_generate(get_synthetic_completion_matrix(4, 3, 5, 7))
+    expected = reference_rollout(packed, residual)
+
+    rollout = AttentionRollout(residual).apply(packed)
+
+    assert rollout.data.shape == (1, 1, packed.data.shape[-1])
+    for i, row in enumerate(expected):
+        assert torch.allclose(rollout.row(0, 0, i).double(), row, atol=1e-6)
+        assert torch.isclose(rollout.row(0, 0, i).sum(), torch.tensor(1.0))
+
+
+def test_rollout_aggregation():
+    attn_matrix = get_synthetic_completion_matrix(4, 3, 5, 7)
+    expected = AttentionRollout().apply(PackedAttention.from_generate(attn_matrix))
+
+    a = AttentionMatrix(attn_matrix)
+    a.format(AttentionAggregationMethod.ROLLOUT, zero_first_attention=True)
+
+    assert (a.num_layers, a.num_heads) == (1, 1)
+    assert torch.all(
+        a.attention_matrix.data[..., a.attention_matrix.row_offsets[:-1]] == 0
+    )
+
+    # Only the attention towards the first token is zeroed, after the rollout
+    expected.data[..., expected.row_offsets[:-1]] = 0
+    assert torch.allclose(a.attention_matrix.data, expected.data)
@@ -0,0 +1,86 @@
+import pytest
+import torch
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_matrix import AttentionMatrix, LazyAttentionMatrix
+from ..att_viz.attention_sparsity import AttentionSparsity, SparsityMethod
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def get_packed():
+    # Two heads, with rows of length 3 and 4
+    data = torch.tensor(
+        [
+            [0.5, 0.3, 0.2, 0.1, 0.6, 0.2, 0.1],
+            [0.2, 0.2, 0.6, 0.4, 0.1, 0.1, 0.4],
+        ]
+    )
+    return PackedAttention(data, torch.tensor([0, 3, 7]))
+
+
+@pytest.mark.parametrize(
+    "sparsity, expected",
+    [
+        (
+            AttentionSparsity.top_k(1),
+            [[1, 0, 0, 0, 1, 0, 0], [0, 0, 1, 1, 0, 0, 0]],
+        ),
+        (
+            AttentionSparsity.threshold(0.25),
+            [[1, 1, 0, 0, 1, 0, 0], [0, 0, 1, 1, 0, 0, 1]],
+        ),
+        (
+            AttentionSparsity.sigma_threshold(0.5),
+            [[1, 0, 0, 0, 1, 0, 0], [0, 0, 1, 1, 0, 0, 1]],
+        ),
+        (
+            AttentionSparsity.cumulative_mass(0.75),
+            [[1, 1, 0, 0, 1, 1, 0], [1, 0, 1, 1, 0, 0, 1]],
+        ),
+    ],
+)
+def test_keep_mask(sparsity, expected):
+    assert torch.equal(sparsity.keep_mask(get_packed()), torch.tensor(expected).bool())
+
+
+def test_apply_zeroes_dropped_values():
+    sparsity = AttentionSparsity.top_k(2)
+    keep = sparsity.keep_mask(get_packed())
+
+    packed = sparsity.apply(get_packed())
+
+    assert torch.equal(packed.data, torch.where(keep, get_packed().data, 0))
+
+
+def test_invalid_parameters():
+    with pytest.raises(AssertionError):
+        AttentionSparsity(SparsityMethod.TOP_K, 0)
+
+    with pytest.raises(AssertionError):
+        AttentionSparsity.cumulative_mass(1.5)
+
+
+def test_sparse_formatting_lazy_matches_eager(tmp_path):
+    attentions = get_synthetic_completion_matrix()
+    path = str(tmp_path / "example_attention.attviz")
+    store = AttentionStore.write(
+        path, PackedAttention.from_generate(attentions), ["t"] * 11, 5
+    )
+
+    eager = AttentionMatrix(attentions)
+    eager.format(
+        AttentionAggregationMethod.HEADWISE_AVERAGING,
+        True,
+        sparsity=AttentionSparsity.top_k(2),
+    )
+
+    lazy = LazyAttentionMatrix(store)
+    lazy.format(
+        AttentionAggregationMethod.HEADWISE_AVERAGING,
+        True,
+        sparsity=AttentionSparsity.top_k(2),
+    )
+
+    assert torch.equal(lazy.get_slice().data, eager.get_slice().data)
+    assert torch.equal((eager.get_slice().data != 0).sum(-1), torch.full((3, 1), 2 * 6))
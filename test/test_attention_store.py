@@ -0,0 +1,66 @@
+import pytest
+import torch
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def write_synthetic_store(path, dtype=None):
+    attentions = get_synthetic_completion_matrix(3, 4, 5, 6)
+    packed = PackedAttention.from_generate(attentions, dtype)
+    tokens = [f"token_{i}" for i in range(11)]
+
+    return AttentionStore.write(str(path), packed, tokens, 5, "some/model"), packed
+
+
+def test_store_round_trip(tmp_path):
+    store, packed = write_synthetic_store(tmp_path / "example_attention.attviz")
+
+    reopened = AttentionStore(store.path)
+
+    assert reopened.tokens == [f"token_{i}" for i in range(11)]
+    assert reopened.prompt_length == 5
+    assert reopened.model_name == "some/model"
+    assert reopened.dtype == torch.float32
+    assert (reopened.num_layers, reopened.num_heads) == (3, 4)
+    assert torch.equal(reopened.row_offsets, packed.row_offsets)
+    assert torch.equal(reopened.read().data, packed.data)
+
+
+def test_store_partial_reads(tmp_path):
+    store, packed = write_synthetic_store(
+        tmp_path / "example_attention.attviz", torch.float16
+    )
+
+    chunk = store.read(layers=slice(1, 3), heads=slice(2, 4))
+
+    assert chunk.data.dtype == torch.float16
+    assert torch.equal(chunk.data, packed.data[1:3, 2:4])
+    assert torch.equal(chunk.row(1, 0, 4), packed.row(2, 2, 4))
+
+
+def test_store_rejects_other_files(tmp_path):
+    path = tmp_path / "not_a_store.attviz"
+    path.write_bytes(b"certainly not a store")
+
+    with pytest.raises(ValueError):
+        AttentionStore(str(path))
+
+
+def test_store_path_for():
+    assert AttentionStore.path_for("runs/example_0") == (
+        "runs/example_0_attention.attviz"
+    )
+
+
+def test_store_map_is_lazy_and_private(tmp_path):
+    store, packed = write_synthetic_store(tmp_path / "example_attention.attviz")
+
+    mapped = store.map()
+
+    assert torch.equal(mapped.data, packed.data)
+
+    mapped.data[0, 0, 0] = -1
+    store.evict()
+
+    assert torch.equal(AttentionStore(store.path).read().data, packed.data)
@@ -0,0 +1,69 @@
+import pytest
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_matrix import AttentionMatrix
+from ..benchmarks import suite
+from ..benchmarks.suite import (
+    STAGES,
+    BenchmarkConfig,
+    compare,
+    format_result,
+    run_benchmarks,
+)
+from ..benchmarks.synthetic import synthetic_attentions
+
+
+def test_synthetic_attentions_are_shaped_like_generate():
+    attentions = synthetic_attentions(3, 2, prompt_length=5, completion_length=4)
+
+    assert len(attentions) == 4 and all(len(step) == 3 for step in attentions)
+    assert attentions[0][0].shape == (1, 2, 5, 5)
+    assert attentions[3][2].shape == (1, 2, 1, 8)
+    assert attentions[0][0].sum(-1).allclose(attentions[0][0].new_ones(1))
+    assert attentions[0][0][0, 0].triu(1).count_nonzero() == 0  # Causal
+
+    matrix = AttentionMatrix(attentions)
+    matrix.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+    assert (matrix.num_layers, matrix.num_heads) == (3, 2)
+
+
+@pytest.mark.parametrize(
+    "aggregation_method",
+    [AttentionAggregationMethod.NONE, AttentionAggregationMethod.HEADWISE_AVERAGING],
+)
+def test_every_stage_runs_and_compares(aggregation_method, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = BenchmarkConfig(
+        num_layers=2,
+        num_heads=2,
+        prompt_length=4,
+        completion_length=6,
+        aggregation_method=aggregation_method,
+        num_completions=2,
+    )
+
+    results = run_benchmarks([config], isolated=False, progress=None)
+
+    assert [result["stage"] for result in results["results"]] == list(STAGES)
+    for result in results["results"]:
+        assert result["seconds"] >= 0
+        assert result["peak_rss_bytes"] > 0
+        assert result["output_bytes"] > 0
+        assert result["config"]["aggregation_method"] == aggregation_method.name
+
+    lines = compare(results, results)
+    assert len(lines) == len(STAGES)
+    assert all("time x1.00" in line for line in lines)
+
+
+def test_peak_rss_may_not_be_measured(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(suite, "_peak_rss", lambda: None)  # e.g. on Windows
+    config = BenchmarkConfig(
+        num_layers=1, num_heads=1, prompt_length=2, completion_length=2
+    )
+
+    results = run_benchmarks([config], ["format"], isolated=False, progress=None)
+    (result,) = results["results"]
+    assert result["peak_rss_bytes"] is None
+    assert "n/a MiB" in format_result(result)
+    assert "peak RSS xnan" in compare(results, results)[0]
@@ -0,0 +1,59 @@
+import pytest
+from ..att_viz.font_metrics import FontMetrics
+from ..att_viz.renderer import RenderConfig, Renderer
+
+
+def test_default_font_metrics():
+    metrics = FontMetrics.default()
+
+    assert metrics.family == "Helvetica"
+    assert metrics.advance("a") == 556
+    assert metrics.advance("a", bold=True) == 556
+    assert metrics.advance("i") == 222
+    assert metrics.advance("i", bold=True) == 278
+
+    # Characters missing from the table
+    assert metrics.advance("é") == 556
+    assert metrics.advance("注") == 1000
+    assert metrics.advance("́") == 0
+
+
+def test_text_width_collapses_white_space():
+    metrics = FontMetrics.default(font_size=10)
+
+    assert FontMetrics.displayed_text("  Hello\n\tWorld  ") == "Hello World"
+    assert metrics.text_width("  ii\n") == pytest.approx(4.44)
+    assert metrics.text_width("ii", bold=True) == pytest.approx(5.56)
+    assert metrics.text_width("\n") == 0
+
+
+def test_token_info_with_font_metrics():
+    metrics = FontMetrics.default()
+    r = Renderer(RenderConfig(font_metrics=metrics))
+
+    tokens = ["Hello", " World", "\n", "!"]
+    info, dy = r.create_token_info(tokens, prompt_length=1)
+
+    assert dy == 22.5
+
+    hello = 0.3 * 0.25 * 15 + metrics.text_width("Hello", bold=True)
+    world = 0.3 * 1.25 * 15 + metrics.text_width(" World")
+
+    assert info[0] == pytest.approx([20, 30, hello, 0])
+    assert info[1] == pytest.approx([20 + hello, 30, world, 1])
+    assert info[2] == pytest.approx([20 + hello + world, 30, 0.3 * 0.25 * 15, 0])
+    assert info[3][:2] == pytest.approx([20, 52.5])
+
+
+def test_token_info_wraps_lines_with_font_metrics():
+    r = Renderer(RenderConfig(font_metrics=FontMetrics.default(), line_length=100))
+
+    info, dy = r.create_token_info([" word"] * 20)
+    lines = sorted({y for _, y, _, _ in info})
+
+    assert len(lines) > 1
+    assert dy >= 22.5 * (len(lines) - 1)
+    for y in lines:
+        line = [token for token in info if token[1] == y]
+        assert line[0][0] == 20
+        assert sum(w for _, _, w, _ in line[:-1]) <= 100
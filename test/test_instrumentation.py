@@ -0,0 +1,160 @@
+import json
+import pytest
+import torch
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_matrix import AttentionMatrix
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.instrumentation import (
+    Instrumentation,
+    _current_rss,
+    active,
+    record,
+    stage,
+)
+from ..att_viz.packed_attention import PackedAttention
+from ..att_viz.renderer import RenderConfig, Renderer
+from ..att_viz.utils import process_saved_completions
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def test_stages_are_only_measured_when_instrumented():
+    with stage("format") as formatting:
+        formatting.add_output("does_not_exist.html")  # Ignored
+    record("render", 1.0)
+
+    observed = []
+    with Instrumentation(observers=[observed.append]) as instrumentation:
+        assert active() is instrumentation
+
+        with stage("experiment"):
+            with stage("format", aggregation_method="NONE") as formatting:
+                formatting.add_tensor(
+                    PackedAttention.from_generate(get_synthetic_completion_matrix())
+                )
+            record("render", 0.5, save_prefix="a")
+
+    assert active() is None
+    assert [r.path for r in observed] == [
+        "experiment/format",
+        "experiment/render",
+        "experiment",
+    ]
+    assert (
+        observed is not instrumentation.records and observed == instrumentation.records
+    )
+
+    formatting, rendering, experiment = observed
+    assert formatting.details == {"aggregation_method": "NONE"}
+    assert formatting.tensor_bytes == 3 * 4 * (5 + 6 + 7 + 8 + 9 + 10) * 4
+    assert rendering.seconds == 0.5
+    assert experiment.seconds >= formatting.seconds
+    assert formatting.process_peak_rss_bytes > 0
+    assert formatting.peak_rss_increase_bytes >= 0
+    assert formatting.python_peak_bytes is None
+
+
+@pytest.mark.skipif(_current_rss() is None, reason="RSS is only read on Linux")
+def test_resident_memory_is_attributed_to_stages():
+    with Instrumentation() as instrumentation:
+        with stage("outer"):
+            with stage("keep"):
+                kept = torch.ones(64 << 20, dtype=torch.uint8)  # Touches every page
+            with stage("free"):
+                torch.ones(64 << 20, dtype=torch.uint8)
+
+    keep, free, outer = instrumentation.records
+    assert keep.rss_delta_bytes >= 60 << 20
+    assert free.rss_delta_bytes < 16 << 20
+    assert outer.rss_delta_bytes >= keep.rss_delta_bytes - (16 << 20)
+    assert outer.peak_rss_increase_bytes >= keep.peak_rss_increase_bytes
+    assert outer.process_peak_rss_bytes >= _current_rss()
+
+    totals = instrumentation.report()["totals"]
+    assert totals["outer/keep"]["rss_delta_bytes"] == keep.rss_delta_bytes
+    del kept
+
+
+def test_memory_tracing_includes_nested_stages():
+    with Instrumentation(trace_memory=True) as instrumentation:
+        with stage("outer"):
+            with stage("inner"):
+                data = bytearray(8 << 20)
+            del data
+
+    inner, outer = instrumentation.records
+    assert inner.python_peak_bytes >= 8 << 20
+    assert outer.python_peak_bytes >= inner.python_peak_bytes
+
+
+def test_report_of_a_rendering_run(tmp_path):
+    attentions = get_synthetic_completion_matrix(num_layers=2)
+    tokens = [f"token_{i}" for i in range(5 + len(attentions))]
+    save_prefixes = [str(tmp_path / f"completion_{i}") for i in range(2)]
+    for save_prefix in save_prefixes:
+        AttentionStore.write(
+            AttentionStore.path_for(save_prefix),
+            PackedAttention.from_generate(attentions),
+            tokens,
+            5,
+        )
+
+    with Instrumentation() as instrumentation:
+        attention_matrix = AttentionMatrix(attentions)
+        attention_matrix.format(AttentionAggregationMethod.NONE, True)
+        Renderer(RenderConfig(), AttentionAggregationMethod.NONE).render(
+            tokens, 5, attention_matrix, save_prefix=str(tmp_path / "eager_")
+        )
+
+        process_saved_completions(
+            RenderConfig(), AttentionAggregationMethod.NONE, save_prefixes
+        )
+
+    instrumentation.save_report(tmp_path / "report.json")
+    with open(tmp_path / "report.json") as fp:
+        report = json.load(fp)
+
+    totals = report["totals"]
+    assert totals["format"]["count"] == 1
+    assert totals["format"]["tensor_bytes"] == attention_matrix.attention_matrix.nbytes
+    assert totals["render/layout"]["count"] == 1
+    assert totals["render"]["output_bytes"] == sum(
+        path.stat().st_size for path in tmp_path.glob("eager_*.html")
+    )
+
+    prefix = "process_saved_completions/process_saved_completion"
+    assert totals[prefix]["count"] == 2
+    # Saved completions are formatted lazily, one layer at a time
+    assert totals[f"{prefix}/render/format"]["count"] == 4
+    assert totals[f"{prefix}/render"]["output_bytes"] == sum(
+        path.stat().st_size for path in tmp_path.glob("completion_*.html")
+    )
+    assert [
+        s["details"]["save_prefix"]
+        for s in report["stages"]
+        if s["name"] == "process_saved_completion"
+    ] == save_prefixes
+
+
+def test_worker_processes_are_recorded_by_save_prefix(tmp_path):
+    attentions = get_synthetic_completion_matrix(num_layers=2)
+    tokens = [f"token_{i}" for i in range(5 + len(attentions))]
+    save_prefixes = [str(tmp_path / f"completion_{i}") for i in range(3)]
+    for save_prefix in save_prefixes[1:]:
+        AttentionStore.write(
+            AttentionStore.path_for(save_prefix),
+            PackedAttention.from_generate(attentions),
+            tokens,
+            5,
+        )
+
+    with Instrumentation() as instrumentation:
+        summary = process_saved_completions(
+            RenderConfig(), AttentionAggregationMethod.NONE, save_prefixes, workers=2
+        )
+
+    *completions, outer = instrumentation.records
+    assert outer.path == "process_saved_completions"
+    assert [r.details["save_prefix"] for r in completions] == save_prefixes
+    assert [r.seconds for r in completions] == list(summary.timings.values())
+    assert completions[0].details["error"] == summary.failures[save_prefixes[0]]
+    assert completions[1].details["error"] is None
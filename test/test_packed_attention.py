@@ -0,0 +1,70 @@
+import torch
+from ..att_viz.packed_attention import PackedAttention
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def test_packing_keeps_last_query_rows():
+    num_layers, num_heads, num_prompt_tokens, num_response_tokens = 2, 3, 4, 5
+    attn_matrix = get_synthetic_completion_matrix(
+        num_layers, num_heads, num_prompt_tokens, num_response_tokens
+    )
+
+    packed = PackedAttention.from_generate(attn_matrix)
+
+    assert packed.data.shape == (
+        num_layers,
+        num_heads,
+        sum(num_prompt_tokens + i for i in range(num_response_tokens)),
+    )
+    assert packed.num_rows == num_response_tokens
+    assert packed.lengths.tolist() == [
+        num_prompt_tokens + i for i in range(num_response_tokens)
+    ]
+
+    for layer in range(num_layers):
+        for head in range(num_heads):
+            for token in range(num_response_tokens):
+                expected = attn_matrix[token][layer][0][head][-1]
+                assert torch.equal(packed.row(layer, head, token), expected)
+                assert torch.equal(packed[layer][head][token], expected)
+
+
+def test_select_is_a_view():
+    packed = PackedAttention.from_generate(get_synthetic_completion_matrix())
+
+    chunk = packed.select(layers=slice(1, 2), heads=slice(0, 2))
+
+    assert chunk.data.shape[:2] == (1, 2)
+    assert chunk.data.data_ptr() == packed.data[1].data_ptr()
+
+    chunk.data[0, 0, 0] = -1
+    assert packed.data[1, 0, 0] == -1
+
+
+def test_tolist_is_ragged():
+    packed = PackedAttention.from_generate(get_synthetic_completion_matrix(1, 2, 3, 4))
+
+    nested = packed.tolist()
+
+    assert len(nested) == 1
+    assert len(nested[0]) == 2
+    assert [len(row) for row in nested[0][1]] == [3, 4, 5, 6]
+    assert nested[0][1][2] == packed.row(0, 1, 2).tolist()
+    assert not hasattr(packed, "__dict__")
+
+
+def test_packing_selected_layers_and_heads_in_reduced_precision():
+    attn_matrix = get_synthetic_completion_matrix(4, 5, 3, 4)
+
+    packed = PackedAttention.from_generate(
+        attn_matrix, torch.float16, layers=[2, 0], heads=[4, 1, 2]
+    )
+
+    assert packed.data.dtype == torch.float16
+    assert packed.data.shape[:2] == (2, 3)
+    for token, token_attention in enumerate(attn_matrix):
+        expected = PackedAttention.step_rows(token_attention, [2, 0], [4, 1, 2])
+        assert torch.equal(
+            packed.data[..., packed.row_offsets[token] : packed.row_offsets[token + 1]],
+            expected.to(torch.float16),
+        )
@@ -0,0 +1,172 @@
+import json
+import numpy as np
+import pytest
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_matrix import AttentionMatrix
+from ..att_viz.attention_reprocessing import AttentionReprocessing
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
+from ..att_viz.renderer import RenderConfig, Renderer
+from ..post_processing import (
+    reprocess_attention,
+    reprocess_html_file,
+    reprocess_store,
+)
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def reference_reprocessing(base_table, cutoff, corrfactor, firstignored):
+    """The row-by-row reprocessing of the original `reprocess_html` loops."""
+    corrected_table = []
+    for layer in base_table:
+        corrected_layer = []
+        for head in layer:
+            corrected_head = []
+            min_len = 2
+            for row in head:
+                if min_len == 2:
+                    min_len = len(row)
+
+                row = list(row)
+                row[:firstignored] = [0] * len(row[:firstignored])
+                arr = np.array(row)
+                std = np.std(arr[firstignored:min_len])
+                mean = np.mean(arr[firstignored:min_len])
+                keep_mask = arr > mean + cutoff * std
+
+                corrected_head.append(
+                    [
+                        float(x) ** corrfactor if keep else 0
+                        for x, keep in zip(row, keep_mask)
+                    ]
+                )
+            corrected_layer.append(corrected_head)
+        corrected_table.append(corrected_layer)
+
+    return corrected_table
+
+
+def get_table(num_layers=2, num_heads=3, prompt_length=5, num_rows=4):
+    rng = np.random.default_rng(0)
+    return [
+        [
+            [rng.random(prompt_length + i).tolist() for i in range(num_rows)]
+            for _ in range(num_heads)
+        ]
+        for _ in range(num_layers)
+    ]
+
+
+@pytest.mark.parametrize(
+    "cutoff, corrfactor, firstignored",
+    [(0.5, 1.0 / 3.0, 1), (0.0, 0.5, 0), (1.5, 1.0, 2)],
+)
+def test_reprocessing_matches_reference(cutoff, corrfactor, firstignored):
+    table = get_table()
+
+    result = reprocess_attention(table, cutoff, corrfactor, firstignored)
+    expected = reference_reprocessing(table, cutoff, corrfactor, firstignored)
+
+    for result_layer, expected_layer in zip(result, expected, strict=True):
+        for result_head, expected_head in zip(
+            result_layer, expected_layer, strict=True
+        ):
+            for result_row, expected_row in zip(
+                result_head, expected_head, strict=True
+            ):
+                assert np.allclose(result_row, expected_row)
+
+
+def test_reprocess_html_file(tmp_path):
+    table = get_table()
+    payload = {"attention": {"attn": table, "num_layers": 2}, "root_div_id": "x"}
+    infile = tmp_path / "vis.html"
+    infile.write_text(
+        "<div></div>\n    const params = " + json.dumps(payload) + "; // HACK: marker\n"
+    )
+
+    outfile = reprocess_html_file(infile, tmp_path / "out.html")
+    lines = (tmp_path / "out.html").read_text().splitlines()
+
+    assert outfile == tmp_path / "out.html"
+    assert lines[0] == "<div></div>"
+    assert lines[1].endswith("; // HACK: marker")
+
+    result = json.loads(lines[1].split("const params = ", 1)[1].split("; // HACK")[0])
+    assert result["attention"]["num_layers"] == 2
+    assert result["attention"]["attn"] == reprocess_attention(table)
+
+
+def get_payload(html_content):
+    return json.loads(html_content.split("const params = ", 1)[1].split("; // HACK")[0])
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 20])
+def test_streaming_matches_parsed_reprocessing(tmp_path, chunk_size):
+    a = AttentionMatrix(get_synthetic_completion_matrix(2, 3, 4, 5))
+    a.format(AttentionAggregationMethod.NONE, True)
+    Renderer(RenderConfig()).render(
+        list("abcdefghi"), 4, a, render_in_chunks=False, save_prefix=str(tmp_path / "x")
+    )
+
+    html_content = (tmp_path / "x.html").read_text()
+    reprocess_html_file(tmp_path / "x.html", tmp_path / "y.html", chunk_size=chunk_size)
+    reprocessed = (tmp_path / "y.html").read_text()
+
+    payload, result = get_payload(html_content), get_payload(reprocessed)
+    payload["attention"]["attn"] = reprocess_attention(payload["attention"]["attn"])
+
+    assert result == payload
+    assert (
+        reprocessed.split("const params = ")[0]
+        == html_content.split("const params = ")[0]
+    )
+
+
+def test_streaming_rejects_binary_payloads(tmp_path):
+    infile = tmp_path / "x.html"
+    infile.write_text(
+        'const params = {"attention": {"attn": {"encoding": "uint8"}}}; // HACK'
+    )
+
+    with pytest.raises(ValueError):
+        reprocess_html_file(infile, tmp_path / "y.html")
+
+
+def test_reprocessing_packed_attention_matches_lists():
+    packed = PackedAttention.from_generate(get_synthetic_completion_matrix(2, 3, 4, 5))
+    expected = reprocess_attention(packed.tolist(), 0.5, 0.5, 2)
+
+    result = AttentionReprocessing(0.5, 0.5, 2).apply(packed).tolist()
+
+    assert np.allclose(
+        np.concatenate([np.concatenate(h) for l in result for h in l]),
+        np.concatenate([np.concatenate(h) for l in expected for h in l]),
+    )
+
+
+def test_reprocess_store(tmp_path):
+    attentions = get_synthetic_completion_matrix(2, 3, 4, 5)
+    save_prefix = str(tmp_path / "completion")
+    AttentionStore.write(
+        AttentionStore.path_for(save_prefix),
+        PackedAttention.from_generate(attentions),
+        list("abcdefghi"),
+        4,
+    )
+
+    reprocess_store(save_prefix)
+
+    html_content = (
+        tmp_path / "completion_reprocessedLayer-1__Chunk-0.html"
+    ).read_text()
+
+    a = AttentionMatrix(attentions)
+    a.format(AttentionAggregationMethod.NONE, True)
+    expected = reprocess_attention(a.get_slice(layers=slice(1, 2)).tolist())
+
+    result = get_payload(html_content)["attention"]["attn"]
+    assert np.allclose(
+        np.concatenate([np.concatenate(h) for l in result for h in l]),
+        np.concatenate([np.concatenate(h) for l in expected for h in l]),
+    )
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import re
+import shutil
+import pytest
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
+from ..att_viz import render_cache
+from ..att_viz.render_cache import RenderCache
+from ..att_viz.renderer import RenderConfig
+from ..att_viz import utils
+from ..att_viz.utils import process_saved_completions
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def write_stores(tmp_path, count, num_layers=2):
+    attentions = get_synthetic_completion_matrix(num_layers=num_layers)
+    tokens = [f"token_{i}" for i in range(5 + len(attentions))]
+    save_prefixes = [str(tmp_path / f"completion_{i}") for i in range(count)]
+
+    for save_prefix in save_prefixes:
+        AttentionStore.write(
+            AttentionStore.path_for(save_prefix),
+            PackedAttention.from_generate(attentions),
+            tokens,
+            5,
+        )
+
+    return save_prefixes
+
+
+def html_files(tmp_path):
+    return {path.name: path.read_bytes() for path in tmp_path.glob("*.html")}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_up_to_date_completions_are_skipped(tmp_path, workers):
+    save_prefixes = write_stores(tmp_path, 3)
+    manifest = str(tmp_path / "manifest.json")
+
+    def process(config=RenderConfig(), reported=None):
+        return process_saved_completions(
+            config,
+            AttentionAggregationMethod.NONE,
+            save_prefixes,
+            workers=workers,
+            render_cache_path=manifest,
+            progress=lambda done, total, save_prefix, elapsed, error: (
+                reported.append((done, save_prefix)) if reported is not None else None
+            ),
+        )
+
+    summary = process()
+    assert not summary.skipped and not summary.failures
+    rendered = html_files(tmp_path)
+    assert len(RenderCache(manifest)) == 3
+
+    reported = []
+    summary = process(reported=reported)
+    assert summary.skipped == save_prefixes
+    assert summary.succeeded == save_prefixes
+    assert reported == [(i + 1, p) for i, p in enumerate(save_prefixes)]
+    assert html_files(tmp_path) == rendered  # Not written again
+
+    # A missing output, a new store content and a new configuration are rendered again
+    os.remove(tmp_path / "completion_0Layer-0__Chunk-0.html")
+    write_stores(tmp_path, 2, num_layers=3)
+    assert process().skipped == [save_prefixes[2]]
+    assert process(RenderConfig(token_height=30)).skipped == []
+    assert process(RenderConfig(token_height=30)).skipped == save_prefixes
+
+
+def test_completions_are_rendered_again_when_att_viz_changes(
+    tmp_path, mocker, monkeypatch
+):
+    save_prefix = write_stores(tmp_path, 1)[0]
+    manifest = str(tmp_path / "manifest.json")
+    write_formatted = mocker.spy(utils, "_write_formatted")
+
+    sources = tmp_path / "att_viz"
+    sources.mkdir()
+    for name in RenderCache.FORMATTER_SOURCES + RenderCache.RENDERER_SOURCES:
+        shutil.copy(os.path.join(render_cache._PACKAGE_DIRECTORY, name), sources)
+    monkeypatch.setattr(render_cache, "_PACKAGE_DIRECTORY", str(sources))
+
+    def process():
+        return process_saved_completions(
+            RenderConfig(),
+            AttentionAggregationMethod.HEADWISE_AVERAGING,
+            [save_prefix],
+            render_cache_path=manifest,
+        )
+
+    process()
+    assert process().skipped == [save_prefix]
+
+    # A new version of the rendering code renders the formatted attention again
+    with open(sources / "renderer.py", "a") as fp:
+        fp.write("\n# Changed\n")
+    assert process().skipped == []
+    assert write_formatted.call_count == 1
+
+    # A new version of the formatting code formats it again
+    with open(sources / "attention_rollout.py", "a") as fp:
+        fp.write("\n# Changed\n")
+    assert process().skipped == []
+    assert write_formatted.call_count == 2
+    assert process().skipped == [save_prefix]
+
+
+def test_failed_completions_are_rendered_again(tmp_path):
+    save_prefixes = write_stores(tmp_path, 2)
+    manifest = str(tmp_path / "manifest.json")
+    os.remove(AttentionStore.path_for(save_prefixes[0]))
+
+    summary = process_saved_completions(
+        RenderConfig(),
+        AttentionAggregationMethod.NONE,
+        save_prefixes,
+        render_cache_path=manifest,
+    )
+    assert list(summary.failures) == [save_prefixes[0]]
+
+    write_stores(tmp_path, 1)
+    summary = process_saved_completions(
+        RenderConfig(),
+        AttentionAggregationMethod.NONE,
+        save_prefixes,
+        render_cache_path=manifest,
+    )
+    assert not summary.failures and summary.skipped == [save_prefixes[1]]
+
+
+def test_store_contents_are_hashed_once(tmp_path, mocker):
+    save_prefix = write_stores(tmp_path, 1)[0]
+    path = AttentionStore.path_for(save_prefix)
+    manifest = str(tmp_path / "manifest.json")
+
+    cache = RenderCache(manifest)
+    digest = cache.content_hash(path)
+    cache.save()
+
+    reloaded = RenderCache(manifest)
+    sha256 = mocker.spy(hashlib, "sha256")
+    assert reloaded.content_hash(path) == digest
+    assert sha256.call_count == 0
+
+    with open(path, "r+b") as fp:
+        fp.seek(AttentionStore.DATA_OFFSET)
+        fp.write(b"\x00\x00\x80\x3f")  # Same size, new content
+    assert reloaded.content_hash(path) != digest
+
+
+@pytest.mark.parametrize(
+    "aggregation_method",
+    [AttentionAggregationMethod.HEADWISE_AVERAGING, AttentionAggregationMethod.ROLLOUT],
+)
+def test_formatted_attention_is_reused_when_only_the_layout_changes(
+    tmp_path, mocker, aggregation_method
+):
+    save_prefix = write_stores(tmp_path, 1)[0]
+    manifest = str(tmp_path / "manifest.json")
+    write_formatted = mocker.spy(utils, "_write_formatted")
+
+    process_saved_completions(
+        RenderConfig(), aggregation_method, [save_prefix], render_cache_path=manifest
+    )
+    rendered = html_files(tmp_path)
+    assert write_formatted.call_count == 1
+
+    formatted = AttentionStore(f"{save_prefix}{RenderCache.FORMATTED_SUFFIX}")
+    assert formatted.num_heads == 1
+    assert formatted.num_layers == (1 if aggregation_method.collapses_layers else 2)
+
+    summary = process_saved_completions(
+        RenderConfig(line_length=300),
+        aggregation_method,
+        [save_prefix],
+        render_cache_path=manifest,
+    )
+    assert not summary.failures and not summary.skipped
+    assert write_formatted.call_count == 1
+    assert html_files(tmp_path).keys() == rendered.keys()
+
+    # The formatted attention renders the same visualizations as the store
+    direct = tmp_path / "direct"
+    direct.mkdir()
+    shutil.copy(AttentionStore.path_for(save_prefix), direct)
+    process_saved_completions(
+        RenderConfig(line_length=300),
+        aggregation_method,
+        [str(direct / "completion_0")],
+    )
+
+    def without_ids(html):
+        return re.sub(rb"AttViz-[0-9a-f]+", b"", html)
+
+    assert {k: without_ids(v) for k, v in html_files(direct).items()} == {
+        k: without_ids(v) for k, v in html_files(tmp_path).items()
+    }
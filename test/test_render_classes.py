@@ -1,6 +1,19 @@
+import base64
+import gzip
+import torch
+import json
+import re
+import pytest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from ..att_viz.renderer import RenderConfig, Renderer
 from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_encoding import AttentionEncoding
+from ..att_viz.attention_sparsity import AttentionSparsity
+from ..att_viz.render_backend import RenderBackend
+from ..att_viz.font_metrics import FontMetrics
+from ..att_viz.attention_matrix import AttentionMatrix
+from .test_attention_matrix import get_synthetic_completion_matrix
 
 
 def test_default_render_config():
@@ -82,3 +95,328 @@ def test_format_special_chars():
 
 def test_rendering():
     pass  # TODO
+
+
+def test_rendering_selected_heads_uses_model_indices(tmp_path):
+    attn_matrix = get_synthetic_completion_matrix(4, 12, 3, 2)
+    a = AttentionMatrix(attn_matrix, layers=[2], heads=list(range(1, 11)))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=False)
+
+    tokens = ["Hello", " World", "!", " How", " are"]
+    Renderer(RenderConfig()).render(
+        tokens, 3, a, save_prefix=str(tmp_path / "att_viz_")
+    )
+
+    assert sorted(path.name for path in tmp_path.glob("*.html")) == [
+        "att_viz_Layer-2__Chunk-0.html",
+        "att_viz_Layer-2__Chunk-1.html",
+    ]
+
+    html_content = (tmp_path / "att_viz_Layer-2__Chunk-1.html").read_text(
+        encoding="UTF-8"
+    )
+
+    assert '"head_start_idx": 9' in html_content
+    assert '"head_indices": [9, 10]' in html_content
+    assert '"layer_idx": 2' in html_content
+
+
+@pytest.mark.parametrize("pool", [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_parallel_rendering_matches_serial_rendering(tmp_path, pool):
+    attn_matrix = get_synthetic_completion_matrix(3, 12, 3, 2)
+    a = AttentionMatrix(attn_matrix)
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=False)
+
+    tokens = ["Hello", " World", "!", " How", " are"]
+    renderer = Renderer(RenderConfig())
+    renderer.render(tokens, 3, a, save_prefix=str(tmp_path / "serial_"))
+
+    with pool(max_workers=2) as executor:
+        htmls = renderer.iter_htmls(tokens, 3, a, executor=executor, max_in_flight=2)
+
+        # Chunks are produced one at a time, in order
+        assert next(htmls)["name"] == "Layer-0__Chunk-0"
+
+        renderer.render(
+            tokens,
+            3,
+            a,
+            save_prefix=str(tmp_path / "parallel_"),
+            executor=executor,
+            max_in_flight=2,
+        )
+
+    id_regex = r'"AttViz-[0-9a-zA-Z]*'
+    names = [
+        f"Layer-{layer}__Chunk-{chunk}" for layer in range(3) for chunk in range(2)
+    ]
+
+    for name in names:
+        serial = (tmp_path / f"serial_{name}.html").read_text(encoding="UTF-8")
+        parallel = (tmp_path / f"parallel_{name}.html").read_text(encoding="UTF-8")
+
+        assert re.sub(id_regex, "", parallel) == re.sub(id_regex, "", serial)
+
+
+def test_streamed_payload_matches_json_dump(tmp_path, mocker):
+    a = AttentionMatrix(get_synthetic_completion_matrix(2, 3, 3, 2))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+
+    load_template = mocker.spy(Renderer, "_load_template")
+    renderer = Renderer(RenderConfig())
+    renderer.render(["a", "b", "c", "d", "e"], 3, a, save_prefix=str(tmp_path / "x_"))
+
+    # The script is read once per renderer, not once per chunk
+    assert load_template.call_count == 1
+
+    html_content = (tmp_path / "x_Layer-1__Chunk-0.html").read_text(encoding="UTF-8")
+    payload = html_content.split("const params = ", 1)[1].split("; // HACK", 1)[0]
+
+    assert (
+        json.loads(payload)["attention"]["attn"]
+        == a.get_slice(layers=slice(1, 2)).tolist()
+    )
+
+
+@pytest.mark.parametrize(
+    "encoding, atol",
+    [(AttentionEncoding.FLOAT16, 1e-3), (AttentionEncoding.UINT8, 1 / 255)],
+)
+def test_binary_attention_encoding(tmp_path, encoding, atol):
+    a = AttentionMatrix(get_synthetic_completion_matrix(2, 3, 4, 5))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+
+    Renderer(RenderConfig(attention_encoding=encoding)).render(
+        ["a", "b", "c", "d", "e", "f", "g", "h", "i"],
+        4,
+        a,
+        save_prefix=str(tmp_path / "x_"),
+    )
+
+    html_content = (tmp_path / "x_Layer-0__Chunk-0.html").read_text(encoding="UTF-8")
+    payload = html_content.split("const params = ", 1)[1].split("; // HACK", 1)[0]
+    attn = json.loads(payload)["attention"]["attn"]
+
+    assert attn["encoding"] == encoding.name.lower()
+    assert attn["shape"] == [1, 3]
+    assert attn["row_offsets"] == a.get_slice().row_offsets.tolist()
+
+    expected = a.get_slice(layers=slice(0, 1)).data
+    data = base64.b64decode(attn["data"])
+
+    if encoding == AttentionEncoding.FLOAT16:
+        decoded = torch.frombuffer(bytearray(data), dtype=torch.float16).float()
+    else:
+        scales = torch.frombuffer(
+            bytearray(base64.b64decode(attn["scales"])), dtype=torch.float32
+        )
+        lengths = a.get_slice().lengths
+        decoded = (
+            torch.frombuffer(bytearray(data), dtype=torch.uint8).float()
+            * torch.repeat_interleave(scales.view(3, -1), lengths, dim=-1).flatten()
+        )
+
+    assert torch.allclose(decoded.view(expected.shape), expected, atol=atol)
+
+
+def test_shared_assets(tmp_path):
+    a = AttentionMatrix(get_synthetic_completion_matrix(2, 3, 3, 2))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+    tokens = ["Hello", " World", "!", " How", " are"]
+
+    Renderer(RenderConfig(shared_assets=True)).render(
+        tokens, 3, a, save_prefix=str(tmp_path / "x_")
+    )
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "x_Layer-0__Chunk-0.html",
+        "x_Layer-1__Chunk-0.html",
+        "x_attention_viz.js",
+        "x_tokens.js",
+    ]
+
+    script = (tmp_path / "x_attention_viz.js").read_text(encoding="UTF-8")
+    assert "PYTHON_PARAMS" not in script
+    assert "window.attVizShared" in script
+
+    shared = (tmp_path / "x_tokens.js").read_text(encoding="UTF-8")
+    shared = json.loads(shared.removeprefix("window.attVizShared = ").rstrip(";\n"))
+    assert shared["tokens"] == tokens
+    assert shared["prompt_length"] == 3
+
+    html_content = (tmp_path / "x_Layer-1__Chunk-0.html").read_text(encoding="UTF-8")
+
+    # Assets are referenced relative to the HTML file, and not duplicated in it
+    assert '<script src="x_tokens.js"></script>' in html_content
+    assert '<script src="x_attention_viz.js"></script>' in html_content
+    assert "requirejs" not in html_content
+
+    params = html_content.split("window.attVizParams = ", 1)[1].split(
+        ";\n</script>", 1
+    )[0]
+    params = json.loads(params)["attention"]
+    assert "tokens" not in params and "pos" not in params
+    assert params["attn"] == a.get_slice(layers=slice(1, 2)).tolist()
+
+
+def test_sparse_attention_encoding(tmp_path):
+    a = AttentionMatrix(get_synthetic_completion_matrix(1, 2, 4, 5))
+    a.format(
+        AttentionAggregationMethod.NONE,
+        zero_first_attention=True,
+        sparsity=AttentionSparsity.top_k(2),
+    )
+
+    Renderer(RenderConfig(attention_encoding=AttentionEncoding.SPARSE)).render(
+        list("abcdefghi"), 4, a, save_prefix=str(tmp_path / "x_")
+    )
+
+    html_content = (tmp_path / "x_Layer-0__Chunk-0.html").read_text(encoding="UTF-8")
+    payload = html_content.split("const params = ", 1)[1].split("; // HACK", 1)[0]
+    attn = json.loads(payload)["attention"]["attn"]
+
+    counts = torch.frombuffer(
+        bytearray(base64.b64decode(attn["counts"])), dtype=torch.int32
+    )
+    indices = torch.frombuffer(
+        bytearray(base64.b64decode(attn["indices"])), dtype=torch.int16
+    )
+    values = torch.frombuffer(
+        bytearray(base64.b64decode(attn["data"])), dtype=torch.float16
+    )
+
+    # Two values per row, for 2 heads and 5 rows
+    assert attn["encoding"] == "sparse"
+    assert counts.tolist() == [2] * 10
+    assert len(indices) == len(values) == 20
+
+    decoded = torch.zeros_like(a.get_slice().data)
+    offsets = a.get_slice().row_offsets
+    for k in range(20):
+        head, row = divmod(k // 2, 5)
+        decoded[0, head, offsets[row] + indices[k]] = values[k].float()
+
+    assert torch.allclose(decoded, a.get_slice().data, atol=1e-3)
+
+
+def test_canvas_backend(tmp_path):
+    a = AttentionMatrix(get_synthetic_completion_matrix(1, 2, 3, 2))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+    tokens = ["Hello", " World", "!", " How", " are"]
+
+    Renderer(RenderConfig()).render(tokens, 3, a, save_prefix=str(tmp_path / "svg_"))
+    Renderer(RenderConfig(backend=RenderBackend.CANVAS)).render(
+        tokens, 3, a, save_prefix=str(tmp_path / "canvas_")
+    )
+
+    svg = get_params(
+        (tmp_path / "svg_Layer-0__Chunk-0.html").read_text(encoding="UTF-8")
+    )
+    canvas = get_params(
+        (tmp_path / "canvas_Layer-0__Chunk-0.html").read_text(encoding="UTF-8")
+    )
+
+    # The default payload is unchanged
+    assert "backend" not in svg
+    assert canvas.pop("backend") == "canvas"
+    assert canvas["attention"] == svg["attention"]
+
+
+def get_params(html_content):
+    return json.loads(
+        html_content.split("const params = ", 1)[1].split("; // HACK", 1)[0]
+    )
+
+
+def test_final_token_layout_with_font_metrics(tmp_path):
+    a = AttentionMatrix(get_synthetic_completion_matrix(1, 2, 3, 2))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+    tokens = ["Hello", " World", "!", " How", " are"]
+
+    Renderer(RenderConfig()).render(tokens, 3, a, save_prefix=str(tmp_path / "a_"))
+    Renderer(RenderConfig(font_metrics=FontMetrics.default())).render(
+        tokens, 3, a, save_prefix=str(tmp_path / "b_")
+    )
+
+    guessed = get_params((tmp_path / "a_Layer-0__Chunk-0.html").read_text("UTF-8"))
+    final = get_params((tmp_path / "b_Layer-0__Chunk-0.html").read_text("UTF-8"))
+
+    assert "pos_final" not in guessed["attention"]
+    assert final["attention"]["pos_final"] is True
+    assert final["attention"]["pos"] != guessed["attention"]["pos"]
+
+
+@pytest.mark.parametrize("sidecar_files", [False, True])
+def test_single_page_viewer(tmp_path, sidecar_files):
+    a = AttentionMatrix(get_synthetic_completion_matrix(3, 2, 3, 2))
+    a.format(AttentionAggregationMethod.NONE, zero_first_attention=True)
+    tokens = ["Hello", " World", "!", " How", " are"]
+
+    r = Renderer(RenderConfig(attention_encoding=AttentionEncoding.FLOAT16))
+    path = r.render_viewer(
+        tokens,
+        3,
+        a,
+        save_prefix=str(tmp_path / "att_viz_"),
+        sidecar_files=sidecar_files,
+    )
+
+    assert path == str(tmp_path / "att_viz_viewer.html")
+    params = get_params((tmp_path / "att_viz_viewer.html").read_text("UTF-8"))
+    attention = params["attention"]
+
+    assert attention["num_layers"] == 3
+    assert attention["layer_indices"] == [0, 1, 2]
+    assert attention["attn"]["encoding"] == "layers"
+    assert len(attention["attn"]["layers"]) == 3
+
+    for layer, source in enumerate(attention["attn"]["layers"]):
+        if sidecar_files:
+            script = (tmp_path / source["src"]).read_text("UTF-8")
+            assert source["src"] == f"att_viz_layer-{layer}.js"
+            assert json.dumps(source["key"]) in script
+            payload = json.loads(script.split("] = ", 1)[1].rstrip(";\n"))
+        else:
+            payload = json.loads(gzip.decompress(base64.b64decode(source["gzip"])))
+
+        expected = a.get_slice(layers=slice(layer, layer + 1))
+        assert payload["shape"] == [1, 2]
+        values = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.float16)
+        assert np.allclose(values, expected.data.flatten().numpy(), atol=1e-3)
+
+
+@pytest.mark.parametrize(
+    "aggr_method, names",
+    [
+        (
+            AttentionAggregationMethod.NONE,
+            [
+                "Layer-0__Chunk-0",
+                "Layer-0__Chunk-1",
+                "Layer-1__Chunk-0",
+                "Layer-1__Chunk-1",
+            ],
+        ),
+        (
+            AttentionAggregationMethod.LAYERWISE_AVERAGING,
+            ["Layer-0__Chunk-0", "Layer-0__Chunk-1"],
+        ),
+        (AttentionAggregationMethod.HEADWISE_MAX, [""]),
+        (AttentionAggregationMethod.ROLLOUT, [""]),
+    ],
+)
+def test_chunking_accounts_for_collapsed_dimensions(aggr_method, names):
+    a = AttentionMatrix(get_synthetic_completion_matrix(2, 10, 3, 2))
+    a.format(aggr_method, zero_first_attention=True)
+    tokens = ["Hello", " World", "!", " How", " are"]
+
+    chunks = list(Renderer(RenderConfig(), aggr_method)._iter_chunks(tokens, 3, a))
+
+    assert [name for _, _, name in chunks] == names
+    for attn_data, _, _ in chunks:
+        assert attn_data["attn"].data.shape[:2] == (
+            attn_data["num_layers"],
+            attn_data["num_heads"],
+        )
+        assert len(attn_data["layer_indices"]) == attn_data["num_layers"]
+        assert len(attn_data["head_indices"]) == attn_data["num_heads"]
@@ -1,63 +1,19 @@
 import pickle
 import re
+import pytest
 import torch
 from ..att_viz.utils import (
     save_completions,
     process_saved_completions,
+    convert_pickled_completions,
 )
 from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
 from ..att_viz.renderer import RenderConfig
 from ..att_viz.self_attention_model import SelfAttentionModel
 from ..att_viz.attention_matrix import AttentionMatrix
-
-
-class MockFileOpener:
-    def __init__(self):
-        self.files = {}
-
-    def open_file(self, filename, *args, **kwargs):
-        if filename not in self.files:
-            new_file_pointer = MockFilePointer()
-            self.files.update({filename: new_file_pointer})
-
-        return self.files.get(filename)
-
-
-class MockFileOpenerForWrites(MockFileOpener):
-    def add_file_pointer(self, filename, fp):
-        self.files.update({filename: fp})
-
-    def open_file(self, filename, *args, **kwargs):
-        if filename.endswith("attention_viz.js"):
-            filename = "attention_viz.js"
-
-        return super().open_file(filename, *args, **kwargs)
-
-
-class MockFilePointer:
-    def __init__(self):
-        self.content = ""
-        self.num_reads = 0
-        self.num_writes = 0
-
-    def write(self, content):
-        self.num_writes += 1
-        print(self.content)
-        self.content = content
-
-    def read(self, *args, **kwargs):
-        self.num_reads += 1
-        # print(str(self.content))
-        return self.content
-
-    def close(self):
-        pass
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *args, **kwargs):
-        pass
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.packed_attention import PackedAttention
+from .test_attention_matrix import get_synthetic_completion_matrix
 
 
 class MockModel:
@@ -94,14 +50,12 @@ class MockTokenizer:
         return self
 
 
-def test_save_completions(mocker):
+def test_save_completions(mocker, tmp_path, monkeypatch):
     model_name = "Salesforce/codegen-350M-mono"
 
     prompts = ["Hello, World!", "print('Garfield')"]
     save_prefixes = ["example_0", "example_1"]
 
-    mock_opener = MockFileOpener()
-
     mock_model = MockModel()
     mock_tokenizer = MockTokenizer()
 
@@ -111,42 +65,30 @@ def test_save_completions(mocker):
     mocker.patch(
         "transformers.AutoTokenizer.from_pretrained", mock_tokenizer.from_pretrained
     )
-    mocker.patch("builtins.open", mock_opener.open_file)
+    monkeypatch.chdir(tmp_path)
     save_completions(model_name, prompts, save_prefixes)
 
     for save_prefix in save_prefixes:
-        for suffix in ["completion_tokens", "attention_matrix", "input_length"]:
-            assert f"{save_prefix}_{suffix}.pickle" in mock_opener.files
-
-            mock_pointer = mock_opener.files.get(f"{save_prefix}_{suffix}.pickle")
-
-            assert mock_pointer.num_reads == 0
-            assert mock_pointer.num_writes == 1
-
-            if suffix == "completion_tokens":
-                assert (
-                    pickle.loads(mock_pointer.read())
-                    == mock_tokenizer.convert_ids_to_tokens()
-                )
-            elif suffix == "attention_matrix":
-                assert pickle.loads(mock_pointer.read()) == AttentionMatrix(
-                    mock_model.attentions
-                )
-            else:
-                assert (
-                    pickle.loads(mock_pointer.read())
-                    == mock_tokenizer.encoded.shape[-1]
-                )
-
-
-def test_process_completions(mocker):
+        assert not list(tmp_path.glob(f"{save_prefix}_*.pickle"))
+
+        store = AttentionStore(AttentionStore.path_for(save_prefix))
+
+        assert store.tokens == mock_tokenizer.convert_ids_to_tokens()
+        assert store.prompt_length == mock_tokenizer.encoded.shape[-1]
+        assert store.model_name == model_name
+        assert AttentionMatrix(store.read()) == AttentionMatrix(mock_model.attentions)
+        assert torch.equal(
+            store.read().data,
+            PackedAttention.from_generate(mock_model.attentions).data,
+        )
+
+
+def test_process_completions(mocker, tmp_path, monkeypatch):
     model_name = "Salesforce/codegen-350M-mono"
 
     prompts = ["Hello, World!", "print('Garfield')"]
     save_prefixes = ["example_0", "example_1"]
 
-    mock_opener = MockFileOpener()
-
     mock_model = MockModel()
     mock_tokenizer = MockTokenizer()
 
@@ -156,51 +98,23 @@ def test_process_completions(mocker):
     mocker.patch(
         "transformers.AutoTokenizer.from_pretrained", mock_tokenizer.from_pretrained
     )
-    mocker.patch("builtins.open", mock_opener.open_file)
+    monkeypatch.chdir(tmp_path)
     save_completions(model_name, prompts, save_prefixes)
     process_saved_completions(
         RenderConfig(), AttentionAggregationMethod.NONE, save_prefixes
     )
 
-    for save_prefix in save_prefixes:
-        for suffix in ["completion_tokens", "attention_matrix", "input_length"]:
-            assert f"{save_prefix}_{suffix}.pickle" in mock_opener.files
-
-            mock_pointer = mock_opener.files.get(f"{save_prefix}_{suffix}.pickle")
-
-            assert mock_pointer.num_reads == 1
-            assert mock_pointer.num_writes == 1
-
-            if suffix == "completion_tokens":
-                assert (
-                    pickle.loads(mock_pointer.read())
-                    == mock_tokenizer.convert_ids_to_tokens()
-                )
-            elif suffix == "attention_matrix":
-                assert pickle.loads(mock_pointer.read()) == AttentionMatrix(
-                    mock_model.attentions
-                )
-            else:
-                assert (
-                    pickle.loads(mock_pointer.read())
-                    == mock_tokenizer.encoded.shape[-1]
-                )
-
-    ## Assert 2 and only 2 .html file were created
-    html_pointers = [
-        file_pointer
-        for filename, file_pointer in mock_opener.files.items()
-        if filename.endswith(".html")
-    ]
-
-    assert len(html_pointers) == 2
+    ## The mock attention matrix has 2 layers of 2 heads: one chunk per layer
+    html_paths = sorted(tmp_path.glob("*.html"))
 
-    for html_pointer in html_pointers:
-        assert html_pointer.num_reads == 0
-
-        assert html_pointer.num_writes == 2
+    assert [path.name for path in html_paths] == [
+        f"{save_prefix}Layer-{layer}__Chunk-0.html"
+        for save_prefix in save_prefixes
+        for layer in range(2)
+    ]
 
-        html_content = html_pointer.read()
+    for html_path in html_paths:
+        html_content = html_path.read_text(encoding="UTF-8")
 
         # Basic content checks (todo, maybe: check content against an already-rendered html file)
         assert """<title>att_viz</title>""" in html_content
@@ -210,6 +124,102 @@ def test_process_completions(mocker):
         )
 
 
+def test_convert_pickled_completions(tmp_path, monkeypatch):
+    attentions = get_synthetic_completion_matrix()
+    tokens = [f"token_{i}" for i in range(5 + len(attentions))]
+
+    monkeypatch.chdir(tmp_path)
+    for suffix, obj in [
+        ("completion_tokens", tokens),
+        ("attention_matrix", AttentionMatrix(attentions)),
+        ("input_length", 5),
+    ]:
+        with open(f"legacy_{suffix}.pickle", "wb") as fp:
+            fp.write(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    convert_pickled_completions(["legacy"], "some/model", remove_pickles=True)
+
+    assert not list(tmp_path.glob("*.pickle"))
+
+    store = AttentionStore(AttentionStore.path_for("legacy"))
+
+    assert store.tokens == tokens
+    assert store.prompt_length == 5
+    assert store.model_name == "some/model"
+    assert torch.equal(
+        store.read().data, PackedAttention.from_generate(attentions).data
+    )
+
+
+def test_convert_pickled_completions_from_another_device(tmp_path, mocker):
+    attentions = get_synthetic_completion_matrix()
+    save_prefix = str(tmp_path / "legacy")
+
+    # Pickled tensors keep the device of their storage: these ones were on a GPU
+    mocker.patch("torch.serialization.location_tag", return_value="cuda:0")
+    for suffix, obj in [
+        ("completion_tokens", [f"token_{i}" for i in range(5 + len(attentions))]),
+        ("attention_matrix", AttentionMatrix(attentions)),
+        ("input_length", 5),
+    ]:
+        with open(f"{save_prefix}_{suffix}.pickle", "wb") as fp:
+            fp.write(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    mocker.stopall()
+
+    mocker.patch("torch.cuda.is_available", return_value=False)
+    with open(f"{save_prefix}_attention_matrix.pickle", "rb") as fp:
+        with pytest.raises(RuntimeError, match="CUDA"):
+            pickle.load(fp)
+
+    convert_pickled_completions([save_prefix])
+
+    assert torch.equal(
+        AttentionStore(AttentionStore.path_for(save_prefix)).read().data,
+        PackedAttention.from_generate(attentions).data,
+    )
+
+
+def test_process_saved_completions_in_parallel(tmp_path):
+    attentions = get_synthetic_completion_matrix(num_layers=2)
+    tokens = [f"token_{i}" for i in range(5 + len(attentions))]
+    save_prefixes = [str(tmp_path / f"completion_{i}") for i in range(5)]
+
+    for save_prefix in save_prefixes:
+        AttentionStore.write(
+            AttentionStore.path_for(save_prefix),
+            PackedAttention.from_generate(attentions),
+            tokens,
+            5,
+        )
+
+    # A corrupt store must not abort the other save prefixes
+    with open(AttentionStore.path_for(save_prefixes[2]), "wb") as fp:
+        fp.write(b"not an attention store")
+
+    reported = []
+    summary = process_saved_completions(
+        RenderConfig(),
+        AttentionAggregationMethod.NONE,
+        save_prefixes,
+        workers=2,
+        max_in_flight=2,
+        progress=lambda done, total, save_prefix, elapsed, error: reported.append(
+            (done, total, save_prefix)
+        ),
+    )
+
+    assert reported == [(i + 1, 5, p) for i, p in enumerate(save_prefixes)]
+    assert list(summary.timings) == save_prefixes
+    assert list(summary.failures) == [save_prefixes[2]]
+    assert summary.succeeded == save_prefixes[:2] + save_prefixes[3:]
+
+    assert sorted(path.name for path in tmp_path.glob("*.html")) == [
+        f"completion_{i}Layer-{layer}__Chunk-0.html"
+        for i in [0, 1, 3, 4]
+        for layer in range(2)
+    ]
+
+
 def test_pickling_works():
     model_name = "Salesforce/codegen-350M-mono"
 
@@ -228,27 +238,24 @@ def test_pickling_works():
     )
 
 
-def test_rendering_saved_completions_works(mocker):
+def test_rendering_saved_completions_works(tmp_path, monkeypatch):
     with open("test/test_result.html", "r") as fp:
         expected_html_content = fp.read()
 
-    mock_opener = MockFileOpenerForWrites()
-
-    mock_opener.add_file_pointer(
-        "test_attention_matrix.pickle", open("test/test_attention_matrix.pickle", "rb")
+    # The golden visualization was rendered from these completion tokens, attention matrix and input length
+    fixtures = []
+    for suffix in ["completion_tokens", "attention_matrix", "input_length"]:
+        with open(f"test/test_{suffix}.pickle", "rb") as fp:
+            fixtures.append(pickle.load(fp))
+    completion_tokens, attention_matrix, input_length = fixtures
+
+    monkeypatch.chdir(tmp_path)
+    AttentionStore.write(
+        AttentionStore.path_for("test"),
+        PackedAttention.from_generate(attention_matrix.attention_matrix),
+        completion_tokens,
+        input_length,
     )
-    mock_opener.add_file_pointer(
-        "test_completion_tokens.pickle",
-        open("test/test_completion_tokens.pickle", "rb"),
-    )
-    mock_opener.add_file_pointer(
-        "test_input_length.pickle", open("test/test_input_length.pickle", "rb")
-    )
-    mock_opener.add_file_pointer(
-        "attention_viz.js", open("att_viz/attention_viz.js", "r")
-    )
-
-    mocker.patch("builtins.open", mock_opener.open_file)
 
     process_saved_completions(
         RenderConfig(),
@@ -256,21 +263,11 @@ def test_rendering_saved_completions_works(mocker):
         save_prefixes=["test"],
     )
 
-    html_pointers = [
-        file_pointer
-        for filename, file_pointer in mock_opener.files.items()
-        if filename.endswith(".html")
-    ]
-
-    assert len(html_pointers) == 1
-
-    html_pointer = html_pointers[0]
-
-    assert html_pointer.num_reads == 0
+    html_paths = list(tmp_path.glob("*.html"))
 
-    assert html_pointer.num_writes == 1
+    assert len(html_paths) == 1
 
-    html_content = html_pointer.read()
+    html_content = html_paths[0].read_text(encoding="UTF-8")
 
     id_regex = r'"AttViz-[0-9a-zA-Z]*"'
 
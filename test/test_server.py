@@ -0,0 +1,131 @@
+import json
+import struct
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+import torch
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_matrix import LazyAttentionMatrix
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.renderer import RenderConfig, Renderer
+from ..att_viz.server import AttentionServer
+from .test_attention_store import write_synthetic_store
+
+
+def read_slice(body):
+    (header_length,) = struct.unpack("<I", body[:4])
+    header = json.loads(body[4 : 4 + header_length])
+    values = np.frombuffer(body[4 + header_length :], dtype=np.float16)
+    return header, values
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    (tmp_path / "runs").mkdir()
+    write_synthetic_store(tmp_path / AttentionStore.path_for("first"))
+    write_synthetic_store(tmp_path / "runs" / AttentionStore.path_for("second"))
+    return tmp_path
+
+
+def test_prefixes(store_dir):
+    server = AttentionServer(str(store_dir))
+
+    assert server.prefixes() == ["first", "runs/second"]
+    assert b'href="view?prefix=runs/second"' in server.index_page()
+
+    with pytest.raises(FileNotFoundError):
+        server.store_path("../first")
+    with pytest.raises(FileNotFoundError):
+        server.store_path("missing")
+
+
+def test_attention_slice(store_dir):
+    server = AttentionServer(str(store_dir))
+
+    expected = LazyAttentionMatrix(
+        AttentionStore(str(store_dir / AttentionStore.path_for("first")))
+    )
+    expected.format(AttentionAggregationMethod.NONE, True, dtype=torch.float16)
+    layer = expected.get_slice(layers=slice(1, 2), heads=slice(1, 3))
+
+    header, values = read_slice(
+        server.attention_slice("first", 1, heads="1-2", tokens="2-4")
+    )
+    offsets = layer.row_offsets[2:6]
+
+    assert header["encoding"] == "float16"
+    assert header["shape"] == [1, 2]
+    assert header["first_row"] == 2
+    assert header["row_offsets"] == (offsets - offsets[0]).tolist()
+    assert np.array_equal(
+        values, layer.data[..., offsets[0] : offsets[-1]].flatten().numpy()
+    )
+
+    # Whole layers, as requested by the viewer
+    header, values = read_slice(server.attention_slice("first", 0))
+    assert header["shape"] == [1, 4]
+    assert len(values) == 4 * expected.attention_matrix.data.shape[-1]
+
+    with pytest.raises(ValueError):
+        server.attention_slice("first", 3)
+    with pytest.raises(ValueError):
+        server.attention_slice("first", 0, heads="2-9")
+
+
+def test_aggregated_attention_slice(store_dir):
+    server = AttentionServer(
+        str(store_dir),
+        Renderer(RenderConfig(), AttentionAggregationMethod.HEADWISE_AVERAGING),
+    )
+
+    header, _ = read_slice(server.attention_slice("first", 2))
+    assert header["shape"] == [1, 1]
+
+
+def test_http_server(store_dir):
+    server = AttentionServer(str(store_dir))
+    httpd = server.make_server(port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    try:
+        with urllib.request.urlopen(f"{base}/view?prefix=runs/second") as response:
+            page = response.read().decode("UTF-8")
+            assert response.headers["Content-Type"].startswith("text/html")
+
+        params = json.loads(
+            page.split("const params = ", 1)[1].split("; // HACK", 1)[0]
+        )
+        sources = params["attention"]["attn"]["layers"]
+        assert sources[2] == {"url": "attn?prefix=runs/second&layer=2"}
+
+        with urllib.request.urlopen(f"{base}/{sources[2]['url']}") as response:
+            body = response.read()
+            etag = response.headers["ETag"]
+            assert response.headers["Content-Type"] == "application/octet-stream"
+            assert response.headers["Cache-Control"] == AttentionServer.CACHE_CONTROL
+            assert response.headers["Last-Modified"]
+        assert body == server.attention_slice("runs/second", 2)
+
+        # Unchanged slices are revalidated without being sent again
+        request = urllib.request.Request(
+            f"{base}/{sources[2]['url']}", headers={"If-None-Match": etag}
+        )
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 304
+
+        for url, code in [
+            ("/attn?prefix=missing&layer=0", 404),
+            ("/attn?prefix=first&layer=7", 400),
+            ("/attn?prefix=first", 400),
+            ("/unknown", 404),
+        ]:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(base + url)
+            assert error.value.code == code
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
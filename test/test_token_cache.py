@@ -0,0 +1,164 @@
+import os
+import random
+import numpy as np
+import pytest
+from ..att_viz.attention_aggregation_method import AttentionAggregationMethod
+from ..att_viz.attention_store import AttentionStore
+from ..att_viz.font_metrics import FontMetrics
+from ..att_viz.packed_attention import PackedAttention
+from ..att_viz.renderer import RenderConfig, Renderer
+from ..att_viz.token_cache import TokenCache
+from ..att_viz.utils import process_saved_completions
+from .test_attention_matrix import get_synthetic_completion_matrix
+
+
+def reference_token_info(renderer, tokens, prompt_length):
+    """Lays tokens out one at a time, measuring every token."""
+    info, dx, dy = [], 0, 0
+    config = renderer.render_config
+
+    for i, t in enumerate(tokens):
+        space, w, bold_w = renderer._measure_token(t)
+        if config.font_metrics is not None and i < prompt_length:
+            w = bold_w
+        info.append([config.x_margin + dx, config.y_margin + dy, w, space])
+
+        dx += w
+        if dx > config.line_length or t == "\n":
+            dx = 0
+            dy += config.token_height
+
+    return info, dy
+
+
+@pytest.mark.parametrize("font_metrics", [None, FontMetrics.default()])
+@pytest.mark.parametrize("seed", range(3))
+def test_layout_matches_token_by_token_layout(font_metrics, seed):
+    rng = random.Random(seed)
+    vocabulary = ["a", " the", " attention", "ization", "\n", ",", " visualization" * 3]
+    tokens = [rng.choice(vocabulary) for _ in range(300)]
+    renderer = Renderer(RenderConfig(line_length=200, font_metrics=font_metrics))
+
+    for _ in range(2):  # The second layout only reads the cache
+        info, dy = renderer.create_token_info(tokens, prompt_length=40)
+        expected_info, expected_dy = reference_token_info(renderer, tokens, 40)
+
+        assert dy == pytest.approx(expected_dy)
+        assert np.allclose(info, expected_info)
+
+
+def test_tokens_are_prettified_and_measured_once():
+    renderer = Renderer(RenderConfig())
+    prettified, measured = [], []
+    cache = renderer.token_cache
+
+    texts = cache.prettify(
+        ["Ġa", "b", "Ġa"], lambda t: prettified.append(t) or renderer._prettify_token(t)
+    )
+    assert texts == [" a", "b", " a"]
+    cache.prettify(["b", "Ġa"], lambda t: prettified.append(t))
+    assert sorted(prettified) == ["b", "Ġa"]
+
+    def measure(t):
+        measured.append(t)
+        return renderer._measure_token(t)
+
+    spaces, widths, _ = cache.layout([" a", "b", " a"], "key", measure)
+    assert spaces == [1, 0, 1] and widths == [20, 20, 20]
+    cache.layout(["b"], "key", measure)
+    assert sorted(measured) == [" a", "b"]
+
+    # Widths computed with another configuration are discarded
+    cache.layout(["b"], "other key", measure)
+    assert measured[-1] == "b" and len(measured) == 3
+
+
+def test_cache_is_keyed_by_configuration():
+    cache = TokenCache()
+    tokens = ["Hello", " World"]
+
+    small = Renderer(RenderConfig(token_width=50), token_cache=cache)
+    large = Renderer(RenderConfig(token_width=200), token_cache=cache)
+
+    assert small.create_token_info(tokens)[0][0][2] == pytest.approx(5 / 11 * 50)
+    assert large.create_token_info(tokens)[0][0][2] == pytest.approx(5 / 11 * 200)
+    assert small.create_token_info(tokens)[0][0][2] == pytest.approx(5 / 11 * 50)
+
+
+def test_added_tokens_are_taken_and_merged():
+    renderer = Renderer(RenderConfig())
+    cache = renderer.token_cache
+    renderer.create_token_info(renderer._format_special_chars(["ĠHello", "Ċ"]))
+
+    merged = TokenCache()
+    merged.merge(cache.take_added())
+    assert len(merged) == len(cache) == 4
+
+    renderer.create_token_info(renderer._format_special_chars(["ĠHello", "Ġyou"]))
+    added = cache.take_added()
+    assert added._texts == {"Ġyou": " you"} and list(added._layout) == [" you"]
+    assert len(cache.take_added()) == 0
+
+    merged.merge(added)
+    assert merged._texts == cache._texts and merged._layout == cache._layout
+
+    # Widths computed with another configuration replace the merged ones
+    other = Renderer(RenderConfig(token_width=200))
+    other.create_token_info(["a"])
+    merged.merge(other.token_cache.take_added())
+    assert list(merged._layout) == ["a"] and len(merged._texts) == 3
+
+
+def test_save_and_load(tmp_path):
+    path = TokenCache.path_for(str(tmp_path), "Salesforce/codegen-350M-mono")
+    assert path == os.path.join(
+        str(tmp_path), "Salesforce_codegen-350M-mono_token_cache.json"
+    )
+    assert TokenCache.path_for(str(tmp_path)).endswith("tokens_token_cache.json")
+
+    renderer = Renderer(RenderConfig(), token_cache=TokenCache("codegen"))
+    tokens = renderer._format_special_chars(["ĠHello", "Ċ", "▁été"])
+    info, dy = renderer.create_token_info(tokens)
+    renderer.token_cache.save(path)
+
+    loaded = TokenCache.load(path)
+    assert loaded.tokenizer_name == "codegen" and len(loaded) == 6
+    assert (
+        str(loaded)
+        == "TokenCache (codegen: 3 prettified token(s), 3 measured token(s))"
+    )
+
+    def fail(t):
+        raise AssertionError(f"{t} is not cached")
+
+    assert loaded.prettify(["ĠHello", "Ċ", "▁été"], fail) == tokens
+    reloaded = Renderer(RenderConfig(), token_cache=loaded)
+    reloaded._measure_token = fail
+    assert reloaded.create_token_info(tokens) == (info, dy)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_processing_saved_completions_persists_the_cache(tmp_path, workers):
+    attentions = get_synthetic_completion_matrix(num_layers=1)
+    tokens = [f"Ġtoken_{i}" for i in range(5 + len(attentions))]
+    save_prefix = str(tmp_path / "completion")
+    AttentionStore.write(
+        AttentionStore.path_for(save_prefix),
+        PackedAttention.from_generate(attentions),
+        tokens,
+        5,
+    )
+    path = TokenCache.path_for(str(tmp_path))
+    TokenCache().save(path)
+
+    summary = process_saved_completions(
+        RenderConfig(),
+        AttentionAggregationMethod.NONE,
+        [save_prefix],
+        workers=workers,
+        token_cache_path=path,
+    )
+    assert not summary.failures
+
+    cache = TokenCache.load(path)
+    assert len(cache) == 2 * len(tokens)